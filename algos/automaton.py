@@ -5,28 +5,53 @@ Clustering using cellular automaton
 import scipy.signal
 import numpy as np
 import numpy.ma as ma
-from numba import autojit
 from copy import deepcopy
+import itertools
+from functools import partial
+
+import gm2_clustering.instrument as instrument
+import algos.automaton_kernels as automaton_kernels
+
+
+@instrument.instrumented()
+def find_seeds(wfs, threshold=200, kernels=None):
+    """
+    Find the local maxima of a stack of waveforms in one pass.
+
+    A voxel is a seed if it is the maximum of its (up to) 3x3x3 neighbourhood
+    and is above threshold. Neighbourhoods never cross event boundaries.
+
+    Params:
+    wfs - (N*9*6*T) numpy array of waveforms. A single (9*6*T) waveform
+          is treated as a stack of one.
+    threshold - minimum amplitude of a seed
+    kernels - "numba" or "numpy", see automaton_kernels. Default is
+              automaton_kernels.default
+
+    Returns:
+    (seeds, offsets) seeds is a flat array of indices into each event's
+                     (9*6*T) grid, in C order. The seeds of event n are
+                     seeds[offsets[n]:offsets[n+1]].
+    """
+    wfs = np.ascontiguousarray(wfs)
+    if wfs.ndim == 3:
+        wfs = wfs[np.newaxis]
+
+    # one compiled version per dtype, not per threshold type too
+    is_seed = automaton_kernels.get_kernels(kernels).local_maxima(wfs, float(threshold))
+
+    event_size = np.prod(wfs.shape[1:])
+    flat = np.flatnonzero(is_seed)
+    offsets = np.searchsorted(flat, np.arange(wfs.shape[0]+1)*event_size)
+    return flat - np.repeat(np.arange(wfs.shape[0])*event_size, np.diff(offsets)), offsets
 
 
-@autojit
 def get_local_maxima(wf, threshold=200):
     """Find the indices of any local maxima"""
-    imax, jmax, kmax = wf.shape
-    results = []
-    for i in xrange(imax):
-        for j in xrange(jmax):
-            for k in xrange(kmax):
-                x = wf[i, j, k]
-                surrounding = wf[max([i-1, 0]):min([i+2, imax]),
-                                 max([j-1, 0]):min([j+2, jmax]),
-                                 max([k-1, 0]):min([k+2, kmax])]
-                if np.max(surrounding) == x and x > threshold:
-                    results.append((i, j, k))
-    return results
+    seeds, _ = find_seeds(wf, threshold)
+    return zip(*np.unravel_index(seeds, wf.shape))
 
 
-@autojit
 def automaton_iteration(tags):
     """
     Do one iteration of the automaton
@@ -81,12 +106,112 @@ def automaton(wf, threshold):
 
     # run the automaton until it converges
     tag_last = np.zeros(wf.shape, dtype=np.object)
+    n_iterations = 0
     while not np.all(tag_last == tags):
-        tag_last[:] = tags
+        # the iteration updates the sets in place, so keep real copies
+        tag_last = deepcopy(tags)
         tags[:] = automaton_iteration(tags)
+        n_iterations += 1
+    instrument.count("automaton.iterations", n_iterations)
     return tags
 
 
+# offsets to the 27 cells of a 3x3x3 neighbourhood
+_NEIGHBOURHOOD = np.array(list(itertools.product((-1, 0, 1), repeat=3)))
+
+
+def _padded_layout(shape):
+    """
+    Layout of an array padded by one cell on every side. In the flattened
+    padded array the 3x3x3 neighbours of a cell are fixed offsets that
+    never fall off the edge.
+
+    Returns:
+    (padded_shape, inner, neighbours) inner is the index of the unpadded
+                                      region, neighbours the flat offsets.
+    """
+    padded_shape = tuple(np.add(shape, 2))
+    inner = tuple(slice(1, -1) for _ in shape)
+    strides = np.cumprod((1,) + padded_shape[:0:-1])[::-1]
+    return padded_shape, inner, _NEIGHBOURHOOD.dot(strides)
+
+
+def _label_words(n_labels):
+    """Number of 64-bit words needed to hold n_labels bits"""
+    return max(1, (n_labels+63)//64)
+
+
+def initialize_labels(wf, threshold, seed_threshold=200, kernels=None):
+    """
+    Integer version of initialize_tags.
+
+    Returns:
+    (labels, active) labels is a wf.shape + (n_words,) uint64 bitmask. Bit i
+                     is set for cells in cluster i+1, so the seeds start with
+                     one bit each. active is False for entries below the
+                     noise floor, which never get a label.
+    """
+    seeds, _ = find_seeds(wf, seed_threshold, kernels)
+    active = ~(wf < threshold)
+
+    n_words = _label_words(len(seeds))
+    labels = np.zeros(wf.shape + (n_words,), dtype=np.uint64)
+    ilabel = np.arange(len(seeds))
+    keep = active.ravel()[seeds]
+    flat_labels = labels.reshape(-1, n_words)
+    flat_labels[seeds[keep], ilabel[keep]//64] = np.left_shift(np.uint64(1),
+                                                               (ilabel[keep] % 64).astype(np.uint64))
+    return labels, active
+
+
+@instrument.instrumented()
+def label_automaton(wf, threshold, seed_threshold=200, kernels=None):
+    """
+    Same clusters as automaton, but with bitmask labels instead of sets.
+
+    A cell only changes in the step after one of its neighbours got its
+    first label, so each iteration only visits the neighbours of the cells
+    labeled in the previous one. Stops when nothing new was labeled.
+    kernels picks the implementation, see automaton_kernels.
+
+    Returns:
+    wf.shape + (n_words,) uint64 bitmask, see initialize_labels
+    """
+    labels, active = initialize_labels(wf, threshold, seed_threshold, kernels)
+    n_words = labels.shape[-1]
+
+    padded_shape, inner, neighbours = _padded_layout(wf.shape)
+    padded_labels = np.zeros(padded_shape + (n_words,), dtype=np.uint64)
+    padded_labels[inner] = labels
+    padded_active = np.zeros(padded_shape, dtype=np.bool)
+    padded_active[inner] = active
+
+    flat_labels = padded_labels.reshape(-1, n_words)
+    flat_active = padded_active.ravel()
+
+    frontier = np.flatnonzero(flat_labels.any(axis=1))
+    n_iterations = automaton_kernels.get_kernels(kernels).grow_offsets(flat_labels, flat_active,
+                                                                      frontier, neighbours)
+
+    instrument.count("label_automaton.iterations", n_iterations)
+    return padded_labels[inner]
+
+
+def label_ids(labels):
+    """Sorted list of the clusters present in a bitmask label array"""
+    present = np.bitwise_or.reduce(labels.reshape(-1, labels.shape[-1]), axis=0)
+    return [64*iword + ibit + 1
+            for iword, word in enumerate(present)
+            for ibit in xrange(64)
+            if (word >> np.uint64(ibit)) & np.uint64(1)]
+
+
+def has_label(labels, ilabel):
+    """Return boolean array indicating whether each labels entry contains ilabel"""
+    iword, ibit = divmod(ilabel-1, 64)
+    return ((labels[..., iword] >> np.uint64(ibit)) & np.uint64(1)).astype(np.bool)
+
+
 def _has_tag(x, y):
     if x == -1:
         return False
@@ -102,16 +227,6 @@ def has_tag(tags, itag):
     return _has_tag_obj(tags, itag).astype(np.bool)
 
 
-def get_clusters(wf, threshold=1):
-    """
-    Generator over clusters. Each cluster is the whole waveform array, with only 
-    the crystals in that cluster unmasked.
-    """
-    time_offset, trimmed_wf = make_time_island(wf)
-    tags = automaton(wf, threshold)
-    return get_tagged(wf, tags)
-
-
 def get_tagged(wf, tags):
     all_clusters = reduce(set.union, tags[tags != -1].ravel(), set())
 
@@ -124,6 +239,167 @@ def get_tagged(wf, tags):
         yield ma.copy(masked_wf)
 
 
+def get_labeled(wf, labels):
+    """Same as get_tagged, for the bitmask labels of label_automaton"""
+    masked_wf = wf.view(ma.MaskedArray)
+    masked_wf.fill_value = 0.
+    for icluster in label_ids(labels):
+        masked_wf.mask = False  # unmask everything
+        masked_wf[~has_label(labels, icluster)] = ma.masked
+
+        yield ma.copy(masked_wf)
+
+
+@instrument.instrumented()
+def find_sparse_seeds(events, threshold=200, neighbours=None):
+    """
+    find_seeds for a SparseEvents. Suppressed voxels count as zero, so as
+    long as events.threshold is below threshold the seeds are the same as
+    those of the dense waveforms.
+
+    Returns:
+    (seeds, offsets) in the same format as find_seeds
+    """
+    if neighbours is None:
+        neighbours = events.neighbours()
+    entries = _sparse_seed_entries(events, threshold, neighbours)
+    return (np.asarray(events.indices, dtype=np.int64)[entries],
+            np.searchsorted(entries, events.offsets[:len(events)+1]))
+
+
+def _sparse_seed_entries(events, threshold, neighbours):
+    """Entry numbers of the seeds, sorted"""
+    values = np.asarray(events.values[:len(neighbours)])
+    # index -1 (no stored neighbour) picks the appended sentinel
+    surrounding = np.append(values, -np.inf)[neighbours].max(axis=1)
+    return np.flatnonzero((values > threshold) & (values == surrounding))
+
+
+@instrument.instrumented()
+def sparse_label_automaton(events, threshold, seed_threshold=200, kernels=None):
+    """
+    label_automaton over all the events of a SparseEvents at once, walking
+    the stored voxels through their neighbour table instead of the grid.
+    When events.threshold is below threshold, every voxel that could get a
+    label is stored and the labels are exactly those of label_automaton on
+    each dense waveform.
+
+    Returns:
+    (n_entries*n_words) uint64 bitmask of each stored voxel. Labels are
+    numbered within each event, like initialize_labels.
+    """
+    neighbours = events.neighbours()
+    n_entries = len(neighbours)
+    values = np.asarray(events.values[:n_entries])
+    seed_entries = _sparse_seed_entries(events, seed_threshold, neighbours)
+
+    # labels are numbered from 0 in each event
+    seed_offsets = np.searchsorted(seed_entries, events.offsets[:len(events)+1])
+    seed_events = np.repeat(np.arange(len(events)), np.diff(seed_offsets))
+    ilabel = np.arange(len(seed_entries)) - seed_offsets[seed_events]
+
+    n_words = _label_words(np.max(np.diff(seed_offsets)) if len(events) else 0)
+    # the last row stays empty and inactive, it stands in for the missing
+    # neighbours (-1 in the table)
+    labels = np.zeros((n_entries+1, n_words), dtype=np.uint64)
+    active = np.append(~(values < threshold), False)
+    keep = active[seed_entries]
+    labels[seed_entries[keep], ilabel[keep]//64] = np.left_shift(np.uint64(1),
+                                                                 (ilabel[keep] % 64).astype(np.uint64))
+
+    n_iterations = automaton_kernels.get_kernels(kernels).grow_table(labels, active, seed_entries[keep],
+                                                                    neighbours)
+
+    instrument.count("sparse_label_automaton.iterations", n_iterations)
+    return labels[:-1]
+
+
+def sparse_cluster_counts(events, labels, kernels=None):
+    """Number of clusters in each event, from the labels of sparse_label_automaton"""
+    offsets = np.asarray(events.offsets[:len(events)+1], dtype=np.int64)
+    return automaton_kernels.get_kernels(kernels).label_counts(labels, offsets)
+
+
+@instrument.instrumented()
+def region_grow(wf, threshold, seed_threshold=200, kernels=None):
+    """
+    Single-pass alternative to label_automaton.
+
+    Floods out from the seeds over the cells above threshold, highest
+    amplitude first, like a watershed (see the priority_flood kernel).
+    Unlike the automaton, every cell belongs to at most one cluster.
+
+    Returns:
+    Integer array shaped like wf. 0 for cells in no cluster, i for cells
+    in cluster i. Cluster numbers match those of label_automaton.
+    """
+    seeds, _ = find_seeds(wf, seed_threshold, kernels)
+    active = ~(wf < threshold)
+    ilabel = np.arange(len(seeds)) + 1
+    keep = active.ravel()[seeds]
+    seeds, ilabel = seeds[keep], ilabel[keep]
+
+    padded_shape, inner, neighbours = _padded_layout(wf.shape)
+    # float64 holds every waveform dtype exactly, so the order is the same
+    padded_wf = np.zeros(padded_shape, dtype=np.float64)
+    padded_wf[inner] = wf
+    padded_active = np.zeros(padded_shape, dtype=np.bool)
+    padded_active[inner] = active
+    regions = np.zeros(padded_shape, dtype=np.int32)
+
+    seeds = np.ravel_multi_index(np.add(np.unravel_index(seeds, wf.shape), 1), padded_shape)
+    flat_regions = regions.reshape(-1)
+    flat_regions[seeds] = ilabel
+    if len(seeds):
+        automaton_kernels.get_kernels(kernels).priority_flood(padded_wf.ravel(), padded_active.ravel(),
+                                                              flat_regions, seeds, neighbours)
+    return regions[inner]
+
+
+def get_regions(wf, regions):
+    """Same as get_tagged, for the cluster numbers of region_grow"""
+    masked_wf = wf.view(ma.MaskedArray)
+    masked_wf.fill_value = 0.
+    for icluster in region_ids(regions):
+        masked_wf.mask = False  # unmask everything
+        masked_wf[regions != icluster] = ma.masked
+
+        yield ma.copy(masked_wf)
+
+
+def region_ids(regions):
+    """Sorted list of the clusters present in a region_grow array"""
+    return list(np.unique(regions[regions > 0]))
+
+
+# name: (grow clusters, list cluster numbers, generate masked clusters)
+_backends = {
+    "automaton": (label_automaton, label_ids, get_labeled),
+    "region": (region_grow, region_ids, get_regions),
+}
+
+
+def get_backend(backend):
+    try:
+        return _backends[backend]
+    except KeyError:
+        raise ValueError("{} is not a valid backend".format(backend))
+
+
+def get_clusters(wf, threshold=1, backend="automaton"):
+    """
+    Generator over clusters. Each cluster is the whole waveform array, with only 
+    the crystals in that cluster unmasked.
+
+    backend - "automaton" for label_automaton, "region" for region_grow
+    """
+    grow, _, views = get_backend(backend)
+    time_offset, trimmed_wf = make_time_island(wf)
+    clusters = grow(wf, threshold)
+    return views(wf, clusters)
+
+
+@instrument.instrumented()
 def make_time_island(wf, threshold=50, window=5):
     ts = np.sum(wf, axis=(0, 1))
     count = len(ts[ts > threshold])
@@ -139,23 +415,26 @@ def make_time_island(wf, threshold=50, window=5):
     return t_min, wf[:, :, t_min:t_max]
 
 
-def fit_waveform(wf, threshold=1.):
+def fit_waveform(wf, threshold=1., backend="automaton", kernels=None):
     """
     Fit the waveform. Currently just want to see if there are one or two
     clusters
+
+    backend - "automaton" for label_automaton, "region" for region_grow
+    kernels - "numba" or "numpy", see automaton_kernels
     """
 
+    grow, ids, _ = get_backend(backend)
     time_offset, trimmed_wf = make_time_island(wf)
-    clusters = automaton(trimmed_wf, threshold)
-    all_clusters = reduce(set.union, clusters[clusters != -1].ravel(), set())
-    if len(all_clusters) > 1:
+    clusters = grow(trimmed_wf, threshold, kernels=kernels)
+    if len(ids(clusters)) > 1:
         return ((None, None, None), (None, None, None))
     else:
         return ((None, None, None),)
 
 def test():
     import gm2_clustering
-    data = np.load("processed_wf/test_sim.npz")
+    data = gm2_clustering.dataset.load("processed_wf/test_sim.npz")
     p1, p2, wf = data['two'][0]
     c = get_clusters(wf)
     gm2_clustering.plot_waveform(c.next(), c.next())
@@ -167,7 +446,14 @@ if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("data_file", help="File in which waveforms are stored")
+    parser.add_argument("--backend", help="Clustering backend", choices=sorted(_backends),
+                        default="automaton")
+    parser.add_argument("--kernels", help="Kernel implementation", choices=automaton_kernels.backends,
+                        default=automaton_kernels.default)
 
     args = parser.parse_args()
 
-    gm2_clustering.algo_tests.one_vs_two(fit_waveform, args.data_file)
+    # compile once here, the workers are forked with the compiled kernels
+    automaton_kernels.warmup(args.kernels)
+    gm2_clustering.algo_tests.one_vs_two(partial(fit_waveform, backend=args.backend, kernels=args.kernels),
+                                         args.data_file)
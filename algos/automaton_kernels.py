@@ -0,0 +1,321 @@
+"""
+Inner loops of the automaton: seed finding, growing labels from cell to
+cell, counting the clusters of a labeling, and the priority flood of
+region_grow.
+
+Two implementations of each, with the same inputs and results:
+
+    "numba"  plain loops over integer and float arrays, compiled in numba's
+             nopython mode. Compiled code is cached on disk, so only the
+             first process to use a kernel compiles it.
+    "numpy"  vectorized NumPy, always available. The priority flood has no
+             vectorized form, so it runs the same loops over Python lists.
+
+The default is numba when it can be imported, numpy otherwise, or whatever
+the GM2_KERNELS environment variable names. Functions in automaton take a
+kernels keyword to pick one per call. Call warmup() before starting worker
+processes (or in each worker) so no event pays for the compilation, and
+check() to compare the two implementations on real events:
+
+    python -m algos.automaton_kernels data.events
+"""
+
+import heapq
+import os
+from collections import namedtuple
+
+import numpy as np
+import scipy.ndimage
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+backends = ("numba", "numpy")
+
+# local_maxima(wfs, threshold): (n*nx*ny*nt) bool, True for seeds
+# grow_offsets(labels, active, frontier, neighbours): grow labels in place
+#     over a flat grid, neighbours being the flat offsets. Returns the
+#     number of iterations
+# grow_table(labels, active, frontier, table): same, with the neighbours of
+#     cell c in table[c] and -1 for no neighbour
+# label_counts(labels, offsets): number of different labels in each
+#     labels[offsets[i]:offsets[i+1]]
+# priority_flood(values, free, regions, seeds, neighbours): grow the
+#     regions[seeds] over the free cells of a flat grid in place, always
+#     from the highest value reached so far. A cell joins the first region
+#     to reach it. free is scratch space, its contents are undefined after
+Kernels = namedtuple("Kernels", ["local_maxima", "grow_offsets", "grow_table", "label_counts",
+                                 "priority_flood"])
+
+
+def _local_maxima_numpy(wfs, threshold):
+    # "nearest" repeats the edge voxels, which can't change the maximum,
+    # so this matches clipping the neighbourhood at the edges
+    surrounding = scipy.ndimage.maximum_filter(wfs, size=(1, 3, 3, 3), mode="nearest")
+    return (wfs == surrounding) & (wfs > threshold)
+
+
+def _grow_numpy(labels, active, frontier, neighbours_of):
+    labeled = np.zeros(len(active), dtype=np.bool)
+    labeled[frontier] = True
+    n_iterations = 0
+    while len(frontier):
+        candidates = np.unique(neighbours_of(frontier))
+        candidates = candidates[active[candidates] & ~labeled[candidates]]
+        # everything is read before it is written, like the start_tags
+        # copy in automaton_iteration
+        labels[candidates] = np.bitwise_or.reduce(labels[neighbours_of(candidates)], axis=1)
+        labeled[candidates] = True
+        frontier = candidates
+        n_iterations += 1
+    return n_iterations
+
+
+def _grow_offsets_numpy(labels, active, frontier, neighbours):
+    return _grow_numpy(labels, active, frontier, lambda cells: cells[:, np.newaxis] + neighbours)
+
+
+def _grow_table_numpy(labels, active, frontier, table):
+    # -1 picks the last row, which callers keep empty and inactive
+    return _grow_numpy(labels, active, frontier, lambda cells: table[cells])
+
+
+def _label_counts_numpy(labels, offsets):
+    counts = np.zeros(len(offsets)-1, dtype=np.int64)
+    nonempty = np.flatnonzero(np.diff(offsets))
+    if len(nonempty) == 0:
+        return counts
+    present = np.bitwise_or.reduceat(labels, offsets[nonempty], axis=0)
+    counts[nonempty] = np.unpackbits(present.view(np.uint8), axis=1).sum(axis=1)
+    return counts
+
+
+def _priority_flood_numpy(values, free, regions, seeds, neighbours):
+    # python indexes lists much faster than arrays
+    regions_list = regions.tolist()
+    _priority_flood_loops(values.tolist(), free.tolist(), regions_list, seeds.tolist(), neighbours.tolist())
+    regions[:] = np.array(regions_list, dtype=regions.dtype)
+
+
+def _local_maxima_loops(wfs, threshold):
+    n, nx, ny, nt = wfs.shape
+    is_seed = np.zeros(wfs.shape, dtype=np.bool_)
+    for e in range(n):
+        for i in range(nx):
+            for j in range(ny):
+                for k in range(nt):
+                    value = wfs[e, i, j, k]
+                    if not value > threshold:
+                        continue
+                    seed = True
+                    for ii in range(max(i-1, 0), min(i+2, nx)):
+                        for jj in range(max(j-1, 0), min(j+2, ny)):
+                            for kk in range(max(k-1, 0), min(k+2, nt)):
+                                if wfs[e, ii, jj, kk] > value:
+                                    seed = False
+                    is_seed[e, i, j, k] = seed
+    return is_seed
+
+
+def _grow_offsets_loops(labels, active, frontier, neighbours):
+    n_cells, n_words = labels.shape
+    labeled = np.zeros(n_cells, dtype=np.bool_)
+    queued = np.zeros(n_cells, dtype=np.bool_)
+    candidates = np.empty(n_cells, dtype=np.int64)
+    for cell in frontier:
+        labeled[cell] = True
+    n_iterations = 0
+    while len(frontier):
+        n_candidates = 0
+        for cell in frontier:
+            for offset in neighbours:
+                neighbour = cell + offset
+                if active[neighbour] and not labeled[neighbour] and not queued[neighbour]:
+                    queued[neighbour] = True
+                    candidates[n_candidates] = neighbour
+                    n_candidates += 1
+        # read every candidate's neighbours before writing any of them
+        new_labels = np.zeros((n_candidates, n_words), dtype=np.uint64)
+        for icandidate in range(n_candidates):
+            cell = candidates[icandidate]
+            for offset in neighbours:
+                for iword in range(n_words):
+                    new_labels[icandidate, iword] |= labels[cell + offset, iword]
+        for icandidate in range(n_candidates):
+            cell = candidates[icandidate]
+            labels[cell, :] = new_labels[icandidate, :]
+            labeled[cell] = True
+            queued[cell] = False
+        frontier = candidates[:n_candidates].copy()
+        n_iterations += 1
+    return n_iterations
+
+
+def _grow_table_loops(labels, active, frontier, table):
+    n_cells, n_words = labels.shape
+    labeled = np.zeros(n_cells, dtype=np.bool_)
+    queued = np.zeros(n_cells, dtype=np.bool_)
+    candidates = np.empty(n_cells, dtype=np.int64)
+    for cell in frontier:
+        labeled[cell] = True
+    n_iterations = 0
+    while len(frontier):
+        n_candidates = 0
+        for cell in frontier:
+            for neighbour in table[cell]:
+                if neighbour >= 0 and active[neighbour] and not labeled[neighbour] and not queued[neighbour]:
+                    queued[neighbour] = True
+                    candidates[n_candidates] = neighbour
+                    n_candidates += 1
+        new_labels = np.zeros((n_candidates, n_words), dtype=np.uint64)
+        for icandidate in range(n_candidates):
+            for neighbour in table[candidates[icandidate]]:
+                if neighbour >= 0:
+                    for iword in range(n_words):
+                        new_labels[icandidate, iword] |= labels[neighbour, iword]
+        for icandidate in range(n_candidates):
+            cell = candidates[icandidate]
+            labels[cell, :] = new_labels[icandidate, :]
+            labeled[cell] = True
+            queued[cell] = False
+        frontier = candidates[:n_candidates].copy()
+        n_iterations += 1
+    return n_iterations
+
+
+def _label_counts_loops(labels, offsets):
+    n_words = labels.shape[1]
+    counts = np.zeros(len(offsets)-1, dtype=np.int64)
+    for i in range(len(offsets)-1):
+        for iword in range(n_words):
+            word = np.uint64(0)
+            for row in range(offsets[i], offsets[i+1]):
+                word |= labels[row, iword]
+            while word:
+                word &= word - np.uint64(1)
+                counts[i] += 1
+    return counts
+
+
+def _priority_flood_loops(values, free, regions, seeds, neighbours):
+    # (-value, cell) pops the highest value first, ties by lowest cell
+    queue = [(-values[cell], cell) for cell in seeds]
+    heapq.heapify(queue)
+    for cell in seeds:
+        free[cell] = False
+    while len(queue):
+        _, cell = heapq.heappop(queue)
+        region = regions[cell]
+        for offset in neighbours:
+            neighbour = cell + offset
+            if free[neighbour]:
+                free[neighbour] = False
+                regions[neighbour] = region
+                heapq.heappush(queue, (-values[neighbour], neighbour))
+
+
+_kernels = {
+    "numpy": Kernels(_local_maxima_numpy, _grow_offsets_numpy, _grow_table_numpy, _label_counts_numpy,
+                     _priority_flood_numpy),
+}
+if numba is not None:
+    _kernels["numba"] = Kernels(*[numba.njit(cache=True)(fcn)
+                                  for fcn in (_local_maxima_loops, _grow_offsets_loops,
+                                              _grow_table_loops, _label_counts_loops,
+                                              _priority_flood_loops)])
+
+default = os.environ.get("GM2_KERNELS") or ("numba" if numba is not None else "numpy")
+
+
+def get_kernels(kernels=None):
+    """The Kernels named kernels, or the default ones"""
+    if kernels is None:
+        kernels = default
+    if kernels not in backends:
+        raise ValueError("{} is not a valid kernels backend".format(kernels))
+    if kernels not in _kernels:
+        raise ValueError("{} kernels need numba, which can't be imported".format(kernels))
+    return _kernels[kernels]
+
+
+def warmup(kernels=None):
+    """
+    Compile (or load from the on-disk cache) the kernels for the array
+    types the automaton uses, including every waveform dtype of
+    gm2_clustering.dtypes. Nothing to do for numpy.
+    """
+    k = get_kernels(kernels)
+    labels = np.zeros((27, 1), dtype=np.uint64)
+    active = np.zeros(27, dtype=np.bool)
+    frontier = np.zeros(1, dtype=np.int64)
+    for dtype in (np.float64, np.float32, np.uint16):
+        k.local_maxima(np.zeros((1, 3, 3, 3), dtype=dtype), 0.)
+    k.grow_offsets(labels, active, frontier, np.zeros(27, dtype=np.int64))
+    k.grow_table(labels, active, frontier, np.full((27, 27), -1, dtype=np.int64))
+    k.label_counts(labels, np.array([0, 27], dtype=np.int64))
+    k.priority_flood(np.zeros(27), active, np.zeros(27, dtype=np.int32), frontier,
+                     np.zeros(27, dtype=np.int64))
+
+
+def check(wfs, threshold=1., seed_threshold=200., kernels=("numba", "numpy")):
+    """
+    Run the automaton on wfs with two sets of kernels and compare.
+
+    Returns:
+    list of the names of the kernels whose results differ, empty if they all
+    agree
+    """
+    import algos.automaton as ca
+    from gm2_clustering.sparse import SparseEvents
+
+    wfs = np.asarray(wfs)
+    if wfs.ndim == 3:
+        wfs = wfs[np.newaxis]
+    events = SparseEvents.from_dense(wfs, 0.)
+    results = []
+    for name in kernels:
+        k = get_kernels(name)
+        labels = [ca.label_automaton(wf, threshold, seed_threshold, kernels=name) for wf in wfs]
+        sparse_labels = ca.sparse_label_automaton(events, threshold, seed_threshold, kernels=name)
+        results.append({
+            "local_maxima": k.local_maxima(wfs, seed_threshold),
+            "grow_offsets": labels,
+            "grow_table": sparse_labels,
+            "label_counts": k.label_counts(sparse_labels, np.asarray(events.offsets, dtype=np.int64)),
+            "priority_flood": [ca.region_grow(wf, threshold, seed_threshold, kernels=name) for wf in wfs],
+        })
+
+    first, second = results
+    differ = []
+    for name in Kernels._fields:
+        a, b = first[name], second[name]
+        if isinstance(a, list):
+            same = len(a) == len(b) and all(np.array_equal(x, y) for x, y in zip(a, b))
+        else:
+            same = np.array_equal(a, b)
+        if not same:
+            differ.append(name)
+    return differ
+
+
+if __name__ == '__main__':
+    import argparse
+    import timeit
+    import gm2_clustering.dataset
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("data_file", help="File in which waveforms are stored")
+    parser.add_argument("-n", type=int, default=20, help="Events of each group to compare on")
+
+    args = parser.parse_args()
+
+    start = timeit.default_timer()
+    warmup("numba")
+    print "numba warmup: {:.2f} s".format(timeit.default_timer() - start)
+    with gm2_clustering.dataset.load(args.data_file) as data:
+        wfs = np.concatenate([np.asarray([event[-1] for event in data[group][:args.n]])
+                              for group in ('one', 'two')])
+    differ = check(wfs)
+    print "kernels differ: {}".format(", ".join(differ)) if differ else "kernels agree"
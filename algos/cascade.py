@@ -0,0 +1,125 @@
+"""
+Run the cheap algorithms first and only fit the events they can't decide.
+
+Tiers, in order:
+    e821        number of time samples above threshold, see e821.py
+    automaton   share of the energy in the second largest cluster, see
+                automaton.py
+    likelihood  one- and two-pulse fits on the time island, see likelihood.py
+
+Each of the first two tiers has a confidence band (one_max, two_min):
+scores at or below one_max mean one pulse, scores at or above two_min mean
+two, and anything in between goes on to the next tier.
+"""
+
+import numpy as np
+
+import algos.automaton as ca
+import algos.e821 as e821
+import algos.likelihood as likelihood
+
+tiers = ("e821", "automaton", "likelihood")
+
+
+class Result(tuple):
+    """
+    ((x0, y0, t0), ...) like any other fit_waveform, plus the tier that
+    decided it
+    """
+    def __new__(cls, clusters, tier):
+        result = tuple.__new__(cls, clusters)
+        result.tier = tier
+        return result
+
+    def __reduce__(self):
+        return Result, (tuple(self), self.tier)
+
+
+def _unknown(n):
+    return ((None, None, None),)*n
+
+
+def second_cluster_fraction(wf, threshold=1., backend="automaton"):
+    """
+    Fraction of the clustered energy in the second largest cluster of the
+    time island of wf. 0 if there is only one cluster.
+    """
+    grow, _, views = ca.get_backend(backend)
+    _, trimmed_wf = ca.make_time_island(wf)
+    energies = sorted((cluster.sum() for cluster in views(trimmed_wf, grow(trimmed_wf, threshold))),
+                      reverse=True)
+    if len(energies) < 2:
+        return 0.
+    return energies[1]/np.sum(energies)
+
+
+def fit_likelihood(wf, min_improvement=0.75):
+    """
+    Fit one and two pulses to the time island of wf. Call it two pulses if
+    the second pulse removes at least min_improvement of the one-pulse
+    chi-squared.
+
+    Returns:
+    ((x0, y0, t0), ...) fitted positions and times of the pulses
+    """
+    roi = likelihood.island_roi(wf)
+    one, chi2_one = likelihood.fit_one_pulse(*roi)
+    two, chi2_two = likelihood.fit_two_pulse(*roi)
+    if chi2_two <= (1.-min_improvement)*chi2_one:
+        return (tuple(two[:3]), tuple(two[6:9]))
+    return (tuple(one[:3]),)
+
+
+def fit_waveform(wf, e821_band=(5, 8), automaton_band=(0.05, 0.2), min_improvement=0.75,
+                 thresh_frac=0.3, threshold=1., backend="automaton"):
+    """
+    Decide between one and two pulses with the cheapest tier that is sure.
+
+    Parameters:
+        wf: waveform
+        e821_band: (one_max, two_min) for the number of samples above
+                   thresh_frac of the maximum
+        automaton_band: (one_max, two_min) for second_cluster_fraction
+        min_improvement: see fit_likelihood
+        thresh_frac: see e821.fit_waveform
+        threshold, backend: see automaton.fit_waveform
+
+    Returns:
+    Result, a tuple with one entry per pulse and the deciding tier as .tier
+    """
+    counts = e821.count_samples(wf, thresh_frac)
+    if counts <= e821_band[0]:
+        return Result(_unknown(1), "e821")
+    if counts >= e821_band[1]:
+        return Result(_unknown(2), "e821")
+
+    fraction = second_cluster_fraction(wf, threshold, backend)
+    if fraction <= automaton_band[0]:
+        return Result(_unknown(1), "automaton")
+    if fraction >= automaton_band[1]:
+        return Result(_unknown(2), "automaton")
+
+    return Result(fit_likelihood(wf, min_improvement), "likelihood")
+
+
+if __name__ == '__main__':
+    import gm2_clustering
+    from functools import partial
+
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("data_file", help="File in which waveforms are stored")
+    parser.add_argument("--e821_band", type=float, nargs=2, default=(5, 8),
+                        help="Sample counts at or below the first mean one pulse, at or above the second two")
+    parser.add_argument("--automaton_band", type=float, nargs=2, default=(0.05, 0.2),
+                        help="Second cluster energy fractions at or below the first mean one pulse, "
+                             "at or above the second two")
+    parser.add_argument("--min_improvement", type=float, default=0.75,
+                        help="Fraction of the one-pulse chi2 a second pulse must remove")
+
+    args = parser.parse_args()
+
+    gm2_clustering.algo_tests.one_vs_two(partial(fit_waveform, e821_band=args.e821_band,
+                                                 automaton_band=args.automaton_band,
+                                                 min_improvement=args.min_improvement),
+                                         args.data_file)
@@ -5,6 +5,37 @@ spatial information and counts the number if times samples above threshold
 
 import numpy as np
 
+from gm2_clustering.sparse import SparseEvents
+
+
+def time_sums(wf):
+    """
+    Spatial sum of wf, (nt). wf may also be an (n*nx*ny*nt) stack or
+    SparseEvents, giving (n*nt).
+    """
+    # ignore all spatial information
+    if isinstance(wf, SparseEvents):
+        return wf.time_sums()
+    return wf.sum(axis=(-3, -2))
+
+
+def samples_above(ts, thresh_frac=0.3):
+    """Number of samples of the time sums ts above thresh_frac of their maximum"""
+    # find a threhold
+    threshold = thresh_frac*ts.max(axis=-1)
+
+    # find the number of samples above the threshold
+    return np.sum(ts > threshold[..., np.newaxis], axis=-1)
+
+
+def count_samples(wf, thresh_frac=0.3):
+    """
+    Number of time samples in the spatial sum of wf above thresh_frac of
+    its maximum. wf may also be an (n*nx*ny*nt) stack or SparseEvents,
+    giving n counts.
+    """
+    return samples_above(time_sums(wf), thresh_frac)
+
 
 def fit_waveform(wf, thresh_frac=0.3, count_limit=6):
     """
@@ -21,20 +52,25 @@ def fit_waveform(wf, thresh_frac=0.3, count_limit=6):
                         Each tuple gives the centroid of the cluster in x, y, and time.
     """
 
-    # ignore all spatial information
-    ts = wf.sum(axis=(0, 1))
-
-    # find a threhold
-    threshold = thresh_frac*ts.max()
-
-    # find the number of samples above the threshold
-    counts = np.count_nonzero(ts > threshold)
+    counts = count_samples(wf, thresh_frac)
 
     if counts > count_limit:
         return ((None, None, None), (None, None, None))
     else:
         return ((None, None, None), )
 
+
+def fit_batch(wfs, thresh_frac=0.3, count_limit=6):
+    """
+    fit_waveform for an (n*nx*ny*nt) stack of waveforms.
+
+    Returns:
+    (n,) number of clusters found in each waveform
+    """
+    return np.where(count_samples(wfs, thresh_frac) > count_limit, 2, 1)
+
+fit_waveform.batch = fit_batch
+
 if __name__ == '__main__':
     import gm2_clustering
 
@@ -8,19 +8,83 @@ import scipy.stats
 import scipy.optimize
 
 import algos.automaton as ca
+import gm2_clustering.dataset
+import gm2_clustering.fit_cache as fit_cache
+import gm2_clustering.instrument as instrument
+import gm2_clustering.utils as utils
 
 
-def make_coords():
+_axes_cache = {}
+
+
+def make_axes(shape):
+    """
+    1-d x, y, and t coordinates of a waveform grid of the given shape, in
+    the same units as utils.make_coords: crystals, and 2 ns per sample.
+    Built once per shape and reused.
     """
-    Generate the coordinates for the waveform.
-    returns a list of numpy arrays (x,y,t), giving
-    the x, y, and t positions at each grid point.
+    try:
+        return _axes_cache[shape]
+    except KeyError:
+        nx, ny, nt = shape
+        axes = (np.arange(nx, dtype=np.float64), np.arange(ny, dtype=np.float64),
+                2.*np.arange(nt, dtype=np.float64))
+        for axis in axes:
+            axis.flags.writeable = False
+        _axes_cache[shape] = axes
+        return axes
+
+
+def pulse_factors(params, shape):
+    """
+    The model is separable: an x profile times a y profile times a time
+    profile. So are its derivatives with respect to each parameter.
+
+    Parameters:
+        params: (x0, y0, t0, amplitude, xwidth, ywidth). Each may be an
+                array, to evaluate many pulses at once
+        shape: shape of the waveform grid
+
+    Returns:
+    (fx, fy, ft) (...*7*nx), (...*7*ny) and (...*7*nt) arrays, with leading
+                 dimensions matching the parameters. Row 0 gives the model,
+                 model = fx[0] x fy[0] x ft[0] (outer product), and row p+1
+                 the derivative with respect to parameter p of
+                 (x0, y0, t0, amplitude, xwidth, ywidth).
     """
-    return np.meshgrid(np.arange(0, 7, 1), np.arange(0, 5, 1),
-                       np.linspace(0, 100, 50))
+    x0, y0, t0, amplitude, xwidth, ywidth = [np.asarray(p, dtype=np.float64)[..., np.newaxis]
+                                             for p in params]
+    x, y, t = make_axes(tuple(shape))
+
+    dx = x - x0
+    gx = scipy.stats.norm.pdf(x, loc=x0, scale=xwidth)
+    dgx_dx0 = gx*dx/xwidth**2
+    dgx_dxwidth = gx*(dx**2/xwidth**3 - 1./xwidth)
+
+    dy = y - y0
+    gy = scipy.stats.norm.pdf(y, loc=y0, scale=ywidth)
+    dgy_dy0 = gy*dy/ywidth**2
+    dgy_dywidth = gy*(dy**2/ywidth**3 - 1./ywidth)
+
+    # gamma(1.4) pulse shape in u = (t - t0)/5, zero before t0
+    u = (t - t0)/5.
+    gt = scipy.stats.gamma.pdf(t, 1.4, loc=t0, scale=5.)
+    after = u > 0
+    dgt_dt0 = np.where(after, gt*(1. - 0.4/np.where(after, u, 1.))/5., 0.)
+
+    agt = amplitude*gt
+    fx = np.stack([gx, dgx_dx0, gx, gx, gx, dgx_dxwidth, gx], axis=-2)
+    fy = np.stack([gy, gy, dgy_dy0, gy, gy, gy, dgy_dywidth], axis=-2)
+    ft = np.stack([agt, agt, agt, amplitude*dgt_dt0, gt, agt, agt], axis=-2)
+    return fx, fy, ft
+
 
+def _outer(fx, fy, ft):
+    """Outer products of matching rows, as an (n*nx*ny*nt) array"""
+    return fx[:, :, np.newaxis, np.newaxis]*fy[:, np.newaxis, :, np.newaxis]*ft[:, np.newaxis, np.newaxis, :]
 
-def gaussian_beta(x0, y0, t0, amplitude, xwidth, ywidth):
+
+def gaussian_beta(x0, y0, t0, amplitude, xwidth, ywidth, shape=utils.WF_SHAPE):
     """
     Generate a waveform using a gaussian for the spatial distribution
     and a beta function for the pulse shape.
@@ -32,116 +96,420 @@ def gaussian_beta(x0, y0, t0, amplitude, xwidth, ywidth):
         amplitude: height of the shower
         xwidth, ywidth: size of the shower and x and y directions
                         No angled showers for now.
+        shape: shape of the waveform grid
+    """
+
+    fx, fy, ft = pulse_factors((x0, y0, t0, amplitude, xwidth, ywidth), shape)
+    return _outer(fx[:1], fy[:1], ft[:1])[0]
+
+
+def gaussian_beta_jacobian(params, shape=utils.WF_SHAPE):
     """
+    Analytic derivatives of gaussian_beta.
 
-    x, y, t = make_coords()
+    Returns:
+    (nx*ny*nt) x 6 array, the derivative of each (flattened) grid point
+    with respect to each of the 6 parameters
+    """
+    fx, fy, ft = pulse_factors(params, shape)
+    return _outer(fx[1:], fy[1:], ft[1:]).reshape(6, -1).T
 
-    wf = scipy.stats.gamma.pdf(t, 1.4, loc=t0, scale=5.)
-    wf *= amplitude
-    wf *= scipy.stats.norm.pdf(x, loc=x0, scale=xwidth)
-    wf *= scipy.stats.norm.pdf(y, loc=y0, scale=ywidth)
 
-    return wf
+def _fit_data(wf):
+    """Values to fit. Masked entries count as zero, as they always have"""
+    return np.asarray(ma.filled(wf, 0.), dtype=np.float64)
 
 
 def chi2_one_pulse(wf, pulse_one_params):
     """Calculate the chi-squared for the one-pulse hypothesis"""
 
-    fitted = gaussian_beta(*pulse_one_params)
+    fitted = gaussian_beta(*pulse_one_params, shape=wf.shape)
     return np.sum((fitted-wf)**2)
 
 
 def chi2_two_pulse(wf, pulse_one_params, pulse_two_params):
     """Calculate the chi-squared for the one-pulse hypothesis"""
 
-    fitted = gaussian_beta(*pulse_one_params) + gaussian_beta(*pulse_two_params)
+    fitted = gaussian_beta(*pulse_one_params, shape=wf.shape) + \
+        gaussian_beta(*pulse_two_params, shape=wf.shape)
     return np.sum((fitted-wf)**2)
 
 
-def profile_chi2_one_pulse(wf):
+def all_voxels(shape):
+    """Index arrays (ix, iy, it) of every voxel of a grid"""
+    return tuple(np.indices(shape).reshape(len(shape), -1))
+
+
+def cluster_voxels(wf):
     """
-    Minimize chi-squared over the free parameters to get the
-    "profile" chi2
+    Index arrays (ix, iy, it) of the voxels of a cluster, i.e. the unmasked
+    entries of a masked waveform from automaton.get_clusters. Every voxel
+    for an ordinary array.
     """
-    def func_to_minimize(args):
-        fitted = gaussian_beta(*args)
-        return (fitted-wf).ravel()
+    return np.nonzero(~ma.getmaskarray(wf))
 
-    # initial guesses
-    # just pick the maximum
-    yinit, xinit, tinit = np.unravel_index(np.argmax(wf), wf.shape)
-    Ainit = np.sum(wf)*3
-    xwinit, ywinit = 1, 1
 
-    result, _, info, mesg, ier = scipy.optimize.leastsq(func_to_minimize,
-                                                        x0=(xinit, yinit, tinit, Ainit, xwinit, ywinit),
-                                                        full_output=1
-                                                        )
-    return chi2_one_pulse(wf, result)/wf[-wf.mask].shape[0]
+def island_roi(wf, threshold=50, window=5):
+    """
+    Region of interest for a fit: the time island of wf found by
+    automaton.make_time_island, and within it the unmasked voxels.
+
+    Returns:
+    (trimmed_wf, voxels, time_offset) pass all three on to the fit
+    """
+    time_offset, trimmed_wf = ca.make_time_island(wf, threshold, window)
+    return trimmed_wf, cluster_voxels(trimmed_wf), time_offset
 
 
-def profile_chi2_two_pulse(wf):
+def voxel_factors(params, voxels, shape, time_offset=0):
     """
-    Minimize chi-squared over the free parameters to get the
-    "profile" chi2
+    The model and its derivatives at a list of voxels only.
+
+    Parameters:
+        params: (x0, y0, t0, amplitude, xwidth, ywidth)
+        voxels: index arrays (ix, iy, it) into a waveform of the given shape
+        time_offset: sample of the full waveform that it=0 corresponds to,
+                     so t0 is in the time of the full waveform
+
+    Returns:
+    7 x n_voxels array. Row 0 is the model, the rest its derivatives, see
+    pulse_factors
     """
+    ix, iy, it = voxels
+    fx, fy, ft = pulse_factors(params, (shape[0], shape[1], shape[2]+time_offset))
+    return fx[:, ix]*fy[:, iy]*ft[:, it+time_offset]
+
 
+def _fit_setup(wf, voxels, time_offset):
+    """
+    Voxels and values to fit, and the voxels to compute chi2 on. By default
+    every voxel is fitted, with masked ones as zeros, but chi2 only counts
+    the unmasked ones.
+    """
+    if voxels is None:
+        fit_voxels, chi2_voxels = all_voxels(wf.shape), cluster_voxels(wf)
+    else:
+        fit_voxels = chi2_voxels = tuple(np.asarray(v) for v in voxels)
+    values = _fit_data(wf)[fit_voxels]
+    t = make_axes((wf.shape[0], wf.shape[1], wf.shape[2]+time_offset))[2]
+    return fit_voxels, values, chi2_voxels, t
+
+
+def _chi2(wf, params, voxels, time_offset):
+    """Sum of squared residuals over voxels, for one or more pulses"""
     n_args = 6
+    fitted = sum(voxel_factors(params[i:i+n_args], voxels, wf.shape, time_offset)[0]
+                 for i in xrange(0, len(params), n_args))
+    return np.sum((fitted - _fit_data(wf)[voxels])**2)
+
+
+@fit_cache.memoize()
+@instrument.instrumented()
+def fit_one_pulse(wf, voxels=None, time_offset=0, p0=None):
+    """
+    Least-squares fit of a single pulse.
+
+    Parameters:
+        wf: waveform or masked cluster
+        voxels: index arrays (ix, iy, it) to restrict the fit to, e.g. from
+                island_roi or cluster_voxels. Default is the whole grid.
+        time_offset: start of wf in samples of the full waveform, see
+                     island_roi. The fitted t0 is in full waveform time.
+        p0: starting parameters, e.g. from matched_filter.TemplateBank.
+            Default is a guess from the largest sample.
+
+    Results are kept in the fit cache when it is on, see gm2_clustering.fit_cache.
+
+    Returns:
+    (params, chi2) fitted (x0, y0, t0, amplitude, xwidth, ywidth) and the
+                   chi-squared over the fitted (unmasked) voxels
+    """
+    voxels, values, chi2_voxels, t = _fit_setup(wf, voxels, time_offset)
 
     def func_to_minimize(args):
-        fitted = gaussian_beta(*args[:n_args])+gaussian_beta(*args[n_args:])
-        return (fitted-wf).ravel()
+        return voxel_factors(args, voxels, wf.shape, time_offset)[0] - values
+
+    def jacobian(args):
+        return voxel_factors(args, voxels, wf.shape, time_offset)[1:].T
+
+    if p0 is None:
+        # initial guesses
+        # just pick the maximum
+        imax = np.argmax(values)
+        xinit, yinit, tinit = voxels[0][imax], voxels[1][imax], t[voxels[2][imax]+time_offset]
+        Ainit = np.sum(values)*3
+        xwinit, ywinit = 1, 1
+        p0 = (xinit, yinit, tinit, Ainit, xwinit, ywinit)
 
-    # initial guesses
-    # just pick the maximum
-    yinit, xinit, tinit = np.unravel_index(np.argmax(wf), wf.shape)
-    Ainit, xwinit, ywinit = 1000, 1, 1
+    result, _, info, mesg, ier = scipy.optimize.leastsq(func_to_minimize,
+                                                        x0=p0,
+                                                        Dfun=jacobian,
+                                                        full_output=1
+                                                        )
+    instrument.count("fit_one_pulse.nfev", info['nfev'])
+    return result, _chi2(wf, result, chi2_voxels, time_offset)
 
-    # mask the region around that maximum to get the second waveform guesses
-    m = wf.view(ma.MaskedArray)
 
-    def or_zero(x):
-        if x < 0:
-            return 0
-        return x
+@fit_cache.memoize()
+@instrument.instrumented()
+def fit_two_pulse(wf, voxels=None, time_offset=0, p0=None):
+    """
+    Least-squares fit of two pulses. Same inputs as fit_one_pulse.
 
-    m[or_zero(yinit-1):(yinit+2), or_zero(xinit-1):(xinit+2), or_zero(tinit-4):(tinit+5)] = ma.masked
-    y2init, x2init, t2init = np.unravel_index(np.argmax(m), m.shape)
-    A2init, xw2init, yw2init = 1000, 1, 1
+    Returns:
+    (params, chi2) fitted parameters, 6 for each pulse, and the chi-squared
+    """
+
+    n_args = 6
+    voxels, values, chi2_voxels, t = _fit_setup(wf, voxels, time_offset)
+
+    def func_to_minimize(args):
+        return voxel_factors(args[:n_args], voxels, wf.shape, time_offset)[0] + \
+            voxel_factors(args[n_args:], voxels, wf.shape, time_offset)[0] - values
+
+    def jacobian(args):
+        return np.vstack((voxel_factors(args[:n_args], voxels, wf.shape, time_offset)[1:],
+                          voxel_factors(args[n_args:], voxels, wf.shape, time_offset)[1:])).T
+
+    if p0 is None:
+        # initial guesses
+        # just pick the maximum
+        ix, iy, it = voxels
+        imax = np.argmax(values)
+        xinit, yinit, tinit = ix[imax], iy[imax], it[imax]
+        Ainit, xwinit, ywinit = 1000, 1, 1
+
+        # leave out the region around that maximum to get the second waveform guesses
+        near = (np.abs(ix - xinit) <= 1) & (np.abs(iy - yinit) <= 1) & \
+            (it - tinit >= -4) & (it - tinit <= 4)
+        imax2 = np.argmax(np.where(near, -np.inf, values))
+        x2init, y2init, t2init = ix[imax2], iy[imax2], it[imax2]
+        A2init, xw2init, yw2init = 1000, 1, 1
+        p0 = (xinit, yinit, t[tinit+time_offset], Ainit, xwinit, ywinit,
+              x2init, y2init, t[t2init+time_offset], A2init, xw2init, yw2init)
 
     result, _, info, mesg, ier = scipy.optimize.leastsq(func_to_minimize,
-                                                        x0=(xinit, yinit, tinit, Ainit, xwinit, ywinit,
-                                                            x2init, y2init, t2init, A2init, xw2init, yw2init),
+                                                        x0=p0,
+                                                        Dfun=jacobian,
                                                         full_output=1,
                                                         maxfev = 50000
                                                         )
     if ier not in range(1, 5):
         print mesg
-    # print ier, chi2_two_pulse(wf, result[:n_args], result[n_args:])
+    instrument.count("fit_two_pulse.nfev", info['nfev'])
+
+    return result, _chi2(wf, result, chi2_voxels, time_offset)
+
+
+def profile_chi2_one_pulse(wf, voxels=None, time_offset=0):
+    """
+    Minimize chi-squared over the free parameters to get the
+    "profile" chi2, per fitted voxel. See fit_one_pulse
+    """
+    _, chi2 = fit_one_pulse(wf, voxels, time_offset)
+    n = ma.count(wf) if voxels is None else len(voxels[0])
+    return chi2/n
+
+
+def profile_chi2_two_pulse(wf, voxels=None, time_offset=0):
+    """
+    Minimize chi-squared over the free parameters to get the
+    "profile" chi2. See fit_two_pulse
+    """
+    _, chi2 = fit_two_pulse(wf, voxels, time_offset)
+    return chi2
+
+
+def batch_initial_guess(wfs, n_pulses=1):
+    """
+    Vectorized version of the initial guesses of fit_one_pulse and
+    fit_two_pulse, for an (n*nx*ny*nt) stack.
+
+    Returns:
+    (n*6) or (n*12) array of starting parameters
+    """
+    n = len(wfs)
+    shape = wfs.shape[1:]
+    t = make_axes(shape)[2]
+    flat = wfs.reshape(n, -1)
+
+    imax = np.argmax(flat, axis=1)
+    xinit, yinit, tinit = np.unravel_index(imax, shape)
+    guess = [xinit, yinit, t[tinit], flat.sum(axis=1)*3, np.ones(n), np.ones(n)]
+    if n_pulses == 1:
+        return np.column_stack(guess)
+
+    # same starting amplitude as fit_two_pulse
+    guess[3] = np.full(n, 1000.)
+
+    # leave out the region around the maximum to get the second pulse
+    ix, iy, it = [i.ravel() for i in np.indices(shape)]
+    near = (np.abs(ix - xinit[:, np.newaxis]) <= 1) & (np.abs(iy - yinit[:, np.newaxis]) <= 1) & \
+        (it - tinit[:, np.newaxis] >= -4) & (it - tinit[:, np.newaxis] <= 4)
+    imax2 = np.argmax(np.where(near, -np.inf, flat), axis=1)
+    x2init, y2init, t2init = np.unravel_index(imax2, shape)
+    guess += [x2init, y2init, t[t2init], np.full(n, 1000.), np.ones(n), np.ones(n)]
+    return np.column_stack(guess)
+
+
+def _batch_residuals(params, data):
+    """
+    Residuals and Jacobian factors for a batch of events.
+
+    Returns:
+    (residuals, (fx, fy, ft)) residuals is shaped like data. The factors are
+                              (n*n_params*nx) etc: column p of event i's
+                              Jacobian is fx[i, p] x fy[i, p] x ft[i, p]
+    """
+    n_args = 6
+    n = len(data)
+    fx, fy, ft = pulse_factors(params.reshape(n, -1, n_args).transpose(2, 0, 1), data.shape[1:])
+    # fx is (n*n_pulses*7*nx). Sum the models of the pulses
+    model = np.einsum('nki,nkj,nkl->nijl', fx[:, :, 0], fy[:, :, 0], ft[:, :, 0])
+    factors = [f[:, :, 1:].reshape(n, -1, f.shape[-1]) for f in (fx, fy, ft)]
+    return model - data, factors
+
+
+def _batch_chi2(params, data):
+    residuals, _ = _batch_residuals(params, data)
+    return np.sum(residuals.reshape(len(data), -1)**2, axis=1)
+
+
+@instrument.instrumented()
+def batch_fit(wfs, p0, max_iter=200, ftol=1.49012e-8, damping=1e-3):
+    """
+    Levenberg-Marquardt fit of the one- or two-pulse model to many events
+    at once.
+
+    Every column of the Jacobian is an outer product of 1-d profiles (see
+    pulse_factors), so J^T J is a product of three small Gram matrices and
+    never needs the full Jacobian. Each event has its own damping, and
+    events drop out of the batch once they converge.
+
+    Parameters:
+        wfs: (n*nx*ny*nt) stack of waveforms
+        p0: (n*6) or (n*12) starting parameters, see batch_initial_guess
+        max_iter: maximum number of iterations
+        ftol: an event has converged when an accepted step lowers chi2 by
+              less than this fraction, like leastsq, or when even the
+              undamped Gauss-Newton step is predicted to (so events that
+              start at their minimum converge too)
+        damping: starting Marquardt damping
+
+    Returns:
+    (params, chi2, converged) per-event fitted parameters, chi-squared over
+                              the whole grid and convergence flags
+    """
+    data = np.asarray(wfs, dtype=np.float64)
+    params = np.array(p0, dtype=np.float64)
+    n, n_params = params.shape
+
+    chi2 = _batch_chi2(params, data)
+    lam = np.full(n, damping)
+    converged = np.zeros(n, dtype=np.bool)
+    active = np.arange(n)
+
+    for _ in xrange(max_iter):
+        if not len(active):
+            break
+        instrument.count("batch_fit.active", len(active))
+        residuals, (fx, fy, ft) = _batch_residuals(params[active], data[active])
+
+        jtj = np.einsum('npi,nqi->npq', fx, fx)*np.einsum('npi,nqi->npq', fy, fy) * \
+            np.einsum('npi,nqi->npq', ft, ft)
+        jtr = np.einsum('npij,npi,npj->np', np.einsum('nijl,npl->npij', residuals, ft), fx, fy)
+
+        diag = np.diagonal(jtj, axis1=1, axis2=2)
+        diag = np.maximum(diag, 1e-12*diag.max(axis=1, keepdims=True) + np.finfo(np.float64).tiny)
+        lhs = jtj + (lam[active, np.newaxis]*diag)[:, :, np.newaxis]*np.eye(n_params)
+        step = np.linalg.solve(lhs, -jtr[:, :, np.newaxis])[:, :, 0]
+        # chi2 reduction the linearized model gives at its minimum, jtr^T jtj^-1 jtr
+        gn_lhs = jtj + (1e-10*diag)[:, :, np.newaxis]*np.eye(n_params)
+        predicted = np.sum(jtr*np.linalg.solve(gn_lhs, jtr[:, :, np.newaxis])[:, :, 0], axis=1)
+
+        trial = params[active] + step
+        with np.errstate(invalid="ignore"):
+            trial_chi2 = _batch_chi2(trial, data[active])
+            accept = trial_chi2 < chi2[active]  # False for nan, e.g. negative widths
+            done = (accept & (chi2[active] - trial_chi2 <= ftol*chi2[active])) | \
+                (predicted <= ftol*chi2[active])
+
+        better = active[accept]
+        params[better] = trial[accept]
+        chi2[better] = trial_chi2[accept]
+        lam[better] /= 10.
+        lam[active[~accept]] *= 10.
+
+        converged[active[done]] = True
+        # stop on convergence, or when no step size helps any more
+        active = active[~done & (lam[active] < 1e16)]
+
+    return params, chi2, converged
+
+
+def batch_fit_one_pulse(wfs, p0=None, **kwargs):
+    """batch_fit of one pulse, starting from batch_initial_guess by default"""
+    if p0 is None:
+        p0 = batch_initial_guess(wfs, 1)
+    return batch_fit(wfs, p0, **kwargs)
+
+
+def batch_fit_two_pulse(wfs, p0=None, **kwargs):
+    """batch_fit of two pulses, starting from batch_initial_guess by default"""
+    if p0 is None:
+        p0 = batch_initial_guess(wfs, 2)
+    return batch_fit(wfs, p0, **kwargs)
+
+
+def get_llr_batch(wfs, chunk_size=256, bank=None):
+    """
+    get_llr for every waveform in an (n*nx*ny*nt) stack, chunk_size events
+    at a time. If a matched_filter.TemplateBank is given, the fits start
+    from its best matches.
+    """
+    llrs = np.empty(len(wfs))
+    n_voxels = np.prod(wfs.shape[1:])
+    for start in xrange(0, len(wfs), chunk_size):
+        chunk = np.asarray(wfs[start:start+chunk_size], dtype=np.float64)
+        p0_one = p0_two = None
+        if bank is not None:
+            p0_one, _ = bank.match_one(chunk)
+            p0_two, _ = bank.match_two(chunk)
+        _, chi2_one, _ = batch_fit_one_pulse(chunk, p0_one)
+        _, chi2_two, _ = batch_fit_two_pulse(chunk, p0_two)
+        llrs[start:start+chunk_size] = chi2_one/n_voxels - chi2_two
+    return llrs
+
+
+def get_llr(wf, voxels=None, time_offset=0):
+    return profile_chi2_one_pulse(wf, voxels, time_offset) - \
+        profile_chi2_two_pulse(wf, voxels, time_offset)
 
-    return chi2_two_pulse(wf, result[:n_args], result[n_args:])
 
-def get_llr(wf):
-    return profile_chi2_one_pulse(wf)-profile_chi2_two_pulse(wf)
+def get_roi_llr(wf):
+    """get_llr, fitting only the time island of wf (and the cluster, if it is masked)"""
+    return get_llr(*island_roi(wf))
 
 
-def get_one_pulse_llr_dist(filename, n):
+def get_one_pulse_llr_dist(filename, n, roi=False):
+    llr_func = get_roi_llr if roi else get_llr
     llrs = []
-    with np.load(filename) as data:
+    with gm2_clustering.dataset.load(filename) as data:
         for datum in data['one'][:n]:
             params, wf = datum
             cluster = ca.get_clusters(wf, 1.).next()
-            llr = get_llr(cluster)
+            llr = llr_func(cluster)
             llrs.append(llr)
 
     return llrs
 
-def get_two_pulse_llr_dist(filename, n):
+def get_two_pulse_llr_dist(filename, n, roi=False):
+    llr_func = get_roi_llr if roi else get_llr
     llrs = []
-    with np.load(filename) as data:
+    with gm2_clustering.dataset.load(filename) as data:
         for datum in data['two'][:n]:
             _,_, wf = datum
-            llr = get_llr(wf)
+            llr = llr_func(wf)
             llrs.append(llr)
 
     return llrs
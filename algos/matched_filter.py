@@ -0,0 +1,285 @@
+"""
+Matched-filter estimates of pulse positions, times and amplitudes.
+
+A template bank holds spatial shower shapes on a grid of positions (and,
+for gaussian showers, widths) and a single pulse shape in time. A pulse
+starting at any sample is the pulse shape shifted in time, so each spatial
+template is correlated against every start time at once with an FFT.
+
+The best matches are a cheap estimate on their own, and make good
+starting points for the likelihood fits (see likelihood.batch_fit).
+"""
+
+import json
+import os
+import numpy as np
+import numpy.ma as ma
+import scipy.stats
+
+import gm2_clustering.utils as utils
+
+
+class TemplateBank(object):
+    """
+    Spatial templates times one pulse shape.
+
+    Parameters:
+        spatial: (k*nx*ny) spatial shower shapes
+        params: (k*4) (x0, y0, xwidth, ywidth) of each spatial template
+        pulse: (nt,) pulse shape of a shower starting at t0 = 0
+
+    A template scaled by A and started s samples later is the
+    gaussian_beta model with parameters (x0, y0, 2*s, A, xwidth, ywidth).
+
+    build_args holds the arguments of gaussian for a bank made by it (and
+    is saved with it), None for any other bank.
+    """
+    # smallest fraction of the pulse (by squared norm) a template may keep
+    # inside the waveform
+    min_fraction = 0.01
+
+    def __init__(self, spatial, params, pulse):
+        self.spatial = np.asarray(spatial, dtype=np.float64)
+        self.params = np.asarray(params, dtype=np.float64)
+        self.pulse = np.asarray(pulse, dtype=np.float64)
+        if len(self.spatial) != len(self.params):
+            raise ValueError("Got {} spatial templates for {} parameter sets".format(
+                len(self.spatial), len(self.params)))
+        self.spatial_norm2 = np.sum(self.spatial**2, axis=(1, 2))
+        self.build_args = None
+
+    def __len__(self):
+        return len(self.spatial)
+
+    @property
+    def shape(self):
+        return self.spatial.shape[1:] + self.pulse.shape
+
+    @staticmethod
+    def gaussian_args(xs=None, ys=None, widths=(0.6, 1., 1.5), shape=utils.WF_SHAPE):
+        """Arguments of gaussian with the defaults filled in, as json-compatible lists"""
+        nx, ny, nt = shape
+        if xs is None:
+            xs = np.linspace(0, nx-1, 2*nx-1)
+        if ys is None:
+            ys = np.linspace(0, ny-1, 2*ny-1)
+        return {"xs": [float(x) for x in xs], "ys": [float(y) for y in ys],
+                "widths": [float(w) for w in widths], "shape": [int(n) for n in shape]}
+
+    @classmethod
+    def gaussian(cls, xs=None, ys=None, widths=(0.6, 1., 1.5), shape=utils.WF_SHAPE):
+        """
+        Bank of the gaussian_beta model, see waveforms.GaussianBetaWaveform.
+        Default positions are every half crystal.
+        """
+        args = cls.gaussian_args(xs, ys, widths, shape)
+        nx, ny, nt = args["shape"]
+        x0, y0, width = [p.ravel() for p in np.meshgrid(args["xs"], args["ys"], args["widths"],
+                                                        indexing='ij')]
+
+        gx = scipy.stats.norm.pdf(np.arange(nx), loc=x0[:, np.newaxis], scale=width[:, np.newaxis])
+        gy = scipy.stats.norm.pdf(np.arange(ny), loc=y0[:, np.newaxis], scale=width[:, np.newaxis])
+        spatial = gx[:, :, np.newaxis]*gy[:, np.newaxis, :]
+        pulse = scipy.stats.gamma.pdf(2.*np.arange(nt), 1.4, loc=0., scale=5.)
+        bank = cls(spatial, np.column_stack((x0, y0, width, width)), pulse)
+        bank.build_args = args
+        return bank
+
+    @classmethod
+    def from_library(cls, wf_filename, xs=None, ys=None, n=1000):
+        """
+        Bank made from the mean of the first n showers in a shower library,
+        moved to each grid position like waveforms.SimulatedWaveform does.
+        The showers aren't gaussian, so the widths are left at 1.
+        """
+        import gm2_clustering.wf_generator.waveforms as waveforms
+
+        library = utils.load_waveform_file(wf_filename)[:n].swapaxes(1, 2)
+        mean_shower = library.mean(axis=0)
+        nx, ny, nt = mean_shower.shape
+        if xs is None:
+            xs = np.linspace(0, nx-1, 2*nx-1)
+        if ys is None:
+            ys = np.linspace(0, ny-1, 2*ny-1)
+        x0, y0 = [p.ravel() for p in np.meshgrid(xs, ys, indexing='ij')]
+
+        placed = waveforms.ShowerPlacer().place(np.broadcast_to(mean_shower, (len(x0),) + mean_shower.shape),
+                                                x0, y0, 0., 1.)
+        # split each placed shower into its spatial and time shapes
+        pulse = placed.sum(axis=(0, 1, 2))
+        total = pulse.sum()
+        if total <= 0:
+            raise ValueError("{} has no signal to make templates from".format(wf_filename))
+        pulse /= total
+        spatial = placed.sum(axis=3)
+        return cls(spatial, np.column_stack((x0, y0, np.ones_like(x0), np.ones_like(x0))), pulse)
+
+    def save(self, filename):
+        arrays = {"spatial": self.spatial, "params": self.params, "pulse": self.pulse}
+        if self.build_args is not None:
+            arrays["build_args"] = json.dumps(self.build_args, sort_keys=True)
+        np.savez(filename, **arrays)
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as data:
+            bank = cls(data['spatial'], data['params'], data['pulse'])
+            if 'build_args' in data.files:
+                bank.build_args = json.loads(str(data['build_args']))
+        return bank
+
+    def correlate(self, wfs):
+        """
+        Correlation of each waveform with every template at every start time.
+
+        Parameters:
+            wfs: (n*nx*ny*nt) stack of waveforms. Masked entries count as zero.
+                 nt may be shorter than the bank's pulse.
+
+        Returns:
+        (corr, norm2) (n*k*nt) correlations, and the (k*nt) squared norms of
+                      the templates, which lose their tail at late start
+                      times. norm2 is inf where too little of the pulse is left.
+        """
+        data = np.asarray(ma.filled(wfs, 0.), dtype=np.float64)
+        nt = data.shape[-1]
+        pulse = self.pulse[:nt]
+
+        # transform each crystal (fewer than templates), project onto the
+        # spatial templates in frequency space, then correlate in time
+        n_fft = 2*nt
+        spectra = np.fft.rfft(data, n_fft)
+        projected = np.tensordot(spectra, self.spatial, axes=([1, 2], [1, 2])).transpose(0, 2, 1)
+        corr = np.fft.irfft(projected*np.conj(np.fft.rfft(pulse, n_fft)), n_fft)[..., :nt]
+
+        # templates that start so late that almost all of the pulse is cut
+        # off match noise, so leave them out
+        pulse_norm2 = np.cumsum(pulse**2)[::-1]
+        pulse_norm2[pulse_norm2 < self.min_fraction*np.sum(self.pulse**2)] = np.inf
+        return corr, self.spatial_norm2[:, np.newaxis]*pulse_norm2
+
+    def _best(self, corr, norm2):
+        """Index, amplitude and chi2 reduction of the best positive match per waveform"""
+        n = len(corr)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            gain = np.where(corr > 0, corr**2/norm2, 0.).reshape(n, -1)
+        ibest = np.argmax(gain, axis=1)
+        itemplate, shift = np.unravel_index(ibest, norm2.shape)
+        amplitude = corr.reshape(n, -1)[np.arange(n), ibest]/norm2[itemplate, shift]
+        return itemplate, shift, amplitude, gain[np.arange(n), ibest]
+
+    def waveforms(self, itemplate, shift, amplitude, nt=None):
+        """(n*nx*ny*nt) templates with the given indices, start samples and amplitudes"""
+        nt = len(self.pulse) if nt is None else nt
+        shift = np.asarray(shift)
+        times = np.arange(nt) - shift[:, np.newaxis]
+        pulses = np.where(times >= 0, self.pulse[np.clip(times, 0, len(self.pulse)-1)], 0.)
+        pulses *= np.asarray(amplitude, dtype=np.float64)[:, np.newaxis]
+        return self.spatial[itemplate][:, :, :, np.newaxis]*pulses[:, np.newaxis, np.newaxis, :]
+
+    def _to_params(self, itemplate, shift, amplitude):
+        x0, y0, xwidth, ywidth = self.params[itemplate].T
+        return np.column_stack((x0, y0, 2.*shift, amplitude, xwidth, ywidth))
+
+    def match_one(self, wfs):
+        """
+        Best single template for each waveform.
+
+        Returns:
+        (params, chi2) (n*6) gaussian_beta parameters of the best templates,
+                       and the chi-squared left over
+        """
+        data = np.asarray(ma.filled(wfs, 0.), dtype=np.float64)
+        itemplate, shift, amplitude, gain = self._best(*self.correlate(data))
+        chi2 = np.sum(data.reshape(len(data), -1)**2, axis=1) - gain
+        return self._to_params(itemplate, shift, amplitude), chi2
+
+    def match_two(self, wfs):
+        """
+        Best pair of templates for each waveform. Greedy: the second
+        template is the best match to what's left after the first, then the
+        two amplitudes are refit together.
+
+        Returns:
+        (params, chi2) (n*12) parameters, 6 for each pulse, and the chi-squared
+        """
+        data = np.asarray(ma.filled(wfs, 0.), dtype=np.float64)
+        n, nt = len(data), data.shape[-1]
+        i1, s1, a1, _ = self._best(*self.correlate(data))
+        first = self.waveforms(i1, s1, np.ones(n), nt)
+        i2, s2, a2, _ = self._best(*self.correlate(data - a1[:, np.newaxis, np.newaxis, np.newaxis]*first))
+        second = self.waveforms(i2, s2, np.ones(n), nt)
+
+        # joint least squares for both amplitudes
+        t1, t2, d = first.reshape(n, -1), second.reshape(n, -1), data.reshape(n, -1)
+        gram = np.empty((n, 2, 2))
+        gram[:, 0, 0] = np.sum(t1*t1, axis=1)
+        gram[:, 1, 1] = np.sum(t2*t2, axis=1)
+        gram[:, 0, 1] = gram[:, 1, 0] = np.sum(t1*t2, axis=1)
+        rhs = np.column_stack((np.sum(t1*d, axis=1), np.sum(t2*d, axis=1)))
+        solvable = np.linalg.det(gram) > 1e-12*gram[:, 0, 0]*gram[:, 1, 1]
+        amplitudes = np.column_stack((a1, a2))
+        if np.any(solvable):
+            amplitudes[solvable] = np.linalg.solve(gram[solvable], rhs[solvable][:, :, np.newaxis])[:, :, 0]
+
+        residual = d - amplitudes[:, :1]*t1 - amplitudes[:, 1:]*t2
+        params = np.hstack((self._to_params(i1, s1, amplitudes[:, 0]), self._to_params(i2, s2, amplitudes[:, 1])))
+        return params, np.sum(residual**2, axis=1)
+
+
+def get_bank(filename, **kwargs):
+    """
+    Load a bank saved with TemplateBank.save, or build a gaussian bank
+    (passing kwargs to TemplateBank.gaussian) and save it there first.
+
+    A gaussian bank in filename that was built with other arguments is
+    rebuilt and replaced. Any other bank is loaded as it is, and passing
+    kwargs for it is an error, since they can't be checked.
+    """
+    if os.path.exists(filename):
+        bank = TemplateBank.load(filename)
+        if bank.build_args is None:
+            if kwargs:
+                raise ValueError("{} is not a gaussian bank, can't build it with {}".format(
+                    filename, ", ".join(sorted(kwargs))))
+            return bank
+        if bank.build_args == TemplateBank.gaussian_args(**kwargs):
+            return bank
+    bank = TemplateBank.gaussian(**kwargs)
+    bank.save(filename)
+    return bank
+
+
+def fit_waveform(wf, bank, min_improvement=0.75):
+    """
+    Decide between one and two pulses from the template matches alone.
+
+    Parameters:
+        wf: waveform
+        bank: TemplateBank
+        min_improvement: call it two pulses if the second template removes
+                         at least this fraction of the chi-squared left by one
+
+    Returns:
+    ((x0, y0, t0), ...) One tuple for each pulse found
+    """
+    one, chi2_one = bank.match_one(wf[np.newaxis])
+    two, chi2_two = bank.match_two(wf[np.newaxis])
+    if chi2_two[0] <= (1.-min_improvement)*chi2_one[0]:
+        return (tuple(two[0, :3]), tuple(two[0, 6:9]))
+    return (tuple(one[0, :3]), )
+
+
+if __name__ == '__main__':
+    import gm2_clustering
+    from functools import partial
+
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("data_file", help="File in which waveforms are stored")
+    parser.add_argument("--bank", default="template_bank.npz",
+                        help="Template bank file, built if it doesn't exist")
+
+    args = parser.parse_args()
+
+    gm2_clustering.algo_tests.one_vs_two(partial(fit_waveform, bank=get_bank(args.bank)), args.data_file)
@@ -1,3 +1,4 @@
 import algo_tests
 import wf_generator
+import dataset
 from wf_plot import plot_waveform
\ No newline at end of file
@@ -0,0 +1,174 @@
+"""
+Fixed-size summary of a one_vs_two run.
+
+An Accumulator holds the fake-rate counts of the one-pulse events and
+2-d (delta R, delta t) histograms of the two-pulse events. It is updated
+one chunk of results at a time, so its size doesn't depend on the number
+of events. Accumulators with the same bins can be added, e.g. to combine
+shards of a dataset or separate runs, and saved to a small .npz.
+
+Plotting is separate: python accumulator.py run1.npz [run2.npz ...]
+"""
+
+import numpy as np
+
+# default bins, in crystals and ns
+DR_BINS = np.linspace(0, 10, 11)
+DT_BINS = np.linspace(0, 200, 26)
+
+
+class Accumulator(object):
+    """
+    Counts from one_vs_two.
+
+    Parameters:
+        dr_bins, dt_bins: bin edges in delta R (crystals) and delta t (ns).
+                          Pairs beyond the last edge are counted in the last bin.
+    """
+    def __init__(self, dr_bins=DR_BINS, dt_bins=DT_BINS):
+        self.dr_bins = np.array(dr_bins, dtype=np.float64)
+        self.dt_bins = np.array(dt_bins, dtype=np.float64)
+        shape = (len(self.dr_bins)-1, len(self.dt_bins)-1)
+        self.n_one = 0
+        self.n_one_fake = 0
+        self.total = np.zeros(shape, dtype=np.int64)
+        self.incorrect = np.zeros(shape, dtype=np.int64)
+        self.tiers = {}
+
+    def _bin(self, values, bins):
+        return np.clip(np.searchsorted(bins, values, side='right') - 1, 0, len(bins)-2)
+
+    def _count_tiers(self, tiers):
+        if tiers is None:
+            return
+        for tier in tiers:
+            if tier is not None:
+                self.tiers[tier] = self.tiers.get(tier, 0) + 1
+
+    def add_one(self, counts, tiers=None):
+        """
+        Add one-pulse events.
+
+        Parameters:
+            counts: number of pulses the algorithm found in each event
+            tiers: deciding tier of each event, if the algorithm has them
+        """
+        counts = np.asarray(counts)
+        self.n_one += len(counts)
+        self.n_one_fake += np.count_nonzero(counts != 1)
+        self._count_tiers(tiers)
+
+    def add_two(self, truth, counts, tiers=None):
+        """
+        Add two-pulse events.
+
+        Parameters:
+            truth: (n*2) truth records with x0, y0 and t0 of both pulses
+            counts: number of pulses the algorithm found in each event
+            tiers: deciding tier of each event, if the algorithm has them
+        """
+        p1, p2 = truth[:, 0], truth[:, 1]
+        dr = np.hypot(p1['x0']-p2['x0'], p1['y0']-p2['y0'])
+        dt = np.abs(p1['t0']-p2['t0'])
+        index = np.ravel_multi_index((self._bin(dr, self.dr_bins), self._bin(dt, self.dt_bins)),
+                                     self.total.shape)
+        size = self.total.size
+        self.total += np.bincount(index, minlength=size).reshape(self.total.shape)
+        incorrect = np.asarray(counts) < 2
+        self.incorrect += np.bincount(index[incorrect], minlength=size).reshape(self.total.shape)
+        self._count_tiers(tiers)
+
+    @property
+    def n_two(self):
+        return self.total.sum()
+
+    @property
+    def fake_rate(self):
+        """Fraction of one-pulse events called anything but one pulse"""
+        return 1.*self.n_one_fake/self.n_one if self.n_one else np.nan
+
+    def false_negative_rate(self):
+        """(delta R * delta t) fraction of two-pulse events called one pulse, 0 for empty bins"""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = 1.*self.incorrect/self.total
+        ratio[self.total == 0] = 0.
+        return ratio
+
+    def tier_fractions(self):
+        """Fraction of all events decided by each tier"""
+        n = sum(self.tiers.itervalues())
+        return dict((tier, 1.*count/n) for tier, count in self.tiers.iteritems())
+
+    def __iadd__(self, other):
+        if not (np.array_equal(self.dr_bins, other.dr_bins) and np.array_equal(self.dt_bins, other.dt_bins)):
+            raise ValueError("Can't add accumulators with different bins")
+        self.n_one += other.n_one
+        self.n_one_fake += other.n_one_fake
+        self.total += other.total
+        self.incorrect += other.incorrect
+        for tier, count in other.tiers.iteritems():
+            self.tiers[tier] = self.tiers.get(tier, 0) + count
+        return self
+
+    def __add__(self, other):
+        result = Accumulator(self.dr_bins, self.dt_bins)
+        result += self
+        result += other
+        return result
+
+    def save(self, filename):
+        tier_names = sorted(self.tiers)
+        np.savez(filename, dr_bins=self.dr_bins, dt_bins=self.dt_bins,
+                 n_one=self.n_one, n_one_fake=self.n_one_fake,
+                 total=self.total, incorrect=self.incorrect,
+                 tier_names=np.array(tier_names, dtype=str),
+                 tier_counts=np.array([self.tiers[tier] for tier in tier_names], dtype=np.int64))
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as data:
+            result = cls(data['dr_bins'], data['dt_bins'])
+            result.n_one = int(data['n_one'])
+            result.n_one_fake = int(data['n_one_fake'])
+            result.total[...] = data['total']
+            result.incorrect[...] = data['incorrect']
+            result.tiers = dict(zip(data['tier_names'].tolist(), data['tier_counts'].tolist()))
+        return result
+
+
+def report(accumulator):
+    """Print the fake rate and the tier fractions"""
+    print("False-positive rate: {}".format(accumulator.fake_rate))
+    for tier, fraction in sorted(accumulator.tier_fractions().iteritems()):
+        print("Decided by {}: {}".format(tier, fraction))
+
+
+def plot(accumulator):
+    """Plot the false-negative rate against delta R and delta t"""
+    import matplotlib.pyplot as plt
+
+    bin_x, bin_y = accumulator.dr_bins, accumulator.dt_bins
+    extent = [bin_y[0], bin_y[-1], bin_x[0], bin_x[-1]]
+    plt.imshow(accumulator.false_negative_rate(), extent=extent, interpolation='nearest',
+               aspect='auto', origin='lower')
+    plt.ylabel(r"$\Delta R$ (crystals)")
+    plt.xlabel(r"$\Delta t$ (ns)")
+    cb = plt.colorbar()
+    cb.set_label("False-negative rate")
+
+
+if __name__ == '__main__':
+    import argparse
+    import matplotlib.pyplot as plt
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("files", nargs="+", help="Saved accumulators. They are added together")
+
+    args = parser.parse_args()
+
+    accumulator = Accumulator.load(args.files[0])
+    for filename in args.files[1:]:
+        accumulator += Accumulator.load(filename)
+    report(accumulator)
+    plot(accumulator)
+    plt.show()
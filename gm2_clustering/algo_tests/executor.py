@@ -0,0 +1,185 @@
+"""
+Run a fit_func over every event in a file with a pool of processes.
+
+The events stay on disk in a columnar dataset (see gm2_clustering.dataset).
+Each worker memory-maps it once when it starts, so only (group, start, stop)
+ranges are sent to the workers and only small results come back. Algorithms
+with a batch version (see get_batch) get a whole chunk at once. The
+one- and two-pulse events are handed out as one stream of chunks, so the
+pool never waits for one group to finish before starting the other.
+"""
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+from functools import partial
+
+import numpy as np
+
+import gm2_clustering.dataset as dataset
+import gm2_clustering.instrument as instrument
+
+# set up in each worker by _init_worker
+_worker = {}
+
+
+def _init_worker(path, fit_func, instrumented):
+    _worker['data'] = dataset.Dataset(path)
+    _worker['fit_func'] = fit_func
+    instrument.enable(instrumented)
+
+
+def get_batch(fit_func):
+    """
+    The batch version of fit_func, or None if it doesn't have one. Like the
+    generator functions, an algorithm provides one as fit_func.batch: it
+    takes an (n*nx*ny*nt) stack and returns the n cluster counts (or an
+    (n*n_points) array of them for a parameter sweep, see sweep.py).
+    """
+    if isinstance(fit_func, partial):
+        batch = get_batch(fit_func.func)
+        if batch is None:
+            return None
+        return partial(batch, *fit_func.args, **(fit_func.keywords or {}))
+    return getattr(fit_func, 'batch', None)
+
+
+def _evaluate_chunk(job):
+    """
+    Number of pulses, and tier if there is one, for the events in one range.
+    Also hands back (and clears) this worker's instrument numbers.
+    """
+    group, start, stop = job
+    waveforms = _worker['data'][group].waveforms
+    fit_func = _worker['fit_func']
+    fit_batch = get_batch(fit_func)
+    if fit_batch is not None:
+        with instrument.timed("executor.read"):
+            wfs = np.asarray(waveforms[start:stop])
+        with instrument.timed("executor.fit_batch"):
+            counts = np.asarray(fit_batch(wfs)).tolist()
+        tiers = [None]*len(counts)
+    else:
+        counts, tiers = [], []
+        for i in xrange(start, stop):
+            with instrument.timed("executor.read"):
+                wf = np.asarray(waveforms[i])
+            with instrument.timed("executor.fit"):
+                result = fit_func(wf)
+            counts.append(len(result))
+            tiers.append(getattr(result, 'tier', None))
+
+    stats = instrument.snapshot()
+    instrument.reset()
+    return group, start, counts, tiers, stats
+
+
+def make_jobs(sizes, chunk_size):
+    """
+    Split each group into chunks, alternating between groups so that all
+    groups are being worked on at once
+
+    Parameters:
+        sizes: list of (group, number of events)
+        chunk_size: events per job
+
+    Returns:
+    list of (group, start, stop)
+    """
+    per_group = [[(group, start, min(start+chunk_size, n)) for start in xrange(0, n, chunk_size)]
+                 for group, n in sizes]
+    jobs = []
+    for i in xrange(max([len(chunks) for chunks in per_group] or [0])):
+        jobs.extend(chunks[i] for chunks in per_group if i < len(chunks))
+    return jobs
+
+
+class Results(object):
+    """Per-event output of evaluate for one group"""
+    def __init__(self, truth, counts, tiers):
+        self.truth = truth
+        self.counts = counts
+        self.tiers = tiers
+
+
+def run(fit_func, data_file, groups=('one', 'two'), n_workers=None, chunk_size=100):
+    """
+    Run fit_func on every event in data_file, one chunk at a time.
+
+    Parameters:
+        fit_func: see one_vs_two. Must be picklable (a module-level function,
+                  or a functools.partial of one) if the start method isn't fork
+        data_file: columnar dataset, or a .npz that is first copied to a
+                   temporary dataset
+        groups: groups of events to run over
+        n_workers: number of processes, default is one per core
+        chunk_size: events per job sent to a worker
+
+    Yields:
+    (group, start, truth, counts, tiers) for each chunk, in the order of
+    make_jobs. truth is a copy of the chunk's truth records, counts the
+    number of pulses found in each event and tiers the deciding tiers
+    (None if fit_func doesn't report them).
+    """
+    if n_workers is None:
+        n_workers = multiprocessing.cpu_count()
+
+    tmp_dir = None
+    path = data_file
+    if not os.path.isdir(data_file):
+        tmp_dir = tempfile.mkdtemp(suffix=dataset.EXTENSION)
+        print "Converting {} to a dataset in {}".format(data_file, tmp_dir)
+        with instrument.timed("executor.convert"):
+            dataset.convert(data_file, tmp_dir)
+        path = tmp_dir
+
+    try:
+        data = dataset.Dataset(path)
+        jobs = make_jobs([(group, len(data[group])) for group in groups], chunk_size)
+
+        pool = multiprocessing.Pool(n_workers, initializer=_init_worker,
+                                    initargs=(path, fit_func, instrument.enabled()))
+        try:
+            chunks = pool.imap(_evaluate_chunk, jobs)
+            while True:
+                # time spent waiting on the workers
+                with instrument.timed("executor.wait"):
+                    try:
+                        group, start, counts, tiers, stats = chunks.next()
+                    except StopIteration:
+                        break
+                instrument.merge(stats)
+                # copy, the memmap may point into tmp_dir
+                truth = np.array(data[group].truth[start:start+len(counts)])
+                yield group, start, truth, np.array(counts, dtype=np.int64), np.array(tiers, dtype=object)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
+
+
+def evaluate(fit_func, data_file, groups=('one', 'two'), n_workers=None, chunk_size=100):
+    """
+    Run fit_func on every event in data_file, keeping every result. Same
+    parameters as run.
+
+    Returns:
+    dictionary of group: Results, with events in file order
+    """
+    chunks = dict((group, []) for group in groups)
+    for group, start, truth, counts, tiers in run(fit_func, data_file, groups, n_workers, chunk_size):
+        chunks[group].append((truth, counts, tiers))
+
+    results = {}
+    for group, group_chunks in chunks.iteritems():
+        if group_chunks:
+            results[group] = Results(*[np.concatenate(column) for column in zip(*group_chunks)])
+        else:
+            results[group] = Results(np.empty(0), np.empty(0, dtype=np.int64), np.empty(0, dtype=object))
+    return results
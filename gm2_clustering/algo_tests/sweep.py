@@ -0,0 +1,192 @@
+"""
+one_vs_two over a grid of algorithm parameters in a single pass.
+
+Each event is read once, and what every parameter point needs from it is
+computed once: for e821 the time sums over the crystals, for the automaton
+the time island and its seeds above the lowest seed threshold. Every point
+is then decided from those. The results match running one_vs_two with
+each setting on its own.
+
+    python -m gm2_clustering.algo_tests.sweep e821 data.events \\
+        --thresh_frac 0.2 0.3 0.4 --count_limit 4 6 8
+"""
+
+import itertools
+import os
+import numpy as np
+
+import algos.automaton as ca
+import algos.e821 as e821
+import gm2_clustering.instrument as instrument
+import executor
+import accumulator
+
+
+class Grid(object):
+    """
+    Every combination of values of some parameters. Subclasses are used
+    as the fit_func of executor.run, and define a batch that takes an
+    (n*nx*ny*nt) stack and returns the (n*n_points) cluster counts, points
+    in the order of points().
+
+    Parameters:
+        values: list of (name, list of values)
+    """
+    def __init__(self, values):
+        self.names = tuple(name for name, _ in values)
+        self.values = tuple(np.asarray(v, dtype=np.float64) for _, v in values)
+
+    @property
+    def shape(self):
+        return tuple(len(v) for v in self.values)
+
+    def points(self):
+        """Parameters of each point, as dictionaries, in C order of shape"""
+        return [dict(zip(self.names, point)) for point in itertools.product(*self.values)]
+
+
+class E821Grid(Grid):
+    """
+    Grid over e821.fit_waveform's thresh_frac and count_limit. batch also
+    takes SparseEvents.
+    """
+    def __init__(self, thresh_fracs, count_limits):
+        Grid.__init__(self, [("thresh_frac", thresh_fracs), ("count_limit", count_limits)])
+
+    def batch(self, wfs):
+        thresh_fracs, count_limits = self.values
+        with instrument.timed("sweep.time_sums"):
+            ts = e821.time_sums(wfs)
+        # (n*n_fracs) samples above each threshold
+        counts = np.stack([e821.samples_above(ts, float(frac)) for frac in thresh_fracs], axis=-1)
+        pulses = np.where(counts[:, :, np.newaxis] > count_limits, 2, 1)
+        return pulses.reshape(len(ts), -1)
+
+
+class AutomatonGrid(Grid):
+    """
+    Grid over the automaton's threshold and seed_threshold, as used by
+    automaton.fit_waveform on the time island of each event.
+
+    Every seed that is above threshold keeps its own cluster, however the
+    clusters grow, so the number of clusters is the number of seeds above
+    both thresholds and no growing is needed.
+    """
+    def __init__(self, thresholds, seed_thresholds):
+        Grid.__init__(self, [("threshold", thresholds), ("seed_threshold", seed_thresholds)])
+
+    def batch(self, wfs):
+        thresholds, seed_thresholds = self.values
+        pulses = np.empty((len(wfs),) + self.shape, dtype=np.int64)
+        for i, wf in enumerate(wfs):
+            _, island = ca.make_time_island(wf)
+            seeds, _ = ca.find_seeds(island, seed_thresholds.min())
+            values = island.ravel()[seeds]
+            # seeds are kept if they are active, ~(wf < threshold)
+            kept = ~(values < thresholds[:, np.newaxis, np.newaxis]) & \
+                (values > seed_thresholds[:, np.newaxis])
+            pulses[i] = np.where(kept.sum(axis=-1) > 1, 2, 1)
+        return pulses.reshape(len(wfs), -1)
+
+
+def sweep(grid, data_file, n_workers=None, chunk_size=100):
+    """
+    Run every point of grid over data_file.
+
+    Returns:
+    grid.shape object array of accumulator.Accumulator
+    """
+    results = [accumulator.Accumulator() for _ in xrange(int(np.prod(grid.shape)))]
+    for group, start, truth, counts, _ in executor.run(grid, data_file, n_workers=n_workers,
+                                                       chunk_size=chunk_size):
+        for ipoint, result in enumerate(results):
+            if group == 'one':
+                result.add_one(counts[:, ipoint])
+            else:
+                result.add_two(truth, counts[:, ipoint])
+
+    accumulators = np.empty(len(results), dtype=object)
+    accumulators[:] = results
+    return accumulators.reshape(grid.shape)
+
+
+def maps(accumulators):
+    """
+    Returns:
+    (fake_rate, efficiency) arrays shaped like accumulators. efficiency is
+    the fraction of all two-pulse events found to have two pulses.
+    """
+    fake_rate = np.array([a.fake_rate for a in accumulators.flat]).reshape(accumulators.shape)
+    efficiency = np.array([1. - 1.*a.incorrect.sum()/a.n_two if a.n_two else np.nan
+                           for a in accumulators.flat]).reshape(accumulators.shape)
+    return fake_rate, efficiency
+
+
+def report(grid, accumulators):
+    """Print the fake rate and efficiency of each point"""
+    fake_rate, efficiency = maps(accumulators)
+    print "  ".join("{:>14}".format(name) for name in grid.names + ("fake rate", "efficiency"))
+    for point, fake, eff in zip(grid.points(), fake_rate.flat, efficiency.flat):
+        print "  ".join(["{:>14.6g}".format(point[name]) for name in grid.names] +
+                        ["{:>14.4f}".format(fake), "{:>14.4f}".format(eff)])
+
+
+def plot(grid, accumulators):
+    """Fake rate and efficiency maps of a two-parameter grid"""
+    import matplotlib.pyplot as plt
+
+    fake_rate, efficiency = maps(accumulators)
+    fig, axes = plt.subplots(1, 2, figsize=(12, 5))
+    for ax, values, label in zip(axes, (fake_rate, efficiency), ("Fake rate", "Efficiency")):
+        image = ax.imshow(values, interpolation='nearest', aspect='auto', origin='lower')
+        ax.set_xticks(np.arange(grid.shape[1]))
+        ax.set_xticklabels(["{:g}".format(v) for v in grid.values[1]])
+        ax.set_yticks(np.arange(grid.shape[0]))
+        ax.set_yticklabels(["{:g}".format(v) for v in grid.values[0]])
+        ax.set_xlabel(grid.names[1])
+        ax.set_ylabel(grid.names[0])
+        fig.colorbar(image, ax=ax).set_label(label)
+
+
+def save(grid, accumulators, directory):
+    """Save each point's accumulator as <directory>/<name><value>_<name><value>.npz"""
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    for point, result in zip(grid.points(), accumulators.flat):
+        result.save(os.path.join(directory, "_".join("{}{:g}".format(name, point[name])
+                                                     for name in grid.names) + ".npz"))
+
+
+if __name__ == '__main__':
+    import argparse
+    import matplotlib.pyplot as plt
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="algorithm")
+    e821_parser = subparsers.add_parser("e821")
+    e821_parser.add_argument("--thresh_frac", type=float, nargs="+", default=[0.3])
+    e821_parser.add_argument("--count_limit", type=int, nargs="+", default=[6])
+    automaton_parser = subparsers.add_parser("automaton")
+    automaton_parser.add_argument("--threshold", type=float, nargs="+", default=[1.])
+    automaton_parser.add_argument("--seed_threshold", type=float, nargs="+", default=[200.])
+    for subparser in (e821_parser, automaton_parser):
+        subparser.add_argument("data_file", help="File in which waveforms are stored")
+        subparser.add_argument("--workers", type=int, help="Number of processes, default one per core")
+        subparser.add_argument("--chunk_size", type=int, default=100)
+        subparser.add_argument("--output", help="Directory to save the accumulator of each point to")
+        subparser.add_argument("--no_plot", action="store_true")
+
+    args = parser.parse_args()
+
+    if args.algorithm == "e821":
+        grid = E821Grid(args.thresh_frac, args.count_limit)
+    else:
+        grid = AutomatonGrid(args.threshold, args.seed_threshold)
+
+    results = sweep(grid, args.data_file, args.workers, args.chunk_size)
+    report(grid, results)
+    if args.output is not None:
+        save(grid, results, args.output)
+    if not args.no_plot:
+        plot(grid, results)
+        plt.show()
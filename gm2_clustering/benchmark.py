@@ -0,0 +1,323 @@
+"""
+Throughput benchmarks for generation, clustering and fitting.
+
+Every case runs in its own process on events generated with a fixed seed,
+and reports events/second, median and 99th percentile time per event and
+the peak resident memory of that process. Results are written as JSON so
+that runs can be compared over time:
+
+    python -m gm2_clustering.benchmark --mode quick --output bench.json
+"""
+
+import json
+import multiprocessing
+import platform
+import Queue
+import resource
+import shutil
+import tempfile
+import time
+import timeit
+from collections import OrderedDict
+
+import numpy as np
+import scipy
+
+import gm2_clustering.dataset as dataset
+import gm2_clustering.utils as utils
+from gm2_clustering.wf_generator import generator, waveforms, transform
+
+# events per case for each speed of case, and the batch sizes and worker
+# counts to scale over. workers=None means powers of two up to the number
+# of cores
+MODES = {
+    "quick": {"fast": 50, "slow": 4, "slowest": 1, "batch_sizes": (10, 100), "workers": (1, 2)},
+    "full": {"fast": 1000, "slow": 100, "slowest": 10, "batch_sizes": (1, 10, 100, 1000), "workers": None},
+}
+
+speeds = ("fast", "slow", "slowest")
+
+# name: (function, what it scales over, speed)
+_cases = OrderedDict()
+
+
+def case(name, scale=None, speed="fast"):
+    """
+    Register a benchmark. The function takes (n, batch_size, n_workers) and
+    returns (times, events) with the time of each call it made and the
+    number of events each call handled.
+
+    Parameters:
+        scale: None, "batch_size" or "n_workers": run once for each value
+        speed: one of speeds, picks the number of events from the mode
+    """
+    if speed not in speeds:
+        raise ValueError("{} is not a valid speed".format(speed))
+
+    def register(fcn):
+        _cases[name] = (fcn, scale, speed)
+        return fcn
+    return register
+
+
+def benchmark_params():
+    """Showers spread over the inside of the calorimeter"""
+    return tuple(p[0] for p in _benchmark_params_batch(1))
+
+
+def _benchmark_params_batch(n):
+    x = np.random.uniform(1, 7, size=n)
+    y = np.random.uniform(1, 4, size=n)
+    t = np.random.uniform(25, 175, size=n)
+    return x, y, t
+
+benchmark_params.batch = _benchmark_params_batch
+
+_generator_args = (benchmark_params, waveforms.gaussian_beta, transform.gaussian_noise)
+_generator_kwargs = {"amplitude": 30000., "xwidth": 1., "ywidth": 1., "noise": 5.}
+
+
+def make_events(n):
+    """
+    n events, the first half from one electron and the rest from two
+
+    Returns:
+    (n*9*6*200) array of waveforms
+    """
+    _, one = generator.generate_batch(n - n//2, *_generator_args, **_generator_kwargs)
+    _, two = generator.generate_two_batch(n//2, *_generator_args, **_generator_kwargs)
+    return np.concatenate((one, two))
+
+
+def _time_calls(fcn, args):
+    """Time fcn(arg) for each arg"""
+    times = []
+    for arg in args:
+        start = timeit.default_timer()
+        fcn(arg)
+        times.append(timeit.default_timer() - start)
+    return times
+
+
+@case("generate")
+def _generate(n, batch_size, n_workers):
+    events = generator.generate(*_generator_args, **_generator_kwargs)
+    return _time_calls(lambda _: events.next(), xrange(n)), 1
+
+
+@case("generate_two")
+def _generate_two(n, batch_size, n_workers):
+    events = generator.generate_two(*_generator_args, **_generator_kwargs)
+    return _time_calls(lambda _: events.next(), xrange(n)), 1
+
+
+@case("generate_batch", scale="batch_size")
+def _generate_batch(n, batch_size, n_workers):
+    n_calls = max(1, n//batch_size)
+    return _time_calls(lambda _: generator.generate_batch(batch_size, *_generator_args, **_generator_kwargs),
+                       xrange(n_calls)), batch_size
+
+
+@case("interpolate_waveform")
+def _interpolate_waveform(n, batch_size, n_workers):
+    x, y, t = utils.make_coords()
+    shifts = np.random.uniform(-1, 1, size=(n, 3))
+    wf = make_events(1)[0]
+    x, y, t = x.ravel(), y.ravel(), t.ravel()
+    return _time_calls(lambda s: utils.interpolate_waveform(wf, x - s[0], y - s[1], t - s[2]), shifts), 1
+
+
+@case("get_local_maxima")
+def _get_local_maxima(n, batch_size, n_workers):
+    import algos.automaton as ca
+    return _time_calls(ca.get_local_maxima, make_events(n)), 1
+
+
+@case("automaton", speed="slowest")
+def _automaton(n, batch_size, n_workers):
+    import algos.automaton as ca
+    # on the time island, like fit_waveform; the whole waveform takes far longer
+    islands = [ca.make_time_island(wf)[1] for wf in make_events(n)]
+    return _time_calls(lambda wf: ca.automaton(wf, 1.), islands), 1
+
+
+@case("get_clusters")
+def _get_clusters(n, batch_size, n_workers):
+    import algos.automaton as ca
+    return _time_calls(lambda wf: list(ca.get_clusters(wf)), make_events(n)), 1
+
+
+@case("e821.fit_waveform")
+def _e821(n, batch_size, n_workers):
+    import algos.e821 as e821
+    return _time_calls(e821.fit_waveform, make_events(n)), 1
+
+
+@case("e821.fit_batch", scale="batch_size")
+def _e821_batch(n, batch_size, n_workers):
+    import algos.e821 as e821
+    wfs = make_events(max(n, batch_size))
+    return _time_calls(e821.fit_batch, [wfs[i:i+batch_size] for i in xrange(0, len(wfs), batch_size)]), batch_size
+
+
+@case("likelihood.get_llr", speed="slow")
+def _get_llr(n, batch_size, n_workers):
+    import algos.likelihood as likelihood
+    return _time_calls(likelihood.get_llr, make_events(n)), 1
+
+
+@case("one_vs_two.automaton", scale="n_workers")
+def _one_vs_two(n, batch_size, n_workers):
+    import algos.automaton as ca
+    import gm2_clustering.algo_tests.executor as executor
+
+    path = tempfile.mkdtemp(suffix=dataset.EXTENSION)
+    try:
+        writer = dataset.DatasetWriter(path)
+        writer.extend({'one': generator.generate_batch(n - n//2, *_generator_args, **_generator_kwargs),
+                       'two': generator.generate_two_batch(n//2, *_generator_args, **_generator_kwargs)})
+        # time between finished chunks, the pool start up counts towards the first
+        times, events = [], []
+        last = timeit.default_timer()
+        for _, _, _, counts, _ in executor.run(ca.fit_waveform, path, n_workers=n_workers, chunk_size=10):
+            now = timeit.default_timer()
+            times.append(now - last)
+            events.append(len(counts))
+            last = now
+    finally:
+        shutil.rmtree(path)
+    return times, np.array(events)
+
+
+def _peak_rss(who=resource.RUSAGE_SELF):
+    """Peak resident memory of this process (or its largest child) in kB"""
+    # kB on linux, bytes on macOS
+    scale = 1024. if platform.system() == "Darwin" else 1.
+    return resource.getrusage(who).ru_maxrss/scale
+
+
+def run_case(name, n, seed=0, batch_size=None, n_workers=None):
+    """
+    Run one benchmark in this process.
+
+    Returns:
+    dictionary of results
+    """
+    fcn, _, _ = _cases[name]
+    np.random.seed(seed)
+    baseline = _peak_rss()
+    start = timeit.default_timer()
+    times, events = fcn(n, batch_size, n_workers)
+    total = timeit.default_timer() - start
+
+    per_event = np.asarray(times, dtype=np.float64)/events
+    n_events = int(np.sum(events*np.ones(len(times), dtype=np.int64)))
+    return {"name": name, "n_events": n_events, "batch_size": batch_size, "n_workers": n_workers,
+            "seconds": total, "events_per_second": n_events/np.sum(times),
+            "p50_ms": 1e3*np.percentile(per_event, 50), "p99_ms": 1e3*np.percentile(per_event, 99),
+            "baseline_rss_kb": baseline, "peak_rss_kb": _peak_rss(),
+            "peak_worker_rss_kb": _peak_rss(resource.RUSAGE_CHILDREN)}
+
+
+def _run_case_child(queue, args):
+    try:
+        queue.put(run_case(*args))
+    except Exception as e:
+        queue.put({"name": args[0], "error": repr(e)})
+
+
+def run_isolated(*args):
+    """
+    run_case in a new process, so that its peak memory is its own. Raises
+    RuntimeError if the process dies without a result, e.g. when it is
+    killed for using too much memory.
+    """
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run_case_child, args=(queue, args))
+    process.start()
+    while True:
+        # check the result once more after it exits, it may have been put
+        # just before
+        alive = process.is_alive()
+        try:
+            result = queue.get(timeout=1.)
+            break
+        except Queue.Empty:
+            if not alive:
+                process.join()
+                raise RuntimeError("Benchmark {} died with exit code {}".format(args[0], process.exitcode))
+    process.join()
+    return result
+
+
+def run(mode="quick", names=None, seed=0, batch_sizes=None, workers=None):
+    """
+    Run benchmarks.
+
+    Parameters:
+        mode: "quick" or "full", see MODES
+        names: cases to run, default all
+        seed: random seed for the generated events
+        batch_sizes, workers: override the mode's values to scale over
+
+    Returns:
+    dictionary with the environment and a list of results
+    """
+    if mode not in MODES:
+        raise ValueError("{} is not a valid mode".format(mode))
+    settings = MODES[mode]
+    if names is None:
+        names = list(_cases)
+    for name in names:
+        if name not in _cases:
+            raise ValueError("{} is not a valid benchmark".format(name))
+    if batch_sizes is None:
+        batch_sizes = settings["batch_sizes"]
+    if workers is None:
+        workers = settings["workers"]
+    if workers is None:
+        n_cores = multiprocessing.cpu_count()
+        workers = sorted(set([2**i for i in xrange(int(np.log2(n_cores))+1)] + [n_cores]))
+
+    results = []
+    for name in names:
+        _, scale, speed = _cases[name]
+        n = settings[speed]
+        if scale == "batch_size":
+            configs = [(size, None) for size in batch_sizes]
+        elif scale == "n_workers":
+            configs = [(None, n_workers) for n_workers in workers]
+        else:
+            configs = [(None, None)]
+        for batch_size, n_workers in configs:
+            result = run_isolated(name, n, seed, batch_size, n_workers)
+            results.append(result)
+            if "error" in result:
+                print "{:<28} failed: {}".format(name, result["error"])
+            else:
+                print "{:<28} batch {!s:>5} workers {!s:>3}: {:10.1f} events/s, p50 {:.3f} ms, p99 {:.3f} ms, " \
+                      "peak {:.0f} MB".format(name, batch_size, n_workers, result["events_per_second"],
+                                              result["p50_ms"], result["p99_ms"], result["peak_rss_kb"]/1024.)
+
+    return {"mode": mode, "seed": seed, "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "host": platform.node(), "cpu_count": multiprocessing.cpu_count(),
+            "python": platform.python_version(), "numpy": np.__version__, "scipy": scipy.__version__,
+            "results": results}
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=sorted(MODES), default="quick")
+    parser.add_argument("--output", help="JSON file to write the results to")
+    parser.add_argument("--cases", nargs="+", choices=list(_cases), help="Benchmarks to run, default all")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch_sizes", type=int, nargs="+", help="Batch sizes to scale over")
+    parser.add_argument("--workers", type=int, nargs="+", help="Worker counts to scale over")
+
+    args = parser.parse_args()
+
+    report = run(args.mode, args.cases, args.seed, args.batch_sizes, args.workers)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=1, sort_keys=True)
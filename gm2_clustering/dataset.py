@@ -0,0 +1,309 @@
+"""
+Columnar, memory-mappable storage for generated events.
+
+A dataset is a directory (by convention named *.events) with one pair of
+flat binary files per group ("one", "two"):
+
+    <group>.truth   truth parameters, as generator.truth_dtype records
+    <group>.wfs     waveforms, one contiguous (N*9*6*T) block
+    meta.json       number of events, shapes and dtypes of each group
+
+or, for a zero-suppressed dataset (see gm2_clustering.sparse), instead of
+<group>.wfs
+
+    <group>.indices  int32 voxel indices of the kept voxels
+    <group>.values   their values
+    <group>.offsets  int64 start of each event's voxels, and the end of the last
+
+Waveforms (or voxel values) are stored as set by the dtype policy at the
+time the dataset was created, see gm2_clustering.dtypes. The policy is
+recorded in meta.json and scaled values are decoded as they are read.
+
+Both files are opened with np.memmap, so opening a dataset costs nothing
+and only the events that are touched are read from disk. Events can be
+appended; the event count in meta.json is only updated once the data is
+written, so an interrupted append leaves the dataset as it was.
+"""
+
+import json
+import os
+import numpy as np
+from gm2_clustering.wf_generator.generator import truth_dtype
+from gm2_clustering.sparse import SparseEvents
+import gm2_clustering.dtypes as dtypes
+
+EXTENSION = ".events"
+
+_META = "meta.json"
+
+
+def is_dataset(path):
+    """True if path is (or should be written as) a columnar dataset rather than a .npz"""
+    return path.endswith(EXTENSION) or os.path.isdir(path)
+
+
+def _read_meta(path):
+    meta_path = os.path.join(path, _META)
+    if not os.path.exists(meta_path):
+        return {}
+    with open(meta_path) as f:
+        return json.load(f)
+
+
+def _write_meta(path, meta):
+    # replace the file in one step, so readers never see half of it
+    tmp_path = os.path.join(path, _META + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(meta, f, indent=1, sort_keys=True)
+    os.rename(tmp_path, os.path.join(path, _META))
+
+
+def _policy(info):
+    """dtype policy of a group, float for datasets from before policies were recorded"""
+    if "wf_policy" in info:
+        return dtypes.Policy.from_meta(info["wf_policy"])
+    return dtypes.Policy(_dtype(info["wf_dtype"]).name)
+
+
+def _decoded(stored, policy):
+    """Stored waveforms or values, decoded as they are read if they are scaled"""
+    if policy.scaled:
+        return dtypes.ScaledArray(stored, policy)
+    return stored
+
+
+def _dtype(descr):
+    """Inverse of dtype.descr, as stored in json"""
+    if isinstance(descr, basestring):
+        return np.dtype(str(descr))
+    return np.dtype([(str(name), str(fmt)) for name, fmt in descr])
+
+
+class EventArray(object):
+    """
+    Events of one group. Behaves like the object arrays of the .npz format:
+    indexing gives ((x0, y0, t0), wf) for one-pulse events and
+    ((x0, y0, t0), (x0, y0, t0), wf) for two-pulse events. Slicing gives
+    another EventArray without reading anything.
+
+    The raw columns are available as truth and waveforms.
+    """
+    def __init__(self, truth, waveforms):
+        self.truth = truth
+        self.waveforms = waveforms
+
+    def __len__(self):
+        return len(self.waveforms)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return EventArray(self.truth[index], self.waveforms[index])
+        truth = self.truth[index]
+        if truth.ndim == 0:
+            return tuple(truth.tolist()), self.waveforms[index]
+        return tuple(tuple(t) for t in truth.tolist()) + (self.waveforms[index],)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+
+class Dataset(object):
+    """
+    Read access to a columnar dataset. Use like the result of np.load:
+    data['one'], data['two'], and as a context manager.
+    """
+    def __init__(self, path, mode="r"):
+        self.path = path
+        self.mode = mode
+        self.meta = _read_meta(path)
+
+    def keys(self):
+        return sorted(self.meta)
+
+    def __contains__(self, group):
+        return group in self.meta
+
+    def __getitem__(self, group):
+        try:
+            info = self.meta[group]
+        except KeyError:
+            raise KeyError("{} has no group {}".format(self.path, group))
+        n = info["n"]
+        record_dtype = _dtype(info["truth_dtype"])
+        wf_dtype = _dtype(info["wf_dtype"])
+        sparse = "sparse_threshold" in info
+        policy = _policy(info)
+        # dtype of the waveforms as they are read
+        read_dtype = policy.work_dtype if policy.scaled else wf_dtype
+        if n == 0:
+            truth = np.empty((0,) + tuple(info["truth_shape"]), dtype=record_dtype)
+            if sparse:
+                return EventArray(truth, SparseEvents(np.empty(0, dtype=np.int32), np.empty(0, dtype=read_dtype),
+                                                      np.zeros(1, dtype=np.int64), info["wf_shape"],
+                                                      info["sparse_threshold"]))
+            return EventArray(truth, np.empty((0,) + tuple(info["wf_shape"]), dtype=read_dtype))
+
+        truth = self._memmap(group + ".truth", record_dtype, (n,) + tuple(info["truth_shape"]))
+        if sparse:
+            nnz = info["nnz"]
+            # np.memmap can't map an empty file
+            indices, values = np.empty(0, dtype=np.int32), np.empty(0, dtype=read_dtype)
+            if nnz:
+                indices = self._memmap(group + ".indices", np.int32, (nnz,))
+                values = _decoded(self._memmap(group + ".values", wf_dtype, (nnz,)), policy)
+            offsets = self._memmap(group + ".offsets", np.int64, (n+1,))
+            return EventArray(truth, SparseEvents(indices, values, offsets, info["wf_shape"],
+                                                  info["sparse_threshold"]))
+        wfs = self._memmap(group + ".wfs", wf_dtype, (n,) + tuple(info["wf_shape"]))
+        return EventArray(truth, _decoded(wfs, policy))
+
+    def _memmap(self, filename, dtype, shape):
+        return np.memmap(os.path.join(self.path, filename), dtype=dtype, mode=self.mode, shape=shape)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class DatasetWriter(object):
+    """
+    Create a columnar dataset, or append to an existing one.
+
+    Parameters:
+        path: dataset directory
+        sparse_threshold: if given, only store the voxels above this value,
+                          see gm2_clustering.sparse
+        policy: dtypes.Policy to store the waveforms with. Defaults to that
+                of the existing events, or the current policy for a new
+                dataset.
+    """
+    def __init__(self, path, sparse_threshold=None, policy=None):
+        self.path = path
+        self.sparse_threshold = sparse_threshold
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.meta = _read_meta(path)
+        if policy is None:
+            existing = [_policy(info) for info in self.meta.itervalues()]
+            policy = existing[0] if existing else dtypes.get_policy()
+        self.policy = policy
+
+    def __len__(self):
+        return sum(info["n"] for info in self.meta.itervalues())
+
+    def count(self, group):
+        """Number of events in group"""
+        return self.meta.get(group, {}).get("n", 0)
+
+    def append(self, group, truth, wfs):
+        """
+        Append events to group.
+
+        Parameters:
+            truth: (n,) or (n*2) record array, as from generator.generate_batch
+            wfs: (n*9*6*T) array of waveforms, or SparseEvents for a sparse dataset
+        """
+        self.extend({group: (truth, wfs)})
+
+    def extend(self, groups):
+        """
+        Append events to several groups at once. Either all of them are
+        added or, if interrupted, none are.
+
+        Parameters:
+            groups: dictionary of group: (truth, wfs), see append
+        """
+        meta = dict(self.meta)
+        for group, (truth, wfs) in groups.iteritems():
+            truth = np.ascontiguousarray(truth)
+            if len(truth) != len(wfs):
+                raise ValueError("Got {} truth entries for {} waveforms".format(len(truth), len(wfs)))
+
+            n_old = self.count(group)
+            info = {"n": n_old,
+                    "truth_dtype": truth.dtype.descr, "truth_shape": list(truth.shape[1:])}
+            # (file suffix, data, number of rows already in the file)
+            columns = [(".truth", truth, n_old)]
+            info["wf_policy"] = self.policy.to_meta()
+            if self.sparse_threshold is None:
+                wfs = np.ascontiguousarray(self.policy.encode(wfs))
+                info.update({"wf_dtype": wfs.dtype.str, "wf_shape": list(wfs.shape[1:])})
+                columns.append((".wfs", wfs, n_old))
+            else:
+                if not isinstance(wfs, SparseEvents):
+                    wfs = SparseEvents.from_dense(wfs, self.sparse_threshold)
+                values = self.policy.encode(wfs.values[:wfs.offsets[-1]])
+                nnz_old = self.meta.get(group, {}).get("nnz", 0)
+                info.update({"wf_dtype": values.dtype.str, "wf_shape": list(wfs.shape),
+                             "sparse_threshold": self.sparse_threshold, "nnz": nnz_old + int(wfs.offsets[-1])})
+                # the offsets file starts with a 0 before the first event
+                offsets = np.asarray(wfs.offsets, dtype=np.int64) + nnz_old
+                columns += [(".indices", np.asarray(wfs.indices, dtype=np.int32), nnz_old),
+                            (".values", values, nnz_old),
+                            (".offsets", offsets[1:] if n_old else offsets, n_old + 1 if n_old else 0)]
+
+            if group in self.meta:
+                old = self.meta[group]
+                if _dtype(old["truth_dtype"]) != truth.dtype or \
+                   list(old["truth_shape"]) != info["truth_shape"] or \
+                   _dtype(old["wf_dtype"]) != _dtype(info["wf_dtype"]) or \
+                   list(old["wf_shape"]) != info["wf_shape"] or \
+                   _policy(old) != self.policy or \
+                   old.get("sparse_threshold") != info.get("sparse_threshold"):
+                    raise ValueError("Events don't match the existing {} events in {}".format(group, self.path))
+
+            for suffix, data, n_rows in columns:
+                row_bytes = data.itemsize*int(np.prod(data.shape[1:]))
+                with open(os.path.join(self.path, group + suffix), "ab") as f:
+                    # drop anything left over from an interrupted append
+                    f.truncate(n_rows*row_bytes)
+                    data.tofile(f)
+
+            info["n"] += len(wfs)
+            meta[group] = info
+
+        # the data only becomes part of the dataset here
+        _write_meta(self.path, meta)
+        self.meta = meta
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def load(path):
+    """
+    Open a file of events, either a columnar dataset or a save_waveform .npz.
+    Either way the result can be used as a context manager and indexed with
+    'one' and 'two'.
+    """
+    if os.path.isdir(path):
+        return Dataset(path)
+    # the events of a .npz are object arrays
+    return np.load(path, allow_pickle=True)
+
+
+def convert(npz_file, path, chunk_size=10000, sparse_threshold=None):
+    """Copy the events in a save_waveform .npz into a columnar dataset"""
+    with np.load(npz_file, allow_pickle=True) as data:
+        writer = DatasetWriter(path, sparse_threshold)
+        for group in ('one', 'two'):
+            events = data[group]
+            for start in xrange(0, len(events), chunk_size):
+                chunk = events[start:start+chunk_size]
+                truth = np.array([[tuple(p) for p in e[:-1]] if len(e) > 2 else tuple(e[0])
+                                  for e in chunk], dtype=truth_dtype)
+                wfs = np.array([e[-1] for e in chunk])
+                writer.append(group, truth, wfs)
+    return Dataset(path)
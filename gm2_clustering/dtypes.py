@@ -0,0 +1,150 @@
+"""
+How waveforms are stored and worked on.
+
+    float64  what numpy gives by default
+    float32  half the memory, still far finer than an ADC count
+    uint16   ADC counts, a quarter of the memory. A stored count c stands
+             for the value (c - pedestal)*scale; the pedestal leaves room
+             for negative noise. Values are rounded to whole counts and
+             clipped to 0-65535.
+
+Generated waveforms are made in the policy's work dtype (float32 for both
+float32 and uint16), written to datasets in its storage dtype and decoded
+back to the work dtype when read, so workers and the clustering algorithms
+never see float64 copies. Fits that need the precision (likelihood,
+matched_filter) promote to float64 themselves.
+
+The policy is float64 unless set with the GM2_WF_DTYPE environment variable
+or set_policy(), as name[:scale[:pedestal]], e.g. "uint16:0.5:100".
+Datasets record the policy they were written with, so they are read back
+correctly whatever the current policy is.
+"""
+
+import os
+import numpy as np
+
+policies = ("float64", "float32", "uint16")
+
+
+class Policy(object):
+    """
+    Parameters:
+        name: one of policies
+        scale: value of one ADC count (uint16 only)
+        pedestal: stored count of a zero value (uint16 only)
+    """
+    def __init__(self, name="float64", scale=1., pedestal=100.):
+        if name not in policies:
+            raise ValueError("{} is not a valid dtype policy".format(name))
+        if name != "uint16":
+            scale, pedestal = 1., 0.
+        self.name = name
+        self.scale = float(scale)
+        self.pedestal = float(pedestal)
+        self.storage_dtype = np.dtype(name)
+        self.work_dtype = np.dtype(np.float64 if name == "float64" else np.float32)
+
+    @classmethod
+    def parse(cls, text):
+        """Policy from name[:scale[:pedestal]]"""
+        parts = text.split(":")
+        return cls(parts[0], *[float(p) for p in parts[1:]])
+
+    @property
+    def scaled(self):
+        """True if stored values have to be decoded"""
+        return self.name == "uint16"
+
+    def encode(self, wfs):
+        """Waveforms in the storage dtype"""
+        if not self.scaled:
+            return np.asarray(wfs, dtype=self.storage_dtype)
+        counts = np.rint(np.asarray(wfs, dtype=self.work_dtype)/self.scale + self.pedestal)
+        info = np.iinfo(self.storage_dtype)
+        return np.clip(counts, info.min, info.max).astype(self.storage_dtype)
+
+    def decode(self, stored):
+        """Stored waveforms in the work dtype"""
+        if not self.scaled:
+            return np.asarray(stored, dtype=self.work_dtype)
+        values = np.asarray(stored, dtype=self.work_dtype) - self.work_dtype.type(self.pedestal)
+        if self.scale != 1.:
+            values *= self.work_dtype.type(self.scale)
+        return values
+
+    def to_meta(self):
+        return {"name": self.name, "scale": self.scale, "pedestal": self.pedestal}
+
+    @classmethod
+    def from_meta(cls, meta):
+        return cls(str(meta["name"]), meta["scale"], meta["pedestal"])
+
+    def __eq__(self, other):
+        return isinstance(other, Policy) and self.to_meta() == other.to_meta()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        if self.scaled:
+            return "Policy({!r}, {}, {})".format(self.name, self.scale, self.pedestal)
+        return "Policy({!r})".format(self.name)
+
+
+class ScaledArray(object):
+    """
+    Stored uint16 waveforms (e.g. a memmap) that decode when read. Slicing
+    gives another ScaledArray without reading anything; any other index,
+    or np.asarray, gives decoded values.
+    """
+    def __init__(self, stored, policy):
+        self.stored = stored
+        self.policy = policy
+
+    def __len__(self):
+        return len(self.stored)
+
+    @property
+    def shape(self):
+        return self.stored.shape
+
+    @property
+    def dtype(self):
+        return self.policy.work_dtype
+
+    @property
+    def nbytes(self):
+        return self.stored.nbytes
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return ScaledArray(self.stored[index], self.policy)
+        return self.policy.decode(self.stored[index])
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def __array__(self, dtype=None):
+        values = self.policy.decode(self.stored)
+        return values if dtype is None else values.astype(dtype)
+
+
+_policy = Policy.parse(os.environ.get("GM2_WF_DTYPE", "float64"))
+
+
+def get_policy():
+    return _policy
+
+
+def set_policy(policy):
+    """Set the policy for everything generated and written from now on, a Policy or a string"""
+    global _policy
+    if isinstance(policy, basestring):
+        policy = Policy.parse(policy)
+    _policy = policy
+
+
+def work_dtype():
+    """dtype to generate and process waveforms in"""
+    return _policy.work_dtype
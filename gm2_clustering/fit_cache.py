@@ -0,0 +1,195 @@
+"""
+On-disk cache of per-event fit results.
+
+Functions opt in with a decorator, and results are looked up by a hash of
+the name, the waveform bytes and every other argument:
+
+    @fit_cache.memoize("likelihood.fit_one_pulse")
+    def fit_one_pulse(wf, voxels=None, time_offset=0, p0=None):
+        ...
+
+so rerunning over unchanged events only reads files. Bump version when the
+function changes in a way that changes its results.
+
+Off by default. Turn it on with the GM2_FIT_CACHE environment variable,
+set to the cache directory (and GM2_FIT_CACHE_MB for its size), or with
+configure(). Worker processes inherit the setting.
+
+Each result is a pickle in <path>/<first 2 hex digits of the key>/<key>. It
+is written to a temporary file and renamed into place, so several
+processes can share a cache and readers never see half an entry. Once the
+cache is over its size, the least recently used entries are deleted.
+"""
+
+import cPickle as pickle
+import functools
+import hashlib
+import os
+import tempfile
+import numpy as np
+import numpy.ma as ma
+
+import gm2_clustering.instrument as instrument
+
+_path = os.environ.get("GM2_FIT_CACHE") or None
+_max_bytes = int(float(os.environ.get("GM2_FIT_CACHE_MB", 1024))*2**20)
+# bytes written by this process since the size was last checked
+_written = 0
+
+
+def configure(path, max_mb=1024):
+    """Cache results in path, up to max_mb megabytes. None turns the cache off"""
+    global _path, _max_bytes, _written
+    _path = path
+    _max_bytes = int(max_mb*2**20)
+    _written = 0
+
+
+def enabled():
+    return _path is not None
+
+
+def _update(h, value):
+    """Feed value into the hash h, arrays by their contents"""
+    if isinstance(value, np.ndarray):
+        h.update("array{}{}".format(value.dtype.str, value.shape))
+        h.update(np.ascontiguousarray(ma.getdata(value)).view(np.uint8))
+        if ma.isMaskedArray(value):
+            h.update("mask")
+            h.update(np.ascontiguousarray(ma.getmaskarray(value)).view(np.uint8))
+    elif isinstance(value, (tuple, list)):
+        h.update("{}{}(".format(type(value).__name__, len(value)))
+        for v in value:
+            _update(h, v)
+        h.update(")")
+    elif isinstance(value, dict):
+        h.update("dict{}(".format(len(value)))
+        for k in sorted(value):
+            _update(h, k)
+            _update(h, value[k])
+        h.update(")")
+    else:
+        h.update(repr(value))
+
+
+def key(name, *args, **kwargs):
+    """Hex digest identifying a call of name with these arguments"""
+    h = hashlib.sha1(name)
+    _update(h, args)
+    _update(h, kwargs)
+    return h.hexdigest()
+
+
+def _entry_path(k):
+    return os.path.join(_path, k[:2], k)
+
+
+def get(k):
+    """
+    Returns:
+    (found, value) found is False if k isn't in the cache
+    """
+    filename = _entry_path(k)
+    try:
+        with open(filename, "rb") as f:
+            value = pickle.load(f)
+    except (IOError, OSError, EOFError, pickle.UnpicklingError):
+        return False, None
+    try:
+        os.utime(filename, None)  # most recently used
+    except OSError:
+        pass
+    return True, value
+
+
+def put(k, value):
+    """Store value under k"""
+    global _written
+    directory = os.path.dirname(_entry_path(k))
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            pass  # made by another process in the meantime
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+        size = f.tell()
+    os.rename(tmp_path, _entry_path(k))
+
+    # checking the size means listing the cache, so only do it now and then
+    _written += size
+    if _written > _max_bytes//20:
+        evict()
+
+
+def _entries():
+    """(mtime, size, filename) of every entry"""
+    entries = []
+    for directory, _, filenames in os.walk(_path):
+        for filename in filenames:
+            if filename.startswith(".tmp"):
+                continue
+            filename = os.path.join(directory, filename)
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue  # evicted by another process
+            entries.append((stat.st_mtime, stat.st_size, filename))
+    return entries
+
+
+def evict(max_bytes=None):
+    """Delete the least recently used entries until the cache fits in max_bytes"""
+    global _written
+    if max_bytes is None:
+        max_bytes = _max_bytes
+    _written = 0
+    entries = sorted(_entries())
+    total = sum(size for _, size, _ in entries)
+    for _, size, filename in entries:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+        total -= size
+
+
+def clear():
+    """Delete every entry"""
+    evict(0)
+
+
+def size():
+    """Bytes used by the entries"""
+    return sum(size for _, size, _ in _entries())
+
+
+def memoize(name=None, version=0):
+    """
+    Decorator caching the results of fcn(wf, ...) when the cache is on.
+    Results are keyed on name (module.function by default), version and
+    all the arguments, so they must be picklable and depend on nothing
+    else.
+    """
+    def decorate(fcn):
+        cache_name = "{}:{}".format(name or "{}.{}".format(fcn.__module__.split(".")[-1], fcn.__name__),
+                                    version)
+
+        @functools.wraps(fcn)
+        def wrapper(*args, **kwargs):
+            if _path is None:
+                return fcn(*args, **kwargs)
+            k = key(cache_name, *args, **kwargs)
+            found, value = get(k)
+            if found:
+                instrument.count("fit_cache.hit")
+                return value
+            instrument.count("fit_cache.miss")
+            value = fcn(*args, **kwargs)
+            put(k, value)
+            return value
+        return wrapper
+    return decorate
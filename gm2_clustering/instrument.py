@@ -0,0 +1,143 @@
+"""
+Opt-in timers and counters for the stages of a run.
+
+Off by default. Turn it on with the GM2_INSTRUMENT environment variable
+(any value but "" or "0"), or with enable(). When it is off, timed() and
+count() return straight away and instrumented functions are called with a
+single extra check.
+
+    with instrument.timed("automaton.make_time_island"):
+        ...
+    instrument.count("likelihood.nfev", nfev)
+
+Each name keeps the number of observations, their total, minimum and
+maximum: for timers the observations are wall times in seconds, for
+counters the counted values (e.g. optimizer calls per fit). snapshot() and
+merge() move the numbers between processes, see algo_tests/executor.py.
+"""
+
+import functools
+import json
+import os
+import timeit
+
+_enabled = os.environ.get("GM2_INSTRUMENT", "") not in ("", "0")
+
+# name: [n, total, min, max]
+_stats = {}
+
+
+def enable(on=True):
+    global _enabled
+    _enabled = on
+
+
+def enabled():
+    return _enabled
+
+
+def record(name, value):
+    """Add one observation of value to name"""
+    stat = _stats.get(name)
+    if stat is None:
+        _stats[name] = [1, value, value, value]
+    else:
+        stat[0] += 1
+        stat[1] += value
+        if value < stat[2]:
+            stat[2] = value
+        if value > stat[3]:
+            stat[3] = value
+
+
+def count(name, value=1):
+    """Record value (e.g. a number of iterations) under name, if enabled"""
+    if _enabled:
+        record(name, value)
+
+
+class _Timer(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = timeit.default_timer()
+        return self
+
+    def __exit__(self, *exc_info):
+        record(self.name, timeit.default_timer() - self.start)
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+_null_timer = _NullTimer()
+
+
+def timed(name):
+    """Context manager recording the wall time of its body under name, if enabled"""
+    if _enabled:
+        return _Timer(name)
+    return _null_timer
+
+
+def instrumented(name=None):
+    """Decorator recording the wall time of each call, under module.function by default"""
+    def decorate(fcn):
+        timer_name = name or "{}.{}".format(fcn.__module__.split(".")[-1], fcn.__name__)
+
+        @functools.wraps(fcn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fcn(*args, **kwargs)
+            with _Timer(timer_name):
+                return fcn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def snapshot():
+    """Copy of everything recorded so far, as name: (n, total, min, max)"""
+    return dict((name, tuple(stat)) for name, stat in _stats.iteritems())
+
+
+def reset():
+    _stats.clear()
+
+
+def merge(stats):
+    """Add a snapshot, e.g. from another process, to this process's numbers"""
+    for name, (n, total, low, high) in stats.iteritems():
+        stat = _stats.get(name)
+        if stat is None:
+            _stats[name] = [n, total, low, high]
+        else:
+            stat[0] += n
+            stat[1] += total
+            stat[2] = min(stat[2], low)
+            stat[3] = max(stat[3], high)
+
+
+def summary(stats=None):
+    """Table of the recorded numbers, one row per name"""
+    if stats is None:
+        stats = snapshot()
+    lines = ["{:<36} {:>10} {:>14} {:>14} {:>14} {:>14}".format("name", "n", "total", "mean", "min", "max")]
+    for name, (n, total, low, high) in sorted(stats.iteritems()):
+        lines.append("{:<36} {:>10d} {:>14.6g} {:>14.6g} {:>14.6g} {:>14.6g}".format(
+            name, n, total, 1.*total/n, low, high))
+    return "\n".join(lines)
+
+
+def dump(filename, stats=None):
+    """Write the recorded numbers to a JSON file"""
+    if stats is None:
+        stats = snapshot()
+    with open(filename, "w") as f:
+        json.dump(dict((name, {"n": n, "total": total, "min": low, "max": high})
+                       for name, (n, total, low, high) in stats.iteritems()),
+                  f, indent=1, sort_keys=True)
@@ -0,0 +1,134 @@
+"""
+Zero-suppressed waveforms.
+
+Only the voxels above a threshold are kept, as flat indices into the
+(9*6*T) grid and their values. The voxels of many events are stored one
+after the other, CSR style: event i owns entries offsets[i]:offsets[i+1] of
+indices and values, with indices sorted within each event.
+
+Most voxels of a waveform are noise, so this is far smaller than the dense
+grid. Indexing a SparseEvents with an integer gives back the dense
+waveform (with the suppressed voxels set to zero), so code written for
+dense waveforms keeps working.
+"""
+
+import itertools
+import numpy as np
+
+import gm2_clustering.utils as utils
+
+# offsets to the 27 cells of a 3x3x3 neighbourhood, the same order as
+# automaton._NEIGHBOURHOOD
+_NEIGHBOURHOOD = np.array(list(itertools.product((-1, 0, 1), repeat=3)))
+
+
+class SparseEvents(object):
+    """
+    Parameters:
+        indices: flat voxel indices into the event grid, sorted within each event
+        values: the values of those voxels
+        offsets: (n+1,) start of each event's entries, and the end of the
+                 last. offsets[0] is 0.
+        shape: shape of one dense event
+        threshold: voxels at or below this value were dropped
+    """
+    def __init__(self, indices, values, offsets, shape=utils.WF_SHAPE, threshold=0.):
+        self.indices = indices
+        self.values = values
+        self.offsets = offsets
+        self.shape = tuple(shape)
+        self.threshold = threshold
+
+    @classmethod
+    def from_dense(cls, wfs, threshold=0.):
+        """Keep the voxels of an (n*nx*ny*nt) stack that are above threshold"""
+        wfs = np.asarray(wfs)
+        if wfs.ndim == 3:
+            wfs = wfs[np.newaxis]
+        event_size = int(np.prod(wfs.shape[1:]))
+        flat = np.flatnonzero(wfs > threshold)
+        offsets = np.searchsorted(flat, np.arange(len(wfs)+1)*event_size).astype(np.int64)
+        indices = (flat % event_size).astype(np.int32)
+        return cls(indices, wfs.ravel()[flat], offsets, wfs.shape[1:], threshold)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def nbytes(self):
+        return self.indices.nbytes + self.values.nbytes + self.offsets.nbytes
+
+    @property
+    def event_ids(self):
+        """Event number of each entry"""
+        return np.repeat(np.arange(len(self)), np.diff(self.offsets))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise ValueError("SparseEvents can only be sliced with a step of 1")
+            stop = max(start, stop)
+            first, last = self.offsets[start], self.offsets[stop]
+            return SparseEvents(self.indices[first:last], self.values[first:last],
+                                np.asarray(self.offsets[start:stop+1]) - first, self.shape, self.threshold)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("Event {} out of range".format(index))
+        first, last = self.offsets[index], self.offsets[index+1]
+        wf = np.zeros(self.shape, dtype=self.values.dtype)
+        wf.ravel()[self.indices[first:last]] = self.values[first:last]
+        return wf
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def to_dense(self):
+        """(n*nx*ny*nt) array of all the events"""
+        wfs = np.zeros((len(self),) + self.shape, dtype=self.values.dtype)
+        n_entries = self.offsets[-1]
+        wfs.ravel()[self.event_ids*int(np.prod(self.shape)) + self.indices[:n_entries]] = self.values[:n_entries]
+        return wfs
+
+    def __array__(self, dtype=None):
+        wfs = self.to_dense()
+        return wfs if dtype is None else wfs.astype(dtype)
+
+    def time_sums(self):
+        """(n*nt) sum over the crystals of each time sample, like wf.sum(axis=(0, 1))"""
+        nt = self.shape[-1]
+        n_entries = self.offsets[-1]
+        bins = self.event_ids*nt + np.asarray(self.indices[:n_entries]) % nt
+        return np.bincount(bins, weights=self.values[:n_entries],
+                           minlength=len(self)*nt).reshape(len(self), nt)
+
+    def neighbours(self):
+        """
+        Position of the stored 3x3x3 neighbours of every entry.
+
+        Returns:
+        (n_entries*27) array of entry numbers, -1 where the neighbour is off
+        the grid or wasn't stored. Column 13 is the entry itself.
+        """
+        n_entries = self.offsets[-1]
+        indices = np.asarray(self.indices[:n_entries], dtype=np.int64)
+        event_size = int(np.prod(self.shape))
+        # entries sorted within each event and events in order, so these
+        # keys are sorted over the whole set
+        keys = self.event_ids*event_size + indices
+        coords = np.array(np.unravel_index(indices, self.shape)).T
+
+        table = np.full((n_entries, len(_NEIGHBOURHOOD)), -1, dtype=np.int64)
+        if n_entries == 0:
+            return table
+        for k, offset in enumerate(_NEIGHBOURHOOD):
+            neighbour = coords + offset
+            on_grid = np.all((neighbour >= 0) & (neighbour < self.shape), axis=1)
+            neighbour_keys = keys - indices + np.ravel_multi_index(
+                tuple(np.where(on_grid[:, np.newaxis], neighbour, 0).T), self.shape)
+            position = np.minimum(np.searchsorted(keys, neighbour_keys), n_entries-1)
+            found = on_grid & (keys[position] == neighbour_keys)
+            table[found, k] = position[found]
+        return table
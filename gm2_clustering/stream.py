@@ -0,0 +1,167 @@
+"""
+Find pulses in a continuous digitizer stream instead of pre-cut events.
+
+A record is a (9*6*T) array of any length, e.g. a memory-mapped file. It is
+read in fixed-size blocks into a ring buffer, and time islands are found as
+the samples arrive, the same way automaton.make_time_island cuts them: from
+window samples before the first sample whose spatial sum is above threshold
+to 3*window samples after the last one. Samples above threshold that are
+close enough for their islands to overlap belong to the same island, even
+if they arrive in different blocks.
+
+Memory use depends on the block size and the longest island allowed, not on
+the length of the record.
+"""
+
+import numpy as np
+import gm2_clustering.dtypes as dtypes
+
+
+class RingBuffer(object):
+    """
+    The most recent capacity samples of a (nx*ny*T) stream. Samples are
+    addressed by their absolute time index in the stream.
+    """
+    def __init__(self, spatial_shape, capacity, dtype=np.float64):
+        self.data = np.zeros(tuple(spatial_shape) + (capacity,), dtype=dtype)
+        self.capacity = capacity
+        self.head = 0  # absolute index of the next sample to be written
+
+    @property
+    def tail(self):
+        """Absolute index of the oldest sample still held"""
+        return max(0, self.head - self.capacity)
+
+    def write(self, block):
+        n = block.shape[-1]
+        if n > self.capacity:
+            raise ValueError("Block of {} samples doesn't fit in a buffer of {}".format(n, self.capacity))
+        index = np.arange(self.head, self.head + n) % self.capacity
+        self.data[..., index] = block
+        self.head += n
+
+    def read(self, start, stop):
+        """Copy of samples [start, stop)"""
+        if start < self.tail or stop > self.head:
+            raise ValueError("Samples {}-{} aren't in the buffer ({}-{})".format(start, stop, self.tail, self.head))
+        return np.take(self.data, np.arange(start, stop) % self.capacity, axis=-1)
+
+
+class IslandFinder(object):
+    """
+    Incremental make_time_island over a stream.
+
+    Parameters:
+        block_size: largest block passed to feed
+        threshold: minimum spatial sum of a sample in an island. Unlike
+                   make_time_island this is fixed, a stream has no single
+                   maximum to adapt to.
+        window: samples kept before the first and 3*window after the last
+                sample above threshold
+        max_length: islands are cut after this many samples, which bounds
+                    the buffer if the signal never drops
+        spatial_shape: (nx, ny) of the stream
+    """
+    def __init__(self, block_size=1000, threshold=50, window=5, max_length=1000,
+                 spatial_shape=(9, 6)):
+        self.block_size = block_size
+        self.threshold = threshold
+        self.window = window
+        self.max_length = max_length
+        # above threshold samples this close together have overlapping islands
+        self.merge_gap = 4*window
+        self.buffer = RingBuffer(spatial_shape, max_length + 5*window + block_size, dtypes.work_dtype())
+        self._first = None  # first and last samples above threshold
+        self._last = None   # in the island being built
+        # (first, last) of finished islands whose last samples haven't all
+        # arrived yet, oldest first
+        self._finished = []
+
+    def _finish(self):
+        """Finish the current island. It is cut once its last sample has arrived"""
+        self._finished.append((self._first, self._last))
+        self._first = self._last = None
+
+    def _cut_ready(self, final=False):
+        """Cut the finished islands whose samples have all arrived, or all of them if final"""
+        islands = []
+        while self._finished:
+            first, last = self._finished[0]
+            t_max = last + 3*self.window
+            if t_max > self.buffer.head and not final:
+                break
+            self._finished.pop(0)
+            t_min = max(first - self.window, self.buffer.tail)
+            islands.append((t_min, self.buffer.read(t_min, min(t_max, self.buffer.head))))
+        return islands
+
+    def feed(self, block):
+        """
+        Add the next block of samples.
+
+        Returns:
+        list of (time_offset, island) for the islands completed by this
+        block. time_offset is the absolute sample index of the island's
+        first sample; island is a (nx*ny*t) copy.
+        """
+        block = np.asarray(block)
+        if block.shape[-1] > self.block_size:
+            raise ValueError("Block of {} samples is longer than block_size {}".format(
+                block.shape[-1], self.block_size))
+        start = self.buffer.head
+        self.buffer.write(block)
+        end = self.buffer.head
+
+        above = start + np.flatnonzero(block.sum(axis=(0, 1)) > self.threshold)
+        for t in above:
+            if self._first is not None and t - self._last > self.merge_gap:
+                self._finish()
+            if self._first is None:
+                self._first = t
+            self._last = t
+            if self._last - self._first + 4*self.window >= self.max_length:
+                self._finish()
+
+        # nothing later can join the current island
+        if self._first is not None and end - 1 - self._last >= self.merge_gap:
+            self._finish()
+        return self._cut_ready()
+
+    def flush(self):
+        """Finish the stream. Returns the remaining islands, like feed"""
+        if self._first is not None:
+            self._finish()
+        return self._cut_ready(final=True)
+
+
+def blocks(record, block_size):
+    """Split a (nx*ny*T) record into blocks along time, without copying"""
+    for start in xrange(0, record.shape[-1], block_size):
+        yield record[..., start:start+block_size]
+
+
+def find_islands(record, block_size=1000, **kwargs):
+    """
+    Generator over the time islands of a record, see IslandFinder for kwargs.
+
+    Yields:
+    (time_offset, island) absolute index of the first sample, and the island
+    """
+    finder = IslandFinder(block_size=block_size, spatial_shape=record.shape[:-1], **kwargs)
+    for block in blocks(record, block_size):
+        for island in finder.feed(block):
+            yield island
+    for island in finder.flush():
+        yield island
+
+
+def fit_stream(fit_func, record, block_size=1000, **kwargs):
+    """
+    Run a fit_waveform on every island of a record.
+
+    Yields:
+    (time_offset, result) absolute index of the island's first sample, and
+    fit_func(island)
+    """
+    for time_offset, island in find_islands(record, block_size, **kwargs):
+        yield time_offset, fit_func(island)
@@ -1,11 +1,15 @@
 import numpy as np
 import scipy.ndimage.interpolation
 
+# (x, y, t) shape of a single waveform: 9x6 crystals, 200 samples
+WF_SHAPE = (9, 6, 200)
+
 def load_waveform_file(filename):
-    """Load the waveforms from a binary file. Returns an array of waveforms, each with 6*9*200 entries"""
-    wfs = np.fromfile(filename, np.uint16)
-    split_wfs = np.split(wfs, len(wfs)/6/9/200)
-    return split_wfs
+    """
+    Memory-map the waveforms in a binary file. Returns an (N*6*9*200) uint16
+    array; nothing is read from disk until a waveform is used.
+    """
+    return np.memmap(filename, dtype=np.uint16, mode='r').reshape(-1, 6, 9, 200)
 
 
 def make_coords():
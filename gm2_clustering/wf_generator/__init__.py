@@ -1,7 +1,8 @@
 import params
 import waveforms
 import transform
-from generator import generate, generate_two
+import templates
+from generator import generate, generate_two, generate_batch, generate_two_batch
 from functools import partial
 
 
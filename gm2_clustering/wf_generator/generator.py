@@ -1,4 +1,28 @@
 import inspect
+import numpy as np
+import gm2_clustering.utils as utils
+import gm2_clustering.dtypes as dtypes
+
+
+truth_dtype = np.dtype([('x0', np.float64), ('y0', np.float64), ('t0', np.float64)])
+
+
+def get_argnames(fcn):
+    """
+    Names of the arguments of fcn. Works for plain functions and for
+    callable objects like waveforms.GaussianBetaWaveform
+    """
+    if inspect.isfunction(fcn):
+        return inspect.getargspec(fcn)[0]
+    if not inspect.ismethod(fcn):
+        fcn = fcn.__call__
+    return inspect.getargspec(fcn)[0][1:]  # drop self
+
+
+def _filter_kwargs(fcn, kwargs):
+    """The entries of kwargs that fcn accepts"""
+    names = get_argnames(fcn)
+    return {name: val for name, val in kwargs.iteritems() if name in names}
 
 
 def generate(param_fcn, waveform_fcn, transform_fcn, **kwargs):
@@ -21,14 +45,9 @@ def generate(param_fcn, waveform_fcn, transform_fcn, **kwargs):
         there are 50 different t values per waveform.
     """
 
-    param_kwargs = {name: val for name, val in kwargs.iteritems()
-                    if name in inspect.getargspec(param_fcn)[0]}
-
-    wf_kwargs = {name: val for name, val in kwargs.iteritems()
-                 if name in inspect.getargspec(waveform_fcn)[0]}
-
-    transform_kwargs = {name: val for name, val in kwargs.iteritems()
-                        if name in inspect.getargspec(transform_fcn)[0]}
+    param_kwargs = _filter_kwargs(param_fcn, kwargs)
+    wf_kwargs = _filter_kwargs(waveform_fcn, kwargs)
+    transform_kwargs = _filter_kwargs(transform_fcn, kwargs)
 
     while True:
         x0, y0, t0 = param_fcn(**param_kwargs)
@@ -37,7 +56,7 @@ def generate(param_fcn, waveform_fcn, transform_fcn, **kwargs):
 
         wf = transform_fcn(wf, **transform_kwargs)
 
-        yield (x0, y0, t0), wf
+        yield (x0, y0, t0), wf.astype(dtypes.work_dtype(), copy=False)
 
 
 def generate_two(param_fcn, waveform_fcn, transform_fcn, **kwargs):
@@ -60,14 +79,9 @@ def generate_two(param_fcn, waveform_fcn, transform_fcn, **kwargs):
         there are 50 different t values per waveform.
     """
 
-    param_kwargs = {name: val for name, val in kwargs.iteritems()
-                    if name in inspect.getargspec(param_fcn)[0]}
-
-    wf_kwargs = {name: val for name, val in kwargs.iteritems()
-                 if name in inspect.getargspec(waveform_fcn)[0]}
-
-    transform_kwargs = {name: val for name, val in kwargs.iteritems()
-                        if name in inspect.getargspec(transform_fcn)[0]}
+    param_kwargs = _filter_kwargs(param_fcn, kwargs)
+    wf_kwargs = _filter_kwargs(waveform_fcn, kwargs)
+    transform_kwargs = _filter_kwargs(transform_fcn, kwargs)
 
     while True:
         x0a, y0a, t0a = param_fcn(**param_kwargs)
@@ -80,4 +94,92 @@ def generate_two(param_fcn, waveform_fcn, transform_fcn, **kwargs):
 
         wf = transform_fcn(wf, **transform_kwargs)
 
-        yield (x0a, y0a, t0a), (x0b, y0b, t0b), wf
+        yield (x0a, y0a, t0a), (x0b, y0b, t0b), wf.astype(dtypes.work_dtype(), copy=False)
+
+
+def _draw_params(param_fcn, n, param_kwargs):
+    """Draw n sets of truth parameters, in one call if param_fcn has a batch version"""
+    truth = np.empty(n, dtype=truth_dtype)
+    batch = getattr(param_fcn, "batch", None)
+    if batch is not None:
+        truth['x0'], truth['y0'], truth['t0'] = batch(n, **param_kwargs)
+    else:
+        for i in xrange(n):
+            truth[i] = param_fcn(**param_kwargs)
+    return truth
+
+
+def _make_waveforms(waveform_fcn, truth, out, wf_kwargs):
+    """Fill out with the waveforms for truth, in one call if waveform_fcn has a batch version"""
+    batch = getattr(waveform_fcn, "batch", None)
+    if batch is not None:
+        return batch(truth['x0'], truth['y0'], truth['t0'], out=out, **wf_kwargs)
+    for i, (x0, y0, t0) in enumerate(truth):
+        out[i] = waveform_fcn(x0, y0, t0, **wf_kwargs)
+    return out
+
+
+def _transform(transform_fcn, wfs, transform_kwargs):
+    """Transform wfs in place, in one call if transform_fcn has a batch version"""
+    batch = getattr(transform_fcn, "batch", None)
+    if batch is not None:
+        return batch(wfs, **transform_kwargs)
+    for i in xrange(len(wfs)):
+        wfs[i] = transform_fcn(wfs[i], **transform_kwargs)
+    return wfs
+
+
+def generate_batch(n, param_fcn, waveform_fcn, transform_fcn, **kwargs):
+    """
+    Generate n waveforms at once. Same inputs as generate.
+
+    Functions with a batch attribute are called once for the whole batch:
+        param_fcn.batch(n, **kwargs) returns arrays x0, y0, t0
+        waveform_fcn.batch(x0, y0, t0, out, **kwargs) fills out
+        transform_fcn.batch(waveforms, **kwargs) transforms in place
+    Anything else is called once per waveform.
+
+    Returns:
+        (truth, waveforms) truth is a length n record array with fields
+                           x0, y0 and t0. waveforms is an (n*9*6*200) array
+                           of dtypes.work_dtype().
+    """
+
+    param_kwargs = _filter_kwargs(param_fcn, kwargs)
+    wf_kwargs = _filter_kwargs(waveform_fcn, kwargs)
+    transform_kwargs = _filter_kwargs(transform_fcn, kwargs)
+
+    truth = _draw_params(param_fcn, n, param_kwargs)
+
+    wfs = np.empty((n,) + utils.WF_SHAPE, dtype=dtypes.work_dtype())
+    _make_waveforms(waveform_fcn, truth, wfs, wf_kwargs)
+    _transform(transform_fcn, wfs, transform_kwargs)
+
+    return truth, wfs
+
+
+def generate_two_batch(n, param_fcn, waveform_fcn, transform_fcn, **kwargs):
+    """
+    Generate n waveforms from two electrons at once. Same inputs as generate_two,
+    see generate_batch for the batch versions of the functions.
+
+    Returns:
+        (truth, waveforms) truth is an (n*2) record array with fields x0, y0
+                           and t0, one column per electron. waveforms is an
+                           (n*9*6*200) array.
+    """
+
+    param_kwargs = _filter_kwargs(param_fcn, kwargs)
+    wf_kwargs = _filter_kwargs(waveform_fcn, kwargs)
+    transform_kwargs = _filter_kwargs(transform_fcn, kwargs)
+
+    truth = np.empty((n, 2), dtype=truth_dtype)
+    truth[:, 0] = _draw_params(param_fcn, n, param_kwargs)
+    truth[:, 1] = _draw_params(param_fcn, n, param_kwargs)
+
+    wfs = np.empty((n,) + utils.WF_SHAPE, dtype=dtypes.work_dtype())
+    _make_waveforms(waveform_fcn, truth[:, 0], wfs, wf_kwargs)
+    wfs += _make_waveforms(waveform_fcn, truth[:, 1], np.empty_like(wfs), wf_kwargs)
+    _transform(transform_fcn, wfs, transform_kwargs)
+
+    return truth, wfs
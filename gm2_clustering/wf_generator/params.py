@@ -1,3 +1,4 @@
+import numpy as np
 import scipy.stats
 
 
@@ -5,6 +6,12 @@ def middle():
     return 2.5, 3.5, 10
 
 
+def _middle_batch(n):
+    return np.full(n, 2.5), np.full(n, 3.5), np.full(n, 10.)
+
+middle.batch = _middle_batch
+
+
 def uniform():
     x = scipy.stats.uniform.rvs(loc=-5, scale=7)
     y = scipy.stats.uniform.rvs(loc=-2, scale=5)
@@ -12,6 +19,17 @@ def uniform():
 
     return x, y, t
 
+
+def _uniform_batch(n):
+    x = scipy.stats.uniform.rvs(loc=-5, scale=7, size=n)
+    y = scipy.stats.uniform.rvs(loc=-2, scale=5, size=n)
+    t = scipy.stats.uniform.rvs(loc=25, scale=150, size=n)
+
+    return x, y, t
+
+uniform.batch = _uniform_batch
+
+
 def uniform_ints():
     x = scipy.stats.randint.rvs(loc=0, scale=9)
     y = scipy.stats.randint.rvs(loc=0, scale=6)
@@ -1,16 +1,27 @@
 import argparse
-import inspect
+import json
+import multiprocessing
+import os
+import shutil
 import numpy as np
 import gm2_clustering.wf_generator
+import gm2_clustering.dataset as dataset
+import gm2_clustering.dtypes as dtypes
 
 
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("n", help="Number of waveforms to generate", type=int)
-    parser.add_argument("output_file", help="Output file")
+    parser.add_argument("output_file", help="Output file. Either a .npz or a columnar *.events dataset")
     parser.add_argument("param_fcn", help="Function to generate waveform parameters. Must be a function in gm2_clustering.wf_generator.params")
     parser.add_argument("waveform_fcn", help="Function to generate waveforms. Must be a function in gm2_clustering.wf_generator.waveforms")
     parser.add_argument("transform_fcn", help="Function to transform waveforms. Must be a function in gm2_clustering.wf_generator.transform")
+    parser.add_argument("--workers", help="Generate in chunks with this many processes (datasets only)", type=int)
+    parser.add_argument("--chunk_size", help="Waveforms per chunk when using --workers or writing a dataset", type=int, default=1000)
+    parser.add_argument("--seed", help="Random seed when using --workers", type=int, default=0)
+    parser.add_argument("--sparse", help="Only store voxels above this value (datasets only)", type=float)
+    parser.add_argument("--dtype", help="Waveform dtype policy, name[:scale[:pedestal]] with name one of {}. "
+                                        "A .npz stores uint16 as float32".format(", ".join(dtypes.policies)))
 
     args, extras = parser.parse_known_args()
 
@@ -30,15 +41,15 @@ def parse_args():
 
     # now add the kwargs of those functions as additional arguments
 
-    param_kwargs = inspect.getargspec(param_fcn)[0]
+    param_kwargs = gm2_clustering.wf_generator.generator.get_argnames(param_fcn)
     for kw in param_kwargs:
         if kw is not None:
             parser.add_argument("--{}".format(kw), help="{} argument".format(args.param_fcn), type=float, required=True)
-    waveform_kwargs = inspect.getargspec(waveform_fcn)[0]
+    waveform_kwargs = gm2_clustering.wf_generator.generator.get_argnames(waveform_fcn)
     for kw in waveform_kwargs[3:]:
         if kw is not None:
             parser.add_argument("--{}".format(kw), help="{} argument".format(args.waveform_fcn), type=float, required=True)
-    transform_kwargs = inspect.getargspec(transform_fcn)[0]
+    transform_kwargs = gm2_clustering.wf_generator.generator.get_argnames(transform_fcn)
     for kw in transform_kwargs[1:]:
         if kw is not None:
             parser.add_argument("--{}".format(kw), help="{} argument".format(args.transform_fcn), type=float, required=True)
@@ -47,10 +58,37 @@ def parse_args():
 
     kwargs = {k: v for (k, v) in vars(arg2).iteritems() if k not in vars(args).keys()}
 
-    return args.n, args.output_file, param_fcn, waveform_fcn, transform_fcn, kwargs
+    options = {"n_workers": args.workers, "chunk_size": args.chunk_size, "seed": args.seed,
+               "sparse_threshold": args.sparse, "dtype": args.dtype}
+
+    return (args.n, args.output_file, param_fcn, waveform_fcn, transform_fcn, kwargs), options
+
+
+def _check_sparse(output_file, sparse_threshold):
+    if sparse_threshold is not None and not dataset.is_dataset(output_file):
+        raise ValueError("{} is not a dataset, only datasets can be sparse".format(output_file))
+
+
+def save_waveform(n, output_file, param_fcn, wf_fcn, trans_fcn, kwargs, chunk_size=1000,
+                  sparse_threshold=None):
+    """
+    Generate n one-pulse and n two-pulse waveforms. output_file is either a
+    .npz or, if it ends in dataset.EXTENSION, a columnar dataset, which is
+    written chunk_size events at a time and, if sparse_threshold is given,
+    only keeps the voxels above it.
+    """
+    _check_sparse(output_file, sparse_threshold)
+    if dataset.is_dataset(output_file):
+        with dataset.DatasetWriter(output_file, sparse_threshold) as writer:
+            for start in xrange(0, n, chunk_size):
+                size = min(chunk_size, n - start)
+                writer.extend({
+                    'one': gm2_clustering.wf_generator.generate_batch(size, param_fcn, wf_fcn,
+                                                                      trans_fcn, **kwargs),
+                    'two': gm2_clustering.wf_generator.generate_two_batch(size, param_fcn, wf_fcn,
+                                                                          trans_fcn, **kwargs)})
+        return
 
-
-def save_waveform(n, output_file, param_fcn, wf_fcn, trans_fcn, kwargs):
     one_iter = gm2_clustering.wf_generator.generate(param_fcn, wf_fcn, trans_fcn, **kwargs)
     two_iter = gm2_clustering.wf_generator.generate_two(param_fcn, wf_fcn, trans_fcn, **kwargs)
 
@@ -63,7 +101,113 @@ def save_waveform(n, output_file, param_fcn, wf_fcn, trans_fcn, kwargs):
 
     np.savez(output_file, one=one_data, two=two_data)
 
+
+def _fcn_name(fcn):
+    return getattr(fcn, "__name__", type(fcn).__name__)
+
+
+def _chunk_path(chunk_dir, ichunk):
+    return os.path.join(chunk_dir, "chunk_{:06d}.npz".format(ichunk))
+
+
+def _generate_chunk(job):
+    """
+    Generate and write one chunk. Every chunk has its own random stream,
+    seeded from (seed, ichunk), and a waveform function that takes
+    waveforms in turn from a library (one with a seek attribute, like
+    base_sim_wf) starts where the chunk starts in the whole run. So the
+    output doesn't depend on which process runs it or in what order.
+    """
+    ichunk, size, chunk_size, seed, chunk_dir, param_fcn, wf_fcn, trans_fcn, kwargs = job
+
+    np.random.seed([seed, ichunk])
+    seek = getattr(wf_fcn, "seek", None)
+    if seek is not None:
+        # each event takes one waveform for 'one' and two for 'two'
+        seek(3*chunk_size*ichunk)
+    one_truth, one_wfs = gm2_clustering.wf_generator.generate_batch(size, param_fcn, wf_fcn,
+                                                                    trans_fcn, **kwargs)
+    two_truth, two_wfs = gm2_clustering.wf_generator.generate_two_batch(size, param_fcn, wf_fcn,
+                                                                        trans_fcn, **kwargs)
+
+    # write under a temporary name, so a chunk file on disk is always complete
+    tmp_path = _chunk_path(chunk_dir, ichunk) + ".tmp.npz"
+    np.savez(tmp_path, one_truth=one_truth, one_wfs=one_wfs, two_truth=two_truth, two_wfs=two_wfs)
+    os.rename(tmp_path, _chunk_path(chunk_dir, ichunk))
+    return ichunk
+
+
+def save_waveform_parallel(n, output_file, param_fcn, wf_fcn, trans_fcn, kwargs,
+                           n_workers=None, chunk_size=1000, seed=0, sparse_threshold=None):
+    """
+    Same output as save_waveform, but generated in chunks by a pool of
+    n_workers processes (default: one per core). Output is reproducible
+    for a given seed and chunk_size.
+
+    output_file has to be a columnar dataset: a .npz holds every event in
+    memory until it is written, which is what chunking is meant to avoid.
+    Finished chunks are kept in output_file + ".chunks" and appended, in
+    order, as soon as they are done. Rerunning an interrupted job with the
+    same arguments only generates the missing chunks.
+    """
+    if not dataset.is_dataset(output_file):
+        raise ValueError("{} is not a dataset, only datasets can be generated in parallel".format(output_file))
+    chunk_dir = output_file + ".chunks"
+    n_chunks = (n + chunk_size - 1)//chunk_size
+    writer = dataset.DatasetWriter(output_file, sparse_threshold)
+    next_chunk = writer.count('one')//chunk_size
+
+    manifest = {"n": n, "chunk_size": chunk_size, "seed": seed,
+                "param_fcn": _fcn_name(param_fcn), "waveform_fcn": _fcn_name(wf_fcn),
+                "transform_fcn": _fcn_name(trans_fcn), "kwargs": kwargs}
+    manifest_path = os.path.join(chunk_dir, "manifest.json")
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            if json.load(f) != json.loads(json.dumps(manifest)):
+                raise ValueError("{} was started with different arguments".format(chunk_dir))
+    else:
+        if not os.path.isdir(chunk_dir):
+            os.makedirs(chunk_dir)
+        with open(manifest_path, "w") as f:
+            json.dump(manifest, f)
+
+    jobs = [(ichunk, min(chunk_size, n - ichunk*chunk_size), chunk_size, seed, chunk_dir,
+             param_fcn, wf_fcn, trans_fcn, kwargs)
+            for ichunk in xrange(next_chunk, n_chunks)
+            if not os.path.exists(_chunk_path(chunk_dir, ichunk))]
+    print("{} of {} chunks left to generate".format(len(jobs), n_chunks))
+
+    def append_finished(next_chunk):
+        """Append the finished chunks that directly follow what is already written"""
+        while next_chunk < n_chunks and os.path.exists(_chunk_path(chunk_dir, next_chunk)):
+            with np.load(_chunk_path(chunk_dir, next_chunk)) as chunk:
+                writer.extend({'one': (chunk['one_truth'], chunk['one_wfs']),
+                               'two': (chunk['two_truth'], chunk['two_wfs'])})
+            os.remove(_chunk_path(chunk_dir, next_chunk))
+            next_chunk += 1
+        return next_chunk
+
+    pool = multiprocessing.Pool(n_workers)
+    try:
+        for ichunk in pool.imap_unordered(_generate_chunk, jobs):
+            print("Finished chunk {}".format(ichunk))
+            next_chunk = append_finished(next_chunk)
+    finally:
+        pool.close()
+        pool.join()
+
+    append_finished(next_chunk)
+    shutil.rmtree(chunk_dir)
+
+
 if __name__ == '__main__':
-    args = parse_args()
-    save_waveform(*args)
+    args, options = parse_args()
+    # set before generating, so the workers start with it too
+    policy = options.pop("dtype")
+    if policy is not None:
+        dtypes.set_policy(policy)
+    if options["n_workers"] is None:
+        save_waveform(*args, chunk_size=options["chunk_size"], sparse_threshold=options["sparse_threshold"])
+    else:
+        save_waveform_parallel(*args, **options)
 
@@ -0,0 +1,119 @@
+"""
+Separable evaluation of the gamma * gaussian * gaussian pulse model.
+
+The model is a time profile times an x profile times a y profile, so it is
+cheaper to evaluate each of those as a 1-d vector and take the outer product
+than to evaluate the pdfs over the whole grid.
+"""
+
+from collections import OrderedDict
+import numpy as np
+import scipy.stats
+import gm2_clustering.utils as utils
+
+
+class LRUCache(object):
+    """Dictionary that forgets the least recently used entry once it holds maxsize"""
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, compute):
+        """Return the entry for key, calling compute() to fill it if it is missing"""
+        try:
+            value = self._entries.pop(key)
+        except KeyError:
+            value = compute()
+            if len(self._entries) >= self.maxsize:
+                self._entries.popitem(last=False)
+        self._entries[key] = value
+        return value
+
+    def clear(self):
+        self._entries.clear()
+
+
+class TemplateEngine(object):
+    """
+    Build gamma * gaussian * gaussian waveforms from cached 1-d profiles.
+    Profiles are evaluated at the exact parameters and only reused when a
+    call repeats them exactly (fixed positions or widths, refits of the
+    same event), so the waveforms are the same as without the cache.
+
+    Parameters:
+        cache_size: number of profiles to keep per axis
+    """
+    def __init__(self, cache_size=4096):
+        x, y, t = utils.make_coords()
+        self.x = x[:, 0, 0].astype(np.float64)
+        self.y = y[0, :, 0].astype(np.float64)
+        self.t = t[0, 0, :].astype(np.float64)
+        self._time_cache = LRUCache(cache_size)
+        self._x_cache = LRUCache(cache_size)
+        self._y_cache = LRUCache(cache_size)
+
+    @property
+    def shape(self):
+        return (len(self.x), len(self.y), len(self.t))
+
+    def _cached(self, cache, params, compute):
+        params = tuple(float(p) for p in params)
+
+        def fill():
+            profile = compute(*params)
+            profile.flags.writeable = False  # shared between callers
+            return profile
+        return cache.get(params, fill)
+
+    def time_profile(self, t0):
+        """Pulse shape sampled on the time axis"""
+        return self._cached(self._time_cache, (t0,),
+                            lambda t0: scipy.stats.gamma.pdf(self.t, 1.4, loc=t0, scale=5.))
+
+    def x_profile(self, x0, xwidth):
+        """Shower profile across the crystals in x"""
+        return self._cached(self._x_cache, (x0, xwidth),
+                            lambda x0, xwidth: scipy.stats.norm.pdf(self.x, loc=x0, scale=xwidth))
+
+    def y_profile(self, y0, ywidth):
+        """Shower profile across the crystals in y"""
+        return self._cached(self._y_cache, (y0, ywidth),
+                            lambda y0, ywidth: scipy.stats.norm.pdf(self.y, loc=y0, scale=ywidth))
+
+    def waveform(self, x0, y0, t0, amplitude, xwidth, ywidth, out=None):
+        """
+        Single waveform, see waveforms.GaussianBetaWaveform.
+
+        Returns:
+            (9*6*200) array, written to out if given
+        """
+        spatial = np.multiply.outer(self.x_profile(x0, xwidth), self.y_profile(y0, ywidth))
+        return np.multiply(spatial[:, :, np.newaxis], amplitude*self.time_profile(t0), out=out)
+
+    def batch(self, x0, y0, t0, amplitude, xwidth, ywidth, out=None):
+        """
+        Stack of waveforms. Each parameter may be an array with one entry
+        per waveform. Random parameters rarely repeat, so this skips the cache.
+
+        Returns:
+            (n*9*6*200) array, written to out if given
+        """
+        def per_wf(param):
+            return np.reshape(param, (-1, 1))
+
+        x_profiles = scipy.stats.norm.pdf(self.x, loc=per_wf(x0), scale=per_wf(xwidth))
+        y_profiles = scipy.stats.norm.pdf(self.y, loc=per_wf(y0), scale=per_wf(ywidth))
+        t_profiles = scipy.stats.gamma.pdf(self.t, 1.4, loc=per_wf(t0), scale=5.)
+        t_profiles *= per_wf(amplitude)
+
+        spatial = x_profiles[:, :, np.newaxis]*y_profiles[:, np.newaxis, :]
+        return np.multiply(spatial[:, :, :, np.newaxis], t_profiles[:, np.newaxis, np.newaxis, :],
+                           out=out)
+
+    def clear(self):
+        self._time_cache.clear()
+        self._x_cache.clear()
+        self._y_cache.clear()
@@ -19,3 +19,11 @@ def gaussian_noise(waveform, noise):
 
     noise = scipy.stats.norm.rvs(scale=noise, size=waveform.shape)
     return waveform+noise
+
+
+def _gaussian_noise_batch(waveforms, noise):
+    """gaussian_noise for a whole stack of waveforms, added in place"""
+    waveforms += scipy.stats.norm.rvs(scale=noise, size=waveforms.shape)
+    return waveforms
+
+gaussian_noise.batch = _gaussian_noise_batch
@@ -1,12 +1,15 @@
 import numpy as np
-import scipy.stats
-import itertools
 import gm2_clustering.utils as utils
+import templates
 
 
 class GaussianBetaWaveform(object):
-    def __init__(self):
-        self.x, self.y, self.t = make_coords()
+    """
+    Gamma pulse shape times a gaussian in x and y. Built from cached,
+    separable profiles, see templates.TemplateEngine
+    """
+    def __init__(self, cache_size=4096):
+        self.templates = templates.TemplateEngine(cache_size)
 
     def __call__(self, x0, y0, t0, amplitude, xwidth, ywidth):
         """
@@ -21,42 +24,220 @@ class GaussianBetaWaveform(object):
             xwidth, ywidth: size of the shower and x and y directions
                             No angled showers for now.
         """
-        wf = scipy.stats.gamma.pdf(self.t, 1.4, loc=t0, scale=5.)
-        wf *= amplitude
-        wf *= scipy.stats.norm.pdf(self.x, loc=x0, scale=xwidth)
-        wf *= scipy.stats.norm.pdf(self.y, loc=y0, scale=ywidth)
+        return self.templates.waveform(x0, y0, t0, amplitude, xwidth, ywidth)
+
+    def batch(self, x0, y0, t0, amplitude, xwidth, ywidth, out=None):
+        """
+        Generate a stack of waveforms. Same parameters as a single waveform,
+        but each may be an array with one entry per waveform.
+
+        Returns:
+            (n*9*6*200) array, written to out if given
+        """
+        return self.templates.batch(x0, y0, t0, amplitude, xwidth, ywidth, out=out)
+
+
+gaussian_beta = GaussianBetaWaveform()
+
+
+class ShowerPlacer(object):
+    """
+    Move library showers to new positions, like utils.interpolate_waveform
+    with order=1 and mode="constant", for many showers at once.
+
+    Each output coordinate only depends on its own axis, and is a shift
+    (and for t, a stride) of the input samples. So the trilinear
+    interpolation is done as one 1-d linear interpolation per axis, each
+    the blend of two strided slices. A whole-sample shift is a single slice.
+
+    Showers are moved one at a time: every shower has its own shift, so
+    doing them all at once means gathering samples by index, which is
+    several times slower than the slices. The loop itself costs little
+    next to the arithmetic on each shower.
+    """
+    # interpolate_waveform converts t with t*2
+    scales = (1., 1., 2.)
+
+    def __init__(self):
+        x, y, t = utils.make_coords()
+        axes = (x[:, 0, 0], y[0, :, 0], t[0, 0, :])
+        self.shape = tuple(len(axis) for axis in axes)
+        # the grids are evenly spaced, so store the first point and the spacing
+        self.origins = tuple(float(axis[0]) for axis in axes)
+        self.steps = tuple(int(round((axis[1]-axis[0])*scale))
+                           for axis, scale in zip(axes, self.scales))
+
+    def _shift_axis(self, wf, axis, offset):
+        """Linearly interpolate wf along axis at (grid - offset)*scale"""
+        n_in = wf.shape[axis]
+        step = self.steps[axis]
+        start = (self.origins[axis] - offset)*self.scales[axis]
+        lower = int(np.floor(start))
+        frac = start - lower
+
+        # output samples that land inside the input, the rest are zero
+        # like mode="constant"
+        k_min = max(0, int(np.ceil(-start/step)))
+        k_max = min(self.shape[axis]-1, int(np.floor((n_in-1-start)/step)))
+
+        shape = list(wf.shape)
+        shape[axis] = self.shape[axis]
+        result = np.zeros(shape)
+        if k_min > k_max:
+            return result
+
+        def strided(first):
+            index = [slice(None)]*wf.ndim
+            index[axis] = slice(first, first + step*(k_max-k_min) + 1, step)
+            return wf[tuple(index)]
+
+        out_index = [slice(None)]*wf.ndim
+        out_index[axis] = slice(k_min, k_max+1)
+        out_index = tuple(out_index)
+
+        first = lower + step*k_min
+        if frac == 0:
+            result[out_index] = strided(first)
+        else:
+            result[out_index] = strided(first)*(1.-frac) + strided(first+1)*frac
+        return result
+
+    def place(self, wfs, x0, y0, t0, amplitude, out=None):
+        """
+        Move showers to (x0, y0, t0) and scale them by amplitude, one
+        shower at a time.
+
+        Parameters:
+            wfs: (n*9*6*200) array of showers, or a single (9*6*200) shower
+            x0, y0, t0, amplitude: shift and scale. Each may be an array
+                                   with one entry per shower.
+
+        Returns:
+            (n*9*6*200) array, or (9*6*200) for a single shower, written to
+            out if given
+        """
+        wfs = np.asarray(wfs)
+        single = wfs.ndim == 3
+        if single:
+            wfs = wfs[np.newaxis]
+        n = len(wfs)
+        x0, y0, t0, amplitude = [np.broadcast_to(np.asarray(p, dtype=np.float64).reshape(-1), (n,))
+                                 for p in (x0, y0, t0, amplitude)]
+
+        result = np.empty((n,) + self.shape) if out is None else out.reshape((n,) + self.shape)
+        for i in xrange(n):
+            wf = self._shift_axis(wfs[i], 2, t0[i])
+            wf = self._shift_axis(wf, 1, y0[i])
+            wf = self._shift_axis(wf, 0, x0[i])
+            if np.issubdtype(wfs.dtype, np.integer):
+                # map_coordinates returns the input dtype, so the shifted
+                # library showers were rounded to whole ADC counts
+                wf = np.floor(wf + 0.5)
+            np.multiply(wf, amplitude[i], out=result[i])
+
+        if single and out is None:
+            return result[0]
+        return out if out is not None else result
 
-        return wf
+
+_placer = ShowerPlacer()
 
 
 def transform_wf(wf, x0, y0, t0, amplitude):
     """Transform a waveform to the given coordinates. Currently only amplitude implemented"""
-    new_x, new_y, new_t = utils.make_coords()
-    new_x -= x0
-    new_y -= y0
-    new_t -= t0
-    new_wf = utils.interpolate_waveform(wf, new_x.ravel(), new_y.ravel(), new_t.ravel())
+    return _placer.place(wf, x0, y0, t0, amplitude)
 
 
-    return new_wf.reshape(9,6,200)*amplitude
+class SimulatedWaveform(object):
+    """
+    Load waveforms from a file
 
+    Parameters:
+        wf_filename: binary shower library, see utils.load_waveform_file.
+                     Memory-mapped the first time a waveform is needed.
+        sampling: how to pick the next library waveform
+                  "cycle": in order, starting over at the end
+                  "random": uniformly at random
+                  "stratified": split the library into n_strata equal
+                                consecutive blocks, and take a random
+                                waveform from each block in turn
+        n_strata: number of blocks for "stratified"
+    """
+    samplings = ("cycle", "random", "stratified")
 
-class SimulatedWaveform(object):
-    """Load waveforms from a file"""
-    def __init__(self, wf_filename):
-        self.wfs = itertools.cycle(utils.load_waveform_file(wf_filename))
+    def __init__(self, wf_filename, sampling="cycle", n_strata=10):
+        if sampling not in self.samplings:
+            raise ValueError("{} is not a valid sampling".format(sampling))
+        self.wf_filename = wf_filename
+        self.sampling = sampling
+        self.n_strata = n_strata
+        self._library = None
+        self._next = 0
+
+    def __getstate__(self):
+        # don't copy the library into other processes, they map it themselves
+        state = dict(self.__dict__)
+        state['_library'] = None
+        return state
+
+    @property
+    def library(self):
+        """(N*9*6*200) view of the memory-mapped library"""
+        if self._library is None:
+            self._library = utils.load_waveform_file(self.wf_filename).swapaxes(1, 2)
+        return self._library
+
+    def sample(self, n=None):
+        """Indices of the next n library waveforms (a single index if n is None)"""
+        size = 1 if n is None else n
+        n_lib = len(self.library)
+        if self.sampling == "cycle":
+            indices = (self._next + np.arange(size)) % n_lib
+        elif self.sampling == "random":
+            indices = np.random.randint(0, n_lib, size=size)
+        else:
+            n_strata = min(self.n_strata, n_lib)
+            stratum = (self._next + np.arange(size)) % n_strata
+            starts = stratum*n_lib//n_strata
+            stops = (stratum+1)*n_lib//n_strata
+            indices = starts + (np.random.random_sample(size)*(stops-starts)).astype(np.int64)
+        self._next += size
+        return indices[0] if n is None else indices
+
+    def seek(self, position):
+        """Continue "cycle" and "stratified" sampling as if position waveforms had been taken"""
+        self._next = position
 
     def __call__(self, x0, y0, t0, amplitude):
         """
         Return simulated waveforms
 
         Pulls waveform library from a file. The return values are transformations of these waveforms.
-        When it exhausts the waveform library, it starts over from the beginning
+        With "cycle" sampling, it starts over from the beginning when it exhausts the waveform library
         """
-        wf = self.wfs.next().reshape(6,9,200).swapaxes(0,1)
+        wf = self.library[self.sample()]
         return transform_wf(wf, x0, y0, t0, amplitude)
 
+    def batch(self, x0, y0, t0, amplitude, out=None):
+        """
+        Stack of simulated waveforms. Same parameters as a single waveform,
+        but each may be an array with one entry per waveform.
+
+        Returns:
+            (n*9*6*200) array, written to out if given
+        """
+        n = np.broadcast(x0, y0, t0, amplitude).size
+        return _placer.place(self.library[self.sample(n)], x0, y0, t0, amplitude, out=out)
+
+
 base_wf = SimulatedWaveform("/home/nic/gm2/clustering/waveforms/waveforms.bin")
 
 def base_sim_wf(x0, y0, t0, amplitude):
-    return base_wf(x0, y0, t0, amplitude)
\ No newline at end of file
+    return base_wf(x0, y0, t0, amplitude)
+
+
+def _base_sim_wf_batch(x0, y0, t0, amplitude, out=None):
+    return base_wf.batch(x0, y0, t0, amplitude, out=out)
+
+base_sim_wf.batch = _base_sim_wf_batch
+base_sim_wf.seek = base_wf.seek
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# plots are never shown in the tests
+os.environ.setdefault("MPLBACKEND", "Agg")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+import algos.e821 as e821
+import gm2_clustering.dataset as dataset
+import gm2_clustering.wf_generator as wf_generator
+from gm2_clustering.algo_tests import accumulator, executor, one_vs_two
+from gm2_clustering.wf_generator import waveforms
+
+KWARGS = {"amplitude": 30000., "xwidth": 1., "ywidth": 1., "noise": 5.}
+
+
+@pytest.fixture(scope="module")
+def path(tmpdir_factory):
+    """A dataset with 10 one- and two-pulse events"""
+    np.random.seed(4)
+    args = (wf_generator.params.uniform, waveforms.gaussian_beta, wf_generator.transform.gaussian_noise)
+    path = str(tmpdir_factory.mktemp("accumulator").join("a.events"))
+    with dataset.DatasetWriter(path) as writer:
+        writer.extend({"one": wf_generator.generate_batch(10, *args, **KWARGS),
+                       "two": wf_generator.generate_two_batch(10, *args, **KWARGS)})
+    return path
+
+
+def assert_same(a, b):
+    np.testing.assert_array_equal(a.dr_bins, b.dr_bins)
+    np.testing.assert_array_equal(a.dt_bins, b.dt_bins)
+    assert (a.n_one, a.n_one_fake) == (b.n_one, b.n_one_fake)
+    np.testing.assert_array_equal(a.total, b.total)
+    np.testing.assert_array_equal(a.incorrect, b.incorrect)
+    assert a.tiers == b.tiers
+
+
+def test_chunks_add_up(path):
+    whole = one_vs_two(e821.fit_waveform, path, n_workers=1, show=False)
+    assert (whole.n_one, whole.n_two) == (10, 10)
+
+    summed = accumulator.Accumulator()
+    for group, start, truth, counts, tiers in executor.run(e821.fit_waveform, path, n_workers=2,
+                                                           chunk_size=3):
+        chunk = accumulator.Accumulator()
+        if group == "one":
+            chunk.add_one(counts, tiers)
+        else:
+            chunk.add_two(truth, counts, tiers)
+        summed = summed + chunk
+    assert_same(summed, whole)
+
+
+def test_save_load(tmpdir):
+    result = accumulator.Accumulator()
+    result.add_one([1, 2, 1], ["e821", "automaton", None])
+    truth = np.zeros((2, 2), dtype=wf_generator.generator.truth_dtype)
+    truth["x0"][:, 1] = 3.
+    truth["t0"][:, 1] = [5., 500.]
+    result.add_two(truth, [1, 2], ["likelihood", "e821"])
+
+    filename = str(tmpdir.join("acc.npz"))
+    result.save(filename)
+    loaded = accumulator.Accumulator.load(filename)
+    assert_same(loaded, result)
+    assert loaded.fake_rate == 1./3
+    # beyond the last edge goes in the last bin
+    assert loaded.total[3, 0] == 1 and loaded.total[3, -1] == 1
+    assert loaded.incorrect[3, 0] == 1 and loaded.incorrect.sum() == 1
+
+    # saved shards add up like the accumulators
+    result.save(str(tmpdir.join("a.npz")))
+    loaded += accumulator.Accumulator.load(str(tmpdir.join("a.npz")))
+    assert_same(loaded, result + result)
+    assert loaded.tiers == {"e821": 4, "automaton": 2, "likelihood": 2}
+
+
+def test_add_different_bins():
+    with pytest.raises(ValueError):
+        accumulator.Accumulator() + accumulator.Accumulator(dt_bins=[0, 100])
@@ -0,0 +1,243 @@
+"""The compiled and NumPy automaton kernels agree"""
+
+import numpy as np
+import pytest
+
+import algos.automaton as ca
+import algos.automaton_kernels as ak
+from gm2_clustering.sparse import SparseEvents
+
+# the loops as plain Python, so they are tested even without numba
+loops = ak.Kernels(ak._local_maxima_loops, ak._grow_offsets_loops, ak._grow_table_loops,
+                   ak._label_counts_loops, ak._priority_flood_loops)
+
+
+@pytest.fixture
+def with_loops(monkeypatch):
+    """Make the plain Python loops available to automaton as kernels="loops" """
+    monkeypatch.setattr(ak, "backends", ak.backends + ("loops",))
+    monkeypatch.setitem(ak._kernels, "loops", loops)
+
+
+def compiled():
+    pytest.importorskip("numba")
+    return ak.get_kernels("numba")
+
+
+def noise(shape, seed=0):
+    np.random.seed(seed)
+    return np.random.normal(size=shape)
+
+
+def plateaus(shape, seed=0):
+    """Few distinct values, so that neighbours are often equal"""
+    np.random.seed(seed)
+    return np.random.randint(0, 4, size=shape).astype(np.float64)
+
+
+def grids():
+    wfs = [noise((3, 4, 3, 5)), plateaus((3, 4, 3, 5)), np.zeros((2, 3, 3, 3))]
+    # a maximum on a corner, one on an edge, and a flat top across the edge
+    edges = np.zeros((1, 4, 3, 5))
+    edges[0, 0, 0, 0] = 5.
+    edges[0, 3, 1, 4] = 4.
+    edges[0, 2, 2, 1:3] = 3.
+    wfs.append(edges)
+    return wfs
+
+
+def check_local_maxima(kernels):
+    for wfs in grids():
+        for dtype in (np.float64, np.float32, np.uint16):
+            typed = (wfs*10 + 20).astype(dtype)
+            for threshold in (0., 20., 35.):
+                np.testing.assert_array_equal(kernels.local_maxima(typed, threshold),
+                                              ak._local_maxima_numpy(typed, threshold))
+
+
+def test_local_maxima_loops():
+    check_local_maxima(loops)
+
+
+def test_local_maxima_edges():
+    wfs = grids()[-1]
+    is_seed = ak._local_maxima_loops(wfs, 0.)
+    assert is_seed[0, 0, 0, 0] and is_seed[0, 3, 1, 4]
+    assert is_seed[0, 2, 2, 1] and is_seed[0, 2, 2, 2]
+    assert is_seed.sum() == 4
+
+
+def test_local_maxima_compiled():
+    check_local_maxima(compiled())
+
+
+def grow_inputs(wf, threshold, seed_threshold):
+    """Arguments of grow_offsets, the way label_automaton sets them up"""
+    labels, active = ca.initialize_labels(wf, threshold, seed_threshold, kernels="numpy")
+    padded_shape, inner, neighbours = ca._padded_layout(wf.shape)
+    padded_labels = np.zeros(padded_shape + labels.shape[-1:], dtype=np.uint64)
+    padded_labels[inner] = labels
+    padded_active = np.zeros(padded_shape, dtype=np.bool)
+    padded_active[inner] = active
+    flat_labels = padded_labels.reshape(-1, labels.shape[-1])
+    return flat_labels, padded_active.ravel(), np.flatnonzero(flat_labels.any(axis=1)), neighbours
+
+
+def check_grow_offsets(kernels):
+    # the low seed threshold gives more than 64 seeds, so several words
+    for wf, threshold, seed_threshold in [(noise((9, 6, 40)), 0., 1.),
+                                          (noise((9, 6, 40), 1), 0.5, 2.),
+                                          (plateaus((5, 4, 10)), 1., 2.)]:
+        labels, active, frontier, neighbours = grow_inputs(wf, threshold, seed_threshold)
+        expected = labels.copy()
+        n_expected = ak._grow_offsets_numpy(expected, active, frontier, neighbours)
+        assert kernels.grow_offsets(labels, active, frontier, neighbours) == n_expected
+        np.testing.assert_array_equal(labels, expected)
+
+
+def test_grow_offsets_loops():
+    check_grow_offsets(loops)
+
+
+def test_grow_offsets_compiled():
+    check_grow_offsets(compiled())
+
+
+def test_several_label_words():
+    labels, _, _, _ = grow_inputs(noise((9, 6, 40)), 0., 1.)
+    assert labels.shape[1] > 1
+
+
+def check_grow_table(kernels):
+    for wfs, threshold in [(noise((4, 6, 5, 12)), 0.5), (plateaus((3, 4, 3, 8)), 1.)]:
+        events = SparseEvents.from_dense(wfs, threshold - 1.)
+        table = events.neighbours()
+        n_entries = len(table)
+        values = np.asarray(events.values[:n_entries])
+        # one label per active entry, with an empty inactive row at the end
+        # for the missing neighbours
+        active = np.append(~(values < threshold), False)
+        frontier = np.flatnonzero(active[:-1])[::3]
+        labels = np.zeros((n_entries+1, 2), dtype=np.uint64)
+        ilabel = np.arange(len(frontier)) % 128
+        labels[frontier, ilabel//64] = np.left_shift(np.uint64(1), (ilabel % 64).astype(np.uint64))
+
+        expected = labels.copy()
+        n_expected = ak._grow_table_numpy(expected, active, frontier, table)
+        assert kernels.grow_table(labels, active, frontier, table) == n_expected
+        np.testing.assert_array_equal(labels, expected)
+
+
+def test_grow_table_loops():
+    check_grow_table(loops)
+
+
+def test_grow_table_compiled():
+    check_grow_table(compiled())
+
+
+def check_label_counts(kernels):
+    np.random.seed(0)
+    labels = np.random.randint(0, 2**62, size=(20, 3)).astype(np.uint64)
+    labels[5:9] = 0
+    # empty segments at the start, middle and end
+    offsets = np.array([0, 0, 4, 5, 5, 9, 20, 20], dtype=np.int64)
+    np.testing.assert_array_equal(kernels.label_counts(labels, offsets),
+                                  ak._label_counts_numpy(labels, offsets))
+    assert kernels.label_counts(labels[:0], np.zeros(1, dtype=np.int64)).tolist() == []
+
+
+def test_label_counts_loops():
+    check_label_counts(loops)
+
+
+def test_label_counts_compiled():
+    check_label_counts(compiled())
+
+
+def flood_inputs(wf, threshold, seed_threshold):
+    """Arguments of priority_flood, the way region_grow sets them up"""
+    seeds, _ = ca.find_seeds(wf, seed_threshold, kernels="numpy")
+    seeds = seeds[~(wf.ravel()[seeds] < threshold)]
+    padded_shape, inner, neighbours = ca._padded_layout(wf.shape)
+    values = np.zeros(padded_shape)
+    values[inner] = wf
+    free = np.zeros(padded_shape, dtype=np.bool)
+    free[inner] = ~(wf < threshold)
+    regions = np.zeros(padded_shape, dtype=np.int32)
+    seeds = np.ravel_multi_index(np.add(np.unravel_index(seeds, wf.shape), 1), padded_shape)
+    regions.ravel()[seeds] = np.arange(len(seeds)) + 1
+    return values.ravel(), free.ravel(), regions.ravel(), seeds, neighbours
+
+
+def check_priority_flood(kernels):
+    # plateaus make many equal values, which are taken in cell order
+    for wf, threshold, seed_threshold in [(noise((9, 6, 40)), 0., 1.),
+                                          (plateaus((5, 4, 10)), 1., 2.),
+                                          (plateaus((5, 4, 10), 1), 0., 2.)]:
+        values, free, regions, seeds, neighbours = flood_inputs(wf, threshold, seed_threshold)
+        expected = regions.copy()
+        ak._priority_flood_numpy(values, free.copy(), expected, seeds, neighbours)
+        assert len(np.unique(expected)) > 2
+        kernels.priority_flood(values, free, regions, seeds, neighbours)
+        np.testing.assert_array_equal(regions, expected)
+
+
+def test_priority_flood_loops():
+    check_priority_flood(loops)
+
+
+def test_priority_flood_compiled():
+    check_priority_flood(compiled())
+
+
+def test_priority_flood_highest_first():
+    # the middle cell is reached by both seeds at once, and goes to the
+    # one whose cell next to it is higher
+    wf = np.array([[[9., 2., 1., 3., 8.]]])
+    regions = ca.region_grow(wf, 0.5, 5., kernels="numpy")
+    assert regions.ravel().tolist() == [1, 1, 2, 2, 2]
+
+
+def automaton_results(kernels):
+    wfs = noise((3, 9, 6, 30))*2
+    wfs[:, 4, 3, 10] = 30.
+    wfs[:, 1, 1, 20] = 25.
+    events = SparseEvents.from_dense(wfs, 0.)
+    labels = [ca.label_automaton(wf, 1., 5., kernels=kernels) for wf in wfs]
+    sparse_labels = ca.sparse_label_automaton(events, 1., 5., kernels=kernels)
+    regions = [ca.region_grow(wf, 1., 5., kernels=kernels) for wf in wfs]
+    return (ca.find_seeds(wfs, 5., kernels=kernels), labels, sparse_labels,
+            ca.sparse_cluster_counts(events, sparse_labels, kernels=kernels), regions)
+
+
+def check_automaton(kernels):
+    (seeds, offsets), labels, sparse_labels, counts, regions = automaton_results(kernels)
+    (np_seeds, np_offsets), np_labels, np_sparse_labels, np_counts, np_regions = automaton_results("numpy")
+    np.testing.assert_array_equal(seeds, np_seeds)
+    np.testing.assert_array_equal(offsets, np_offsets)
+    for a, b in zip(labels + regions, np_labels + np_regions):
+        np.testing.assert_array_equal(a, b)
+    np.testing.assert_array_equal(sparse_labels, np_sparse_labels)
+    np.testing.assert_array_equal(counts, np_counts)
+
+
+def test_automaton_loops(with_loops):
+    check_automaton("loops")
+
+
+def test_automaton_compiled():
+    compiled()
+    check_automaton("numba")
+
+
+def test_warmup():
+    compiled()
+    ak.warmup("numba")
+    signatures = [str(s) for s in ak.get_kernels("numba").local_maxima.signatures]
+    assert any("uint16" in s for s in signatures)
+
+
+def test_unknown_kernels():
+    with pytest.raises(ValueError):
+        ak.get_kernels("fortran")
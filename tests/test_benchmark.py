@@ -0,0 +1,21 @@
+import os
+
+import pytest
+
+import gm2_clustering.benchmark as benchmark
+
+
+def _die(queue, args):
+    os._exit(3)
+
+
+def test_run_isolated_child_dies(monkeypatch):
+    monkeypatch.setattr(benchmark, "_run_case_child", _die)
+    with pytest.raises(RuntimeError, match="exit code 3"):
+        benchmark.run_isolated("generate", 1)
+
+
+def test_run_isolated_error():
+    result = benchmark.run_isolated("no such case", 1)
+    assert result["name"] == "no such case"
+    assert "KeyError" in result["error"]
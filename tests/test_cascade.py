@@ -0,0 +1,96 @@
+import pickle
+
+import numpy as np
+import pytest
+
+import algos.cascade as cascade
+import algos.e821 as e821
+import gm2_clustering.wf_generator as wf_generator
+from gm2_clustering.wf_generator import waveforms
+
+KWARGS = {"amplitude": 30000., "xwidth": 1., "ywidth": 1., "noise": 5.}
+E821_BAND = (5, 8)
+AUTOMATON_BAND = (0.05, 0.2)
+LIKELIHOOD = ((1., 2., 3.), (4., 5., 6.))
+
+
+@pytest.fixture
+def scores(monkeypatch):
+    """Set the e821 and automaton scores, and record which tiers ran"""
+    state = {"calls": []}
+
+    def count_samples(wf, thresh_frac):
+        state["calls"].append("e821")
+        return state["e821"]
+
+    def second_cluster_fraction(wf, threshold, backend):
+        state["calls"].append("automaton")
+        return state["automaton"]
+
+    def fit_likelihood(wf, min_improvement):
+        state["calls"].append("likelihood")
+        return LIKELIHOOD
+
+    monkeypatch.setattr(e821, "count_samples", count_samples)
+    monkeypatch.setattr(cascade, "second_cluster_fraction", second_cluster_fraction)
+    monkeypatch.setattr(cascade, "fit_likelihood", fit_likelihood)
+    return state
+
+
+@pytest.mark.parametrize("e821_score, automaton_score, n_pulses, tier", [
+    # outside the e821 band, band edges included
+    (0, None, 1, "e821"),
+    (5, None, 1, "e821"),
+    (8, None, 2, "e821"),
+    (30, None, 2, "e821"),
+    # inside it, decided by the automaton
+    (6, 0., 1, "automaton"),
+    (7, 0.05, 1, "automaton"),
+    (6, 0.2, 2, "automaton"),
+    (7, 0.5, 2, "automaton"),
+    # inside both bands
+    (6, 0.1, 2, "likelihood"),
+    (7, 0.19, 2, "likelihood"),
+])
+def test_tier_routing(scores, e821_score, automaton_score, n_pulses, tier):
+    scores["e821"], scores["automaton"] = e821_score, automaton_score
+    result = cascade.fit_waveform(np.zeros((6, 9, 200)), e821_band=E821_BAND,
+                                  automaton_band=AUTOMATON_BAND)
+    assert result.tier == tier
+    assert len(result) == n_pulses
+    # later tiers only run for events the earlier ones can't decide
+    assert scores["calls"] == list(cascade.tiers[:cascade.tiers.index(tier)+1])
+    if tier == "likelihood":
+        assert result == LIKELIHOOD
+
+
+def test_result_pickles():
+    result = cascade.Result(LIKELIHOOD, "likelihood")
+    loaded = pickle.loads(pickle.dumps(result, pickle.HIGHEST_PROTOCOL))
+    assert loaded == result and loaded.tier == "likelihood"
+
+
+def test_generated_events_stop_at_first_sure_tier():
+    np.random.seed(6)
+    args = (wf_generator.params.uniform, waveforms.gaussian_beta, wf_generator.transform.gaussian_noise)
+    wfs = np.concatenate([wf_generator.generate_batch(10, *args, **KWARGS)[1],
+                          wf_generator.generate_two_batch(10, *args, **KWARGS)[1]])
+    # wide bands send some events on to the likelihood fits
+    e821_band, band = (5, 12), (0.1, 0.5)
+    seen = set()
+    for wf in wfs:
+        result = cascade.fit_waveform(wf, e821_band=e821_band, automaton_band=band)
+        seen.add(result.tier)
+        counts = e821.count_samples(wf)
+        if counts <= e821_band[0] or counts >= e821_band[1]:
+            assert result.tier == "e821"
+            assert len(result) == (1 if counts <= e821_band[0] else 2)
+            continue
+        fraction = cascade.second_cluster_fraction(wf)
+        if fraction <= band[0] or fraction >= band[1]:
+            assert result.tier == "automaton"
+            assert len(result) == (1 if fraction <= band[0] else 2)
+        else:
+            assert result.tier == "likelihood"
+            assert result == cascade.Result(cascade.fit_likelihood(wf), "likelihood")
+    assert seen == set(cascade.tiers)
@@ -0,0 +1,132 @@
+import os
+
+import numpy as np
+import pytest
+
+import gm2_clustering.dataset as dataset
+import gm2_clustering.dtypes as dtypes
+import gm2_clustering.wf_generator as wf_generator
+from gm2_clustering.wf_generator import save_waveform, waveforms
+from gm2_clustering.wf_generator.generator import truth_dtype
+
+KWARGS = {"amplitude": 30000., "xwidth": 1., "ywidth": 1., "noise": 5.}
+
+
+def events(n, seed):
+    """(truth, wfs) of n one-pulse and n two-pulse events"""
+    np.random.seed(seed)
+    args = (wf_generator.params.uniform, waveforms.gaussian_beta, wf_generator.transform.gaussian_noise)
+    return {"one": wf_generator.generate_batch(n, *args, **KWARGS),
+            "two": wf_generator.generate_two_batch(n, *args, **KWARGS)}
+
+
+def check_group(data, group, truth, wfs):
+    stored = data[group]
+    assert len(stored) == len(truth)
+    np.testing.assert_array_equal(stored.truth, truth)
+    np.testing.assert_array_equal(np.asarray(stored.waveforms), wfs)
+
+
+def expected(batches, policy, sparse_threshold):
+    """What reading back the batches should give"""
+    result = {}
+    for group in ("one", "two"):
+        truth = np.concatenate([batch[group][0] for batch in batches])
+        wfs = np.concatenate([batch[group][1] for batch in batches])
+        wfs = policy.decode(policy.encode(wfs))
+        if sparse_threshold is not None:
+            # from_dense works on the values before they are encoded
+            kept = np.concatenate([batch[group][1] for batch in batches]) > sparse_threshold
+            wfs = np.where(kept, wfs, 0)
+        result[group] = truth, wfs
+    return result
+
+
+@pytest.mark.parametrize("policy, sparse_threshold", [
+    ("float64", None),
+    ("float64", 20.),
+    ("uint16:0.5:100", None),
+    ("uint16:0.5:100", 20.),
+])
+def test_extend_round_trip(tmpdir, policy, sparse_threshold):
+    policy = dtypes.Policy.parse(policy)
+    path = str(tmpdir.join("a.events"))
+    batches = [events(3, 0), events(2, 1)]
+    with dataset.DatasetWriter(path, sparse_threshold, policy) as writer:
+        writer.extend(batches[0])
+    # appending with a new writer picks up the policy of the dataset
+    with dataset.DatasetWriter(path, sparse_threshold) as writer:
+        assert writer.policy == policy
+        writer.extend(batches[1])
+
+    with dataset.load(path) as data:
+        assert data.keys() == ["one", "two"]
+        for group, (truth, wfs) in expected(batches, policy, sparse_threshold).iteritems():
+            check_group(data, group, truth, wfs)
+            if sparse_threshold is not None:
+                assert data[group].waveforms.threshold == sparse_threshold
+
+
+def test_extend_mismatch(tmpdir):
+    path = str(tmpdir.join("a.events"))
+    batch = events(2, 0)
+    dataset.DatasetWriter(path).extend(batch)
+    with pytest.raises(ValueError):
+        dataset.DatasetWriter(path, policy=dtypes.Policy("float32")).extend(batch)
+    with pytest.raises(ValueError):
+        dataset.DatasetWriter(path, sparse_threshold=1.).extend(batch)
+
+
+@pytest.mark.parametrize("sparse_threshold", [None, 20.])
+def test_interrupted_extend(tmpdir, monkeypatch, sparse_threshold):
+    path = str(tmpdir.join("a.events"))
+    batches = [events(3, 0), events(2, 1), events(4, 2)]
+    dataset.DatasetWriter(path, sparse_threshold).extend(batches[0])
+
+    # the data of the second batch is written, but not the meta data
+    def interrupt(path, meta):
+        raise KeyboardInterrupt
+    writer = dataset.DatasetWriter(path, sparse_threshold)
+    with monkeypatch.context() as m:
+        m.setattr(dataset, "_write_meta", interrupt)
+        with pytest.raises(KeyboardInterrupt):
+            writer.extend(batches[1])
+
+    # the dataset is as it was, and appending again overwrites the leftovers
+    with dataset.load(path) as data:
+        for group, (truth, wfs) in expected(batches[:1], dtypes.get_policy(), sparse_threshold).iteritems():
+            check_group(data, group, truth, wfs)
+    dataset.DatasetWriter(path, sparse_threshold).extend(batches[2])
+    with dataset.load(path) as data:
+        for group, (truth, wfs) in expected(batches[::2], dtypes.get_policy(), sparse_threshold).iteritems():
+            check_group(data, group, truth, wfs)
+
+
+def test_npz_round_trip(tmpdir):
+    npz_file = str(tmpdir.join("a.npz"))
+    np.random.seed(0)
+    save_waveform.save_waveform(4, npz_file, wf_generator.params.uniform, waveforms.gaussian_beta,
+                                wf_generator.transform.gaussian_noise, KWARGS)
+
+    path = str(tmpdir.join("a.events"))
+    converted = dataset.convert(npz_file, path, chunk_size=3)
+    with dataset.load(npz_file) as npz:
+        for group in ("one", "two"):
+            assert len(converted[group]) == len(npz[group]) == 4
+            for event, original in zip(converted[group], npz[group]):
+                assert event[:-1] == tuple(tuple(t) for t in original[:-1])
+                np.testing.assert_array_equal(event[-1], original[-1])
+    assert converted["two"].truth.dtype == truth_dtype
+    assert converted["two"].truth.shape == (4, 2)
+
+
+def test_npz_one_vs_two(tmpdir):
+    from gm2_clustering.algo_tests.one_vs_two import one_vs_two
+    import algos.e821 as e821
+
+    npz_file = str(tmpdir.join("a.npz"))
+    np.random.seed(0)
+    save_waveform.save_waveform(4, npz_file, wf_generator.params.uniform, waveforms.gaussian_beta,
+                                wf_generator.transform.gaussian_noise, KWARGS)
+    results = one_vs_two(e821.fit_waveform, npz_file, n_workers=1, chunk_size=3, show=False)
+    assert results.n_one == results.n_two == 4
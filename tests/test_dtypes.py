@@ -0,0 +1,88 @@
+"""The dtype policies give the same classifications as float64"""
+
+import numpy as np
+import pytest
+
+import algos.automaton as ca
+import algos.e821 as e821
+import algos.likelihood as likelihood
+import gm2_clustering.dataset as dataset
+import gm2_clustering.dtypes as dtypes
+from gm2_clustering.wf_generator import generator, params, waveforms, transform
+
+POLICIES = ["float64", "float32", "uint16:0.02:2000"]
+
+_generator_args = (params.uniform, waveforms.gaussian_beta, transform.gaussian_noise)
+_generator_kwargs = {"amplitude": 30000., "xwidth": 1., "ywidth": 1., "noise": 5.}
+
+
+@pytest.fixture
+def policy(request):
+    old = dtypes.get_policy()
+    dtypes.set_policy(request.param)
+    yield dtypes.get_policy()
+    dtypes.set_policy(old)
+
+
+def make_events(tmpdir, n=10):
+    """Fixed-seed one- and two-pulse events, written to and read back from a dataset"""
+    np.random.seed(1234)
+    one = generator.generate_batch(n, *_generator_args, **_generator_kwargs)
+    two = generator.generate_two_batch(n, *_generator_args, **_generator_kwargs)
+    path = str(tmpdir.join("events" + dataset.EXTENSION))
+    dataset.DatasetWriter(path).extend({'one': one, 'two': two})
+    data = dataset.load(path)
+    return np.concatenate([np.asarray(data[group].waveforms) for group in ('one', 'two')])
+
+
+def reference_events(tmpdir):
+    old = dtypes.get_policy()
+    dtypes.set_policy("float64")
+    try:
+        return make_events(tmpdir.mkdir("float64"))
+    finally:
+        dtypes.set_policy(old)
+
+
+@pytest.mark.parametrize("policy", POLICIES, indirect=True)
+def test_generated_dtype(policy, tmpdir):
+    wfs = make_events(tmpdir)
+    assert wfs.dtype == policy.work_dtype
+
+
+@pytest.mark.parametrize("policy", POLICIES, indirect=True)
+def test_e821_counts(policy, tmpdir):
+    reference = reference_events(tmpdir)
+    wfs = make_events(tmpdir)
+    expected = [len(e821.fit_waveform(wf)) for wf in reference]
+    assert [len(e821.fit_waveform(wf)) for wf in wfs] == expected
+    assert e821.fit_batch(wfs).tolist() == expected
+
+
+@pytest.mark.parametrize("policy", POLICIES, indirect=True)
+def test_automaton_counts(policy, tmpdir):
+    reference = reference_events(tmpdir)
+    wfs = make_events(tmpdir)
+    expected = [len(ca.fit_waveform(wf)) for wf in reference]
+    assert [len(ca.fit_waveform(wf)) for wf in wfs] == expected
+
+
+@pytest.mark.parametrize("policy", POLICIES, indirect=True)
+def test_likelihood_fits_in_float64(policy, tmpdir, monkeypatch):
+    wf = make_events(tmpdir, n=1)[-1]
+    dtypes_seen = []
+    leastsq = likelihood.scipy.optimize.leastsq
+
+    def checked_leastsq(func, x0, *args, **kwargs):
+        dtypes_seen.append(func(np.asarray(x0, dtype=np.float64)).dtype)
+        return leastsq(func, x0, *args, **kwargs)
+
+    monkeypatch.setattr(likelihood.scipy.optimize, "leastsq", checked_leastsq)
+    likelihood.fit_one_pulse(wf)
+    likelihood.fit_two_pulse(wf)
+    assert dtypes_seen == [np.float64, np.float64]
+
+    data = likelihood._fit_data(wf)
+    assert data.dtype == np.float64
+    params, chi2, _ = likelihood.batch_fit_one_pulse(wf[np.newaxis])
+    assert params.dtype == np.float64 and chi2.dtype == np.float64
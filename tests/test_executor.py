@@ -0,0 +1,77 @@
+from functools import partial
+
+import numpy as np
+import pytest
+
+import algos.cascade as cascade
+import algos.e821 as e821
+import gm2_clustering.dataset as dataset
+import gm2_clustering.wf_generator as wf_generator
+from gm2_clustering.algo_tests import executor
+from gm2_clustering.wf_generator import waveforms
+
+KWARGS = {"amplitude": 30000., "xwidth": 1., "ywidth": 1., "noise": 5.}
+N_EVENTS = 7
+
+# e821 has a batch version, the cascade goes event by event and reports
+# tiers. The empty automaton band keeps it away from the likelihood fits.
+FIT_FUNCS = [e821.fit_waveform,
+             partial(cascade.fit_waveform, e821_band=(5, 7), automaton_band=(0.1, 0.1))]
+
+
+@pytest.fixture(scope="module")
+def events(tmpdir_factory):
+    """Path of a dataset with N_EVENTS one- and two-pulse events, and the events"""
+    np.random.seed(3)
+    args = (wf_generator.params.uniform, waveforms.gaussian_beta, wf_generator.transform.gaussian_noise)
+    batch = {"one": wf_generator.generate_batch(N_EVENTS, *args, **KWARGS),
+             "two": wf_generator.generate_two_batch(N_EVENTS, *args, **KWARGS)}
+    path = str(tmpdir_factory.mktemp("executor").join("a.events"))
+    with dataset.DatasetWriter(path) as writer:
+        writer.extend(batch)
+    return path, batch
+
+
+def direct(fit_func, wfs):
+    """Counts and tiers of fit_func called on each event in this process"""
+    results = [fit_func(wf) for wf in wfs]
+    return [len(result) for result in results], [getattr(result, 'tier', None) for result in results]
+
+
+def test_make_jobs_partial_chunks():
+    assert executor.make_jobs([("one", 5), ("two", 2)], 2) == \
+        [("one", 0, 2), ("two", 0, 2), ("one", 2, 4), ("one", 4, 5)]
+    assert executor.make_jobs([("one", 0)], 2) == []
+
+
+@pytest.mark.parametrize("fit_func", FIT_FUNCS)
+@pytest.mark.parametrize("n_workers", [1, 2])
+@pytest.mark.parametrize("chunk_size", [1, 3, N_EVENTS, 100])
+def test_run_matches_direct(events, fit_func, n_workers, chunk_size):
+    path, batch = events
+    chunks = dict((group, []) for group in batch)
+    for group, start, truth, counts, tiers in executor.run(fit_func, path, n_workers=n_workers,
+                                                           chunk_size=chunk_size):
+        assert len(truth) == len(counts) == len(tiers) <= chunk_size
+        np.testing.assert_array_equal(truth, batch[group][0][start:start+len(counts)])
+        chunks[group].append((start, counts, tiers))
+
+    for group, (truth, wfs) in batch.iteritems():
+        starts = [start for start, _, _ in chunks[group]]
+        assert starts == range(0, N_EVENTS, chunk_size)
+        counts, tiers = direct(fit_func, wfs)
+        assert np.concatenate([c for _, c, _ in chunks[group]]).tolist() == counts
+        assert np.concatenate([t for _, _, t in chunks[group]]).tolist() == tiers
+
+
+def test_evaluate_same_for_any_workers_and_chunks(events):
+    path, _ = events
+    fit_func = FIT_FUNCS[1]
+    reference = executor.evaluate(fit_func, path, n_workers=1, chunk_size=100)
+    for n_workers, chunk_size in [(2, 1), (2, 3), (1, 4)]:
+        results = executor.evaluate(fit_func, path, n_workers=n_workers, chunk_size=chunk_size)
+        for group in ("one", "two"):
+            np.testing.assert_array_equal(results[group].truth, reference[group].truth)
+            np.testing.assert_array_equal(results[group].counts, reference[group].counts)
+            assert results[group].tiers.tolist() == reference[group].tiers.tolist()
+
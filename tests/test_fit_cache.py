@@ -0,0 +1,109 @@
+import os
+
+import numpy as np
+import numpy.ma as ma
+import pytest
+
+import gm2_clustering.fit_cache as fit_cache
+import gm2_clustering.utils as utils
+import algos.likelihood as likelihood
+
+
+@pytest.fixture
+def cache(tmpdir):
+    fit_cache.configure(str(tmpdir.join("cache")))
+    yield str(tmpdir.join("cache"))
+    fit_cache.configure(None)
+
+
+def counted(version=0):
+    """A memoized function that counts how often it really runs"""
+    calls = []
+
+    @fit_cache.memoize("test.counted", version)
+    def fcn(wf, scale=1.):
+        calls.append(1)
+        return wf.sum()*scale
+    return fcn, calls
+
+
+def test_off():
+    fit_cache.configure(None)
+    assert not fit_cache.enabled()
+    fcn, calls = counted()
+    fcn(np.ones(3))
+    fcn(np.ones(3))
+    assert len(calls) == 2
+
+
+def test_second_call_is_a_hit(cache):
+    fcn, calls = counted()
+    assert fcn(np.ones(3), scale=2.) == fcn(np.ones(3), scale=2.) == 6.
+    assert len(calls) == 1
+    # any other argument, or another version, runs again
+    fcn(np.ones(3), scale=3.)
+    fcn(np.ones(4), scale=2.)
+    counted(version=1)[0](np.ones(3), scale=2.)
+    assert len(calls) == 3
+
+
+def test_fit_one_pulse(cache, monkeypatch):
+    params = np.array([[3.2, 2.6, 61.3, 20000., 1., 1.2]])
+    wf, _ = likelihood._batch_residuals(params, np.zeros((1,) + utils.WF_SHAPE))
+    wf = wf[0] + np.random.RandomState(0).normal(0, 5, utils.WF_SHAPE)
+    fitted, chi2 = likelihood.fit_one_pulse(wf)
+
+    def no_fit(*args, **kwargs):
+        raise AssertionError("fit run again")
+    monkeypatch.setattr(likelihood.scipy.optimize, "leastsq", no_fit)
+    cached, cached_chi2 = likelihood.fit_one_pulse(wf)
+    np.testing.assert_array_equal(cached, fitted)
+    assert cached_chi2 == chi2
+
+
+def test_key():
+    wf = np.arange(6.).reshape(2, 3)
+    base = fit_cache.key("fit:0", wf, 1, p0=None)
+    masked = ma.masked_array(wf, mask=wf > 3)
+    others = [
+        fit_cache.key("fit:1", wf, 1, p0=None),
+        fit_cache.key("other:0", wf, 1, p0=None),
+        fit_cache.key("fit:0", wf + 1e-12, 1, p0=None),
+        fit_cache.key("fit:0", wf.astype(np.float32), 1, p0=None),
+        fit_cache.key("fit:0", wf.reshape(3, 2), 1, p0=None),
+        fit_cache.key("fit:0", masked, 1, p0=None),
+        fit_cache.key("fit:0", wf, 2, p0=None),
+        fit_cache.key("fit:0", wf, 1, p0=np.zeros(6)),
+        fit_cache.key("fit:0", wf, 1),
+        fit_cache.key("fit:0", wf, (1,), p0=None),
+    ]
+    assert fit_cache.key("fit:0", wf.copy(), 1, p0=None) == base
+    assert len(set(others + [base])) == len(others) + 1
+    assert fit_cache.key("fit:0", masked, 1) != fit_cache.key("fit:0", ma.masked_array(wf, mask=wf > 4), 1)
+
+
+def test_evict_oldest_first(cache):
+    for i in xrange(5):
+        fit_cache.put("{:02d}".format(i), "x"*1000)
+        entry = fit_cache._entry_path("{:02d}".format(i))
+        os.utime(entry, (1e9 + i, 1e9 + i))
+    size = os.path.getsize(fit_cache._entry_path("00"))
+
+    # reading an entry makes it the most recently used
+    assert fit_cache.get("01")[0]
+    fit_cache.evict(3*size)
+    assert [fit_cache.get("{:02d}".format(i))[0] for i in xrange(5)] == [False, True, False, True, True]
+    assert fit_cache.size() == 3*size
+
+    fit_cache.clear()
+    assert fit_cache.size() == 0
+
+
+def test_size_limit(tmpdir):
+    fit_cache.configure(str(tmpdir), max_mb=0.01)
+    try:
+        for i in xrange(50):
+            fit_cache.put("{:02d}".format(i), "x"*1000)
+        assert fit_cache.size() <= 0.01*2**20
+    finally:
+        fit_cache.configure(None)
@@ -0,0 +1,33 @@
+import numpy as np
+
+import gm2_clustering.utils as utils
+import algos.likelihood as likelihood
+
+# (x0, y0, t0, amplitude, xwidth, ywidth) of each event
+PARAMS = np.array([[3.2, 2.6, 61.3, 20000., 1., 1.2],
+                   [5.7, 1.4, 120.7, 8000., 0.8, 0.9]])
+
+
+def models(params):
+    data = np.zeros((len(params),) + utils.WF_SHAPE)
+    residuals, _ = likelihood._batch_residuals(params, data)
+    return residuals
+
+
+def test_batch_fit_converges_at_minimum():
+    # nothing can be improved, so no step is ever accepted
+    params, chi2, converged = likelihood.batch_fit(models(PARAMS), PARAMS)
+    assert converged.all()
+    np.testing.assert_array_equal(params, PARAMS)
+
+
+def test_batch_fit_noise():
+    wfs = models(PARAMS) + np.random.RandomState(3).normal(0, 5, (len(PARAMS),) + utils.WF_SHAPE)
+    params, chi2, converged = likelihood.batch_fit(wfs, PARAMS)
+    assert converged.all()
+    np.testing.assert_allclose(params[:, :3], PARAMS[:, :3], atol=0.1)
+
+    # starting again from the fit, it is already at the minimum
+    refit, rechi2, reconverged = likelihood.batch_fit(wfs, params, max_iter=2)
+    assert reconverged.all()
+    np.testing.assert_allclose(rechi2, chi2, rtol=1e-6)
@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+
+import algos.likelihood as lk
+import algos.matched_filter as mf
+
+
+def test_get_bank_reuses_matching_bank(tmpdir):
+    filename = str(tmpdir.join("bank.npz"))
+    built = mf.get_bank(filename, widths=(1., 1.5))
+    loaded = mf.get_bank(filename, widths=[1., 1.5])
+    assert loaded.build_args == built.build_args
+    np.testing.assert_array_equal(loaded.spatial, built.spatial)
+
+
+def test_get_bank_rebuilds_for_other_arguments(tmpdir):
+    filename = str(tmpdir.join("bank.npz"))
+    mf.get_bank(filename, widths=(1.,))
+    bank = mf.get_bank(filename, widths=(0.6, 1.))
+    assert len(bank) == 2*len(mf.get_bank(str(tmpdir.join("other.npz")), widths=(1.,)))
+    assert mf.TemplateBank.load(filename).build_args["widths"] == [0.6, 1.]
+    # no arguments means the default bank
+    assert len(mf.get_bank(filename)) == len(mf.TemplateBank.gaussian())
+
+
+def test_get_bank_other_banks(tmpdir):
+    filename = str(tmpdir.join("bank.npz"))
+    gaussian = mf.TemplateBank.gaussian(widths=(1.,))
+    mf.TemplateBank(gaussian.spatial, gaussian.params, gaussian.pulse).save(filename)
+    assert len(mf.get_bank(filename)) == len(gaussian)
+    with pytest.raises(ValueError):
+        mf.get_bank(filename, widths=(1.,))
+
+
+@pytest.fixture(scope="module")
+def bank():
+    return mf.TemplateBank.gaussian(widths=(0.8, 1.2))
+
+
+# templates, shifts and amplitudes on the bank's grid; the second pulses are
+# smaller and sit on other crystals so that the larger one is found first
+ONE = (np.array([10, 100, 150]), np.array([20, 40, 60]),
+       np.array([20000., 15000., 30000.]))
+TWO = (np.array([200, 20, 90]), np.array([55, 70, 25]),
+       np.array([10000., 12000., 9000.]))
+
+
+def test_match_one_recovers_grid_params(bank):
+    wfs = bank.waveforms(*(ONE + (200,)))
+    params, chi2 = bank.match_one(wfs)
+    np.testing.assert_allclose(params, bank._to_params(*ONE), atol=1e-6)
+    assert np.all(np.abs(chi2) < 1e-3)
+
+
+def test_match_two_recovers_grid_params(bank):
+    wfs = bank.waveforms(*(ONE + (200,))) + bank.waveforms(*(TWO + (200,)))
+    params, chi2 = bank.match_two(wfs)
+    np.testing.assert_allclose(params[:, :6], bank._to_params(*ONE),
+                               atol=1e-6)
+    np.testing.assert_allclose(params[:, 6:], bank._to_params(*TWO),
+                               atol=1e-6)
+    assert np.all(np.abs(chi2) < 1e-3)
+
+
+def test_llr_batch_matches_leastsq(bank):
+    one = bank.waveforms(*(ONE + (200,)))
+    two = one + bank.waveforms(*(TWO + (200,)))
+    rng = np.random.RandomState(0)
+    wfs = np.concatenate([one, two])
+    wfs = wfs + rng.normal(0., 5., wfs.shape)
+
+    llrs = lk.get_llr_batch(wfs, bank=bank)
+
+    # the leastsq fits started from the same bank matches
+    p0_one, _ = bank.match_one(wfs)
+    p0_two, _ = bank.match_two(wfs)
+    expected = np.array([lk.fit_one_pulse(wf, p0=a)[1]/wf.size -
+                         lk.fit_two_pulse(wf, p0=b)[1]
+                         for wf, a, b in zip(wfs, p0_one, p0_two)])
+    np.testing.assert_allclose(llrs, expected, rtol=2e-3)
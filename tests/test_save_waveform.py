@@ -0,0 +1,65 @@
+import hashlib
+import os
+
+import numpy as np
+import pytest
+
+import gm2_clustering.wf_generator as wf_generator
+import gm2_clustering.wf_generator.save_waveform as save_waveform
+from gm2_clustering.wf_generator import waveforms
+
+WAVEFORMS = [
+    (waveforms.gaussian_beta, {"amplitude": 30000., "xwidth": 1., "ywidth": 1., "noise": 5.}),
+    (waveforms.base_sim_wf, {"amplitude": 2., "noise": 5.}),
+]
+
+
+@pytest.fixture
+def library(tmpdir, monkeypatch):
+    """A small shower library in place of the real one behind base_sim_wf"""
+    filename = str(tmpdir.join("waveforms.bin"))
+    np.random.RandomState(0).randint(0, 3000, size=(50, 6, 9, 200)).astype(np.uint16).tofile(filename)
+    monkeypatch.setattr(waveforms.base_wf, "wf_filename", filename)
+    monkeypatch.setattr(waveforms.base_wf, "_library", None)
+    return filename
+
+
+def generate(tmpdir, name, wf_fcn, kwargs, n_workers):
+    output = str(tmpdir.join(name + ".events"))
+    save_waveform.save_waveform_parallel(10, output, wf_generator.params.uniform, wf_fcn,
+                                         wf_generator.transform.gaussian_noise, kwargs,
+                                         n_workers=n_workers, chunk_size=4, seed=3)
+    digests = {}
+    for filename in ("one.truth", "one.wfs", "two.truth", "two.wfs"):
+        with open(os.path.join(output, filename), "rb") as f:
+            digests[filename] = hashlib.sha1(f.read()).hexdigest()
+    return digests
+
+
+@pytest.mark.parametrize("wf_fcn, kwargs", WAVEFORMS)
+def test_parallel_output_independent_of_workers(tmpdir, library, wf_fcn, kwargs):
+    # the workers of the second run have already taken waveforms
+    one_worker = generate(tmpdir, "one_worker", wf_fcn, kwargs, 1)
+    three_workers = generate(tmpdir, "three_workers", wf_fcn, kwargs, 3)
+    assert one_worker == three_workers
+
+
+def test_parallel_resumed(tmpdir, library):
+    wf_fcn, kwargs = WAVEFORMS[1]
+    whole = generate(tmpdir, "whole", wf_fcn, kwargs, 2)
+
+    # a run interrupted after its first chunk, with the sampler moved on
+    output = str(tmpdir.join("resumed.events"))
+    chunk_dir = output + ".chunks"
+    os.makedirs(chunk_dir)
+    save_waveform._generate_chunk((0, 4, 4, 3, chunk_dir, wf_generator.params.uniform, wf_fcn,
+                                   wf_generator.transform.gaussian_noise, kwargs))
+    waveforms.base_wf.sample(7)
+    assert generate(tmpdir, "resumed", wf_fcn, kwargs, 2) == whole
+
+
+def test_parallel_needs_dataset(tmpdir):
+    wf_fcn, kwargs = WAVEFORMS[0]
+    with pytest.raises(ValueError):
+        save_waveform.save_waveform_parallel(4, str(tmpdir.join("a.npz")), wf_generator.params.uniform,
+                                             wf_fcn, wf_generator.transform.gaussian_noise, kwargs)
@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+
+import algos.automaton as ca
+import gm2_clustering.stream as stream
+
+# smaller than the window, equal to it, islands split between blocks, the
+# whole record in one block
+BLOCK_SIZES = [1, 3, 5, 7, 20, 64, 600]
+
+
+def record(pulses, length=600, seed=0):
+    """Noise with (start, length, amplitude) pulses added in every crystal"""
+    wf = np.random.RandomState(seed).normal(0, 0.5, (9, 6, length))
+    for start, n, amplitude in pulses:
+        wf[:, :, start:start+n] += amplitude
+    return wf
+
+
+def islands(wf, block_size, **kwargs):
+    return list(stream.find_islands(wf, block_size, threshold=50, window=5, **kwargs))
+
+
+def check_same(a, b):
+    assert [offset for offset, _ in a] == [offset for offset, _ in b]
+    for (_, x), (_, y) in zip(a, b):
+        np.testing.assert_array_equal(x, y)
+
+
+def test_ring_buffer():
+    buf = stream.RingBuffer((2, 1), 5)
+    data = np.arange(24.).reshape(2, 1, 12)
+    for start in (0, 4, 8):
+        buf.write(data[..., start:start+4])
+    assert (buf.tail, buf.head) == (7, 12)
+    np.testing.assert_array_equal(buf.read(7, 12), data[..., 7:12])
+    with pytest.raises(ValueError):
+        buf.read(6, 12)
+    with pytest.raises(ValueError):
+        buf.write(np.zeros((2, 1, 6)))
+
+
+def test_block_sizes():
+    # an island at the start, two that merge, one longer than max_length and
+    # one running into the end
+    wf = record([(3, 4, 3.), (40, 2, 2.), (58, 3, 2.), (200, 150, 2.), (590, 10, 3.)])
+    expected = islands(wf, len(wf[0, 0]), max_length=100)
+    assert [(offset, island.shape[-1]) for offset, island in expected] == \
+        [(0, 21), (35, 40), (195, 100), (276, 88), (585, 15)]
+    for block_size in BLOCK_SIZES:
+        check_same(islands(wf, block_size, max_length=100), expected)
+
+
+def test_merge_gap():
+    # samples above threshold at most 4*window apart share an island
+    assert len(islands(record([(100, 1, 3.), (120, 1, 3.)]), 7)) == 1
+    assert len(islands(record([(100, 1, 3.), (121, 1, 3.)]), 7)) == 2
+
+
+def test_matches_make_time_island():
+    # separate events in one record, each with at least 3 samples above
+    # threshold so make_time_island doesn't lower it
+    pulses = [(30, 3, 3.), (150, 8, 2.), (300, 5, 4.), (480, 12, 1.5)]
+    wf = record(pulses)
+    for block_size in BLOCK_SIZES:
+        found = islands(wf, block_size)
+        assert len(found) == len(pulses)
+        for (offset, island), (start, _, _) in zip(found, pulses):
+            segment_start = start - 25
+            t_min, expected = ca.make_time_island(wf[:, :, segment_start:start+75], threshold=50)
+            assert offset == segment_start + t_min
+            np.testing.assert_array_equal(island, expected)
+
+    # and the whole record, as a single event
+    single = record([(80, 6, 3.)], length=200)
+    t_min, expected = ca.make_time_island(single, threshold=50)
+    check_same(islands(single, 16), [(t_min, expected)])
+
+
+def test_block_too_long():
+    finder = stream.IslandFinder(block_size=10)
+    with pytest.raises(ValueError):
+        finder.feed(np.zeros((9, 6, 11)))
+
+
+def test_fit_stream():
+    wf = record([(30, 3, 3.), (300, 5, 4.)])
+    results = list(stream.fit_stream(lambda island: island.shape[-1], wf, 50, threshold=50))
+    assert results == [(25, 22), (295, 24)]
@@ -0,0 +1,52 @@
+import numpy as np
+
+import algos.automaton as ca
+import algos.e821 as e821
+import gm2_clustering.wf_generator as wf_generator
+from gm2_clustering.sparse import SparseEvents
+from gm2_clustering.wf_generator import waveforms
+from gm2_clustering.algo_tests import sweep
+
+
+def events(n=20, dtype=np.float64):
+    rng = np.random.RandomState(7)
+    t = np.arange(200)
+    pulses = np.exp(-0.5*((t - rng.uniform(20, 180, (n, 1, 1, 1)))/rng.uniform(1, 6, (n, 1, 1, 1)))**2)
+    return (rng.uniform(100, 1000, (n, 9, 6, 1))*pulses + rng.normal(0, 5, (n, 9, 6, 200))).astype(dtype)
+
+
+def test_e821_grid_matches_fit_batch():
+    grid = sweep.E821Grid([0.2, 0.3, 0.4], [4, 6, 8])
+    for dtype in (np.float64, np.float32):
+        wfs = events(dtype=dtype)
+        expected = np.stack([e821.fit_batch(wfs, **point) for point in grid.points()], axis=-1)
+        np.testing.assert_array_equal(grid.batch(wfs), expected)
+
+
+def test_e821_grid_sparse():
+    grid = sweep.E821Grid([0.2, 0.3], [4, 6])
+    wfs = events()
+    np.testing.assert_array_equal(grid.batch(SparseEvents.from_dense(wfs, 0.)), grid.batch(wfs))
+
+
+def generated_events(n=10):
+    """One- and two-pulse events with noise, from the generator"""
+    np.random.seed(5)
+    args = (wf_generator.params.uniform, waveforms.gaussian_beta, wf_generator.transform.gaussian_noise)
+    kwargs = {"amplitude": 30000., "xwidth": 1., "ywidth": 1., "noise": 5.}
+    _, one = wf_generator.generate_batch(n, *args, **kwargs)
+    _, two = wf_generator.generate_two_batch(n, *args, **kwargs)
+    return np.concatenate([one, two])
+
+
+def test_automaton_grid_matches_label_automaton():
+    # thresholds below, between and above the seed thresholds
+    grid = sweep.AutomatonGrid([0.5, 1., 50., 300.], [20., 200., 400.])
+    wfs = generated_events()
+    pulses = grid.batch(wfs)
+    for wf, event_pulses in zip(wfs, pulses):
+        _, island = ca.make_time_island(wf)
+        for point, n_pulses in zip(grid.points(), event_pulses):
+            labels = ca.label_automaton(island, point["threshold"], point["seed_threshold"], kernels="numpy")
+            assert n_pulses == (2 if len(ca.label_ids(labels)) > 1 else 1)
+    assert set(pulses.ravel()) == set([1, 2])
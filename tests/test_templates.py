@@ -0,0 +1,36 @@
+import numpy as np
+import scipy.stats
+
+import gm2_clustering.utils as utils
+import gm2_clustering.wf_generator.templates as templates
+
+PARAMS = [(3.123456789, 2.987654321, 50.00000049, 1000., 0.8, 1.3),
+          (4.5, 2.5, 80.25, 2500., 1.1, 0.9)]
+
+
+def direct(x0, y0, t0, amplitude, xwidth, ywidth):
+    x, y, t = utils.make_coords()
+    return amplitude*scipy.stats.norm.pdf(x, loc=x0, scale=xwidth) * \
+        scipy.stats.norm.pdf(y, loc=y0, scale=ywidth) * \
+        scipy.stats.gamma.pdf(t, 1.4, loc=t0, scale=5.)
+
+
+def test_waveform_matches_model():
+    engine = templates.TemplateEngine()
+    for params in PARAMS:
+        np.testing.assert_allclose(engine.waveform(*params), direct(*params), rtol=1e-12, atol=0)
+
+
+def test_cache_only_reuses_exact_parameters():
+    engine = templates.TemplateEngine()
+    first = engine.time_profile(50.)
+    assert engine.time_profile(50.) is first
+    assert engine.time_profile(50. + 1e-9) is not first
+    assert len(engine._time_cache) == 2
+
+
+def test_batch_matches_waveform():
+    engine = templates.TemplateEngine()
+    stacked = engine.batch(*[np.array(p) for p in zip(*PARAMS)])
+    for wf, params in zip(stacked, PARAMS):
+        np.testing.assert_allclose(wf, engine.waveform(*params), rtol=1e-12, atol=0)